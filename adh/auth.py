@@ -1,26 +1,167 @@
+import hashlib
+from collections import namedtuple
 import requests
 import requests.exceptions
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import current_app
 from connexion import NoContent
 from adh.model.database import Database as db
 from adh.model.models import Utilisateur
+from adh.util.cache import TTLCache
 
+# Sentinel telling a cache miss apart from a cached invalid token (None)
+_MISSING = object()
 
-def get_groups(token):
-    try:
+_token_cache = None
+
+# What the controllers get as "admin" when it comes from the admin cache
+AdminHandle = namedtuple("AdminHandle", ["id", "login"])
+
+
+class AuthClient():
+    """
+    Client of the OAuth server.
+
+    It owns a keep-alive requests.Session so that the TCP/TLS connections to
+    the auth server are reused between requests. There is one client per
+    uWSGI worker, shared by all its threads, so pool_size should be at least
+    the number of threads of a worker.
+    """
+
+    def __init__(self, address, pool_size=4, retries=2, backoff=0.1,
+                 timeout=1):
+        self.address = address
+        self.timeout = timeout
+        self.requests = 0
+
+        # A read timeout is not retried: the server hangs, trying again would
+        # hold the thread of the worker even longer
+        retry = Retry(
+            connect=retries,
+            read=0,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+            raise_on_status=False,
+        )
+        self._adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=retry,
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", self._adapter)
+        self.session.mount("https://", self._adapter)
+
+    def get_groups(self, token):
+        """
+        Ask the auth server who owns the token.
+        Returns None if the token is invalid, raises a RequestException if the
+        server could not be reached or failed to answer.
+        """
         headers = {"Authorization": "Bearer " + token}
-        r = requests.get(
-            current_app.config["AUTH_SERVER_ADDRESS"] + "/api/me",
+        self.requests += 1
+        r = self.session.get(
+            self.address + "/api/me",
             headers=headers,
-            timeout=1
+            timeout=self.timeout
         )
-    except requests.exceptions.ReadTimeout:
+
+        if r.status_code in (401, 403):
+            return None
+        if r.status_code != 200:
+            raise requests.exceptions.HTTPError(
+                "Auth server error {}".format(r.status_code), response=r)
+        infos = r.json()
+        if "uid" not in infos:
+            return None
+        return infos
+
+    def stats(self):
+        """ Return the number of requests and of TCP connections opened """
+        pools = self._adapter.poolmanager.pools
+        connections = sum(pools[k].num_connections for k in pools.keys())
+        return {
+            "requests": self.requests,
+            "connections": connections,
+            "reused": self.requests - connections,
+        }
+
+    def close(self):
+        self.session.close()
+
+
+_auth_client = None
+
+
+def get_auth_client():
+    """ Return the auth server client of this worker, create it if needed """
+    global _auth_client
+    if _auth_client is None:
+        conf = current_app.config
+        _auth_client = AuthClient(
+            conf["AUTH_SERVER_ADDRESS"],
+            pool_size=conf.get("AUTH_POOL_SIZE", 4),
+            retries=conf.get("AUTH_RETRIES", 2),
+            backoff=conf.get("AUTH_BACKOFF", 0.1),
+            timeout=conf.get("AUTH_TIMEOUT", 1),
+        )
+    return _auth_client
+
+
+def _request_groups(token):
+    return get_auth_client().get_groups(token)
+
+
+def get_groups(token):
+    try:
+        return _request_groups(token)
+    except requests.exceptions.RequestException:
         return None
 
-    if r.status_code != 200 or "uid" not in r.json():
+
+def get_token_cache():
+    """ Return the token cache of this worker, create it if needed """
+    global _token_cache
+    if _token_cache is None:
+        _token_cache = TTLCache(
+            maxsize=current_app.config.get("AUTH_CACHE_SIZE", 1024),
+            ttl=current_app.config.get("AUTH_CACHE_TTL", 60),
+        )
+    return _token_cache
+
+
+def _token_key(token):
+    """ Never keep the bearer tokens in memory, only a hash of them """
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def cached_get_groups(token):
+    """
+    Same as get_groups, but the answers of the auth server are kept in the
+    token cache. Invalid tokens are cached too (for a shorter time), timeouts,
+    unreachable server and server errors (5xx) are not.
+    """
+    cache = get_token_cache()
+    key = _token_key(token)
+
+    infos = cache.get(key, _MISSING)
+    if infos is not _MISSING:
+        return infos
+
+    try:
+        infos = _request_groups(token)
+    except requests.exceptions.RequestException:
         return None
 
-    return r.json()
+    if infos:
+        cache.set(key, infos)
+    else:
+        ttl = current_app.config.get("AUTH_CACHE_NEGATIVE_TTL", 5)
+        cache.set(key, None, ttl)
+    return infos
 
 
 def token_info(access_token) -> dict:
@@ -32,7 +173,7 @@ def token_info(access_token) -> dict:
             "groups": []
         }
 
-    infos = get_groups(access_token)
+    infos = cached_get_groups(access_token)
     if not infos:
         return None
     return {
@@ -42,12 +183,45 @@ def token_info(access_token) -> dict:
     }
 
 
+def get_admin_cache():
+    """ Return the login -> Utilisateur.id cache of this worker """
+    ttl = current_app.config.get("ADMIN_CACHE_TTL", 3600)
+    return db.get_db().get_cache(
+        "admins",
+        lambda: TTLCache(maxsize=256, ttl=ttl)
+    )
+
+
+def get_admin(session, login):
+    """
+    Return the admin that has this login, create it if it does not exist.
+
+    Known admins are served from the admin cache as an AdminHandle without
+    querying the database. A freshly created admin is not cached until its
+    creation is committed (the request could still be rolled back), it will
+    be picked up by the next request.
+    """
+    cache = get_admin_cache()
+    admin_id = cache.get(login)
+    if admin_id is not None:
+        return AdminHandle(admin_id, login)
+
+    q = session.query(Utilisateur.id)
+    q = q.filter(Utilisateur.login == login)
+    admin_id = q.scalar()
+    if admin_id is None:
+        return Utilisateur.find_or_create(session, login)
+
+    cache.set(login, admin_id)
+    return AdminHandle(admin_id, login)
+
+
 def auth_simple_user(f):
     def wrapper(*args, user, token_info, **kwargs):
         if current_app.config["TESTING"] \
            or "adh6_user" in token_info["groups"]:
             s = db.get_db().get_session()
-            admin = Utilisateur.find_or_create(s, user)
+            admin = get_admin(s, user)
             return f(admin, *args, **kwargs)
         return NoContent, 401
     return wrapper
@@ -0,0 +1,94 @@
+"""
+Deletion of the devices of the members who left.
+
+A member has left when none of their memberships is running anymore and,
+either their departure date is past, or they had a membership. The devices
+of all of them are deleted with a DELETE statement per table, and their
+deletion recorded with a single INSERT, in one transaction. Run it from
+cron, --dry-run only tells what would be deleted:
+
+    python -m adh.cleanup [--dry-run] [--admin LOGIN] [--date YYYY-MM-DD]
+"""
+import argparse
+import datetime
+import logging
+import time
+from sqlalchemy import and_, exists, or_
+from sqlalchemy.orm import joinedload
+from adh.controller.device_utils import bulk_delete_devices
+from adh.model.database import Database, unit_of_work
+from adh.model.models import Adherent, Adhesion, Ordinateur, Portable, \
+        Utilisateur
+
+
+def departed(now):
+    """ Filter selecting the members who left at the time now """
+    running = exists().where(and_(Adhesion.adherent_id == Adherent.id,
+                                  Adhesion.fin >= now))
+    ended = exists().where(Adhesion.adherent_id == Adherent.id)
+    return and_(~running, or_(Adherent.date_de_depart < now.date(), ended))
+
+
+def departed_devices(s, now):
+    """ The devices (Ordinateur and Portable) of the members who left """
+    members = s.query(Adherent.id).filter(departed(now)).subquery()
+    devices = []
+    for cls in (Ordinateur, Portable):
+        q = s.query(cls).filter(cls.adherent_id.in_(members))
+        q = q.options(joinedload(cls.adherent))
+        devices += q.order_by(cls.id)
+    return devices
+
+
+def cleanup(s, admin, now, dry_run=False):
+    """
+    Delete the devices of the members who left at the time now (unless
+    dry_run). Returns (login, mac address) of the devices and the time
+    spent finding and deleting them, in seconds.
+    """
+    start = time.perf_counter()
+    devices = departed_devices(s, now)
+    found = time.perf_counter()
+    # Nothing can be read from the devices once deleted
+    listed = [(dev.adherent.login, dev.mac) for dev in devices]
+    if not dry_run:
+        with unit_of_work(s):
+            bulk_delete_devices(s, admin, devices)
+    return listed, found - start, time.perf_counter() - found
+
+
+def main(argv=None):
+    from CONFIGURATION import PROD_DATABASE
+
+    parser = argparse.ArgumentParser(
+        description="Delete the devices of the members who left")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only list the devices that would be deleted")
+    parser.add_argument("--admin", default="cleanup",
+                        help="login recorded as the author of the deletions")
+    parser.add_argument("--date", type=datetime.date.fromisoformat,
+                        help="delete as if it was that day (default today)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    Database.init_db(PROD_DATABASE)
+    s = Database.get_db().get_session()
+    now = datetime.datetime.now()
+    if args.date:
+        now = datetime.datetime.combine(args.date, datetime.time())
+
+    admin = Utilisateur.find_or_create(s, args.admin)
+    devices, find_time, delete_time = cleanup(s, admin, now, args.dry_run)
+    for login, mac in devices:
+        logging.info("%s %s of %s", "Would delete" if args.dry_run
+                     else "Deleted", mac, login)
+    members = set(login for login, _ in devices)
+    logging.info("%d devices of %d members found in %.0fms, deleted in "
+                 "%.0fms", len(devices), len(members),
+                 find_time * 1000, delete_time * 1000)
+    if args.dry_run:
+        s.rollback()
+
+
+if __name__ == "__main__":
+    main()
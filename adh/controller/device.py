@@ -1,112 +1,147 @@
 from connexion import NoContent
 from adh.exceptions import UserNotFound
-from adh.model.database import Database as db
-from adh.model import models
-from adh.model.models import Adherent
+from adh.model.database import Database as db, unit_of_work
+from adh.model.models import Adherent, Device
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import MultipleResultsFound
 from adh.exceptions import InvalidIPv4, InvalidIPv6, InvalidMac
-from adh.controller.device_utils import is_wired, is_wireless, \
+from adh.exceptions import InvalidCursor
+from adh.util.pagination import paginate, page_headers
+from adh.util.count import total_count
+from adh.util import export, mac_vendor
+from adh.controller.device_utils import find_devices, \
+        find_devices_by_mac, \
+        find_owners, \
+        fill_addresses, \
+        device_error, \
+        address_error, \
+        NO_ADDRESS, \
+        device_values, \
+        bulk_create_devices, \
+        bulk_update_devices, \
+        bulk_delete_devices, \
         delete_wireless_device, \
         delete_wired_device, \
         update_wireless_device, \
         update_wired_device, \
         create_wireless_device, \
         create_wired_device, \
-        get_all_devices, \
         dev_to_dict
 from adh.auth import auth_simple_user
+from adh import search
+
+MULTIPLE_DEVICES = 'Multiple records for that MAC address found in ' + \
+    'database. A MAC address should be unique. Fix your database.'
+
+# Columns of the CSV export
+DEVICE_FIELDS = ["mac", "connectionType", "ipAddress", "ipv6Address",
+                 "username"]
 
 
 @auth_simple_user
-def filterDevice(admin, limit=100, offset=0, username=None, terms=None):
+def filterDevice(admin, limit=100, offset=0, username=None, terms=None,
+                 cursor=None, totalCount="exact", vendor=False):
     """ [API] Filter the list of the devices according to some criterias """
     s = db.get_db().get_session()
 
     if limit < 0:
         return 'Limit must be a positive number', 400
 
-    # Return a subquery with all devices (wired & wireless)
-    # The fields, ip, ipv6, dns, etc, are set to None for wireless devices
+    # The devices table indexes all devices (wired & wireless)
+    # The fields ip and ipv6 are set to None for wireless devices
     # There is also a field "type" wich is wired and wireless
-    all_devices = get_all_devices(s)
-
-    # Query all devices and their owner's unsername
-    q = s.query(all_devices, Adherent.login.label("login"))
-    q = q.join(Adherent, Adherent.id == all_devices.columns.adherent_id)
+    q = s.query(
+        Device.mac, Device.ip, Device.ipv6, Device.type,
+        Adherent.login.label("login"),
+    )
+    q = q.join(Adherent, Adherent.id == Device.adherent_id)
 
     if username:
         q = q.filter(Adherent.login == username)
 
     if terms:
-        q = q.filter(
-            (all_devices.columns.mac.contains(terms)) |
-            (all_devices.columns.ip.contains(terms)) |
-            (all_devices.columns.ipv6.contains(terms)) |
-            (Adherent.login.contains(terms))
+        q = q.filter(search.matches(s, "device", terms))
+    filtered = username or terms
+    count = total_count(
+        q, totalCount, ("device", username, terms),
+        tables=None if filtered else [Device.__table__],
+    )
+    try:
+        r, next_cursor = paginate(
+            q, (Device.mac, Device.type),
+            lambda d: (d.mac, d.type),
+            limit, offset, cursor,
         )
-    count = q.count()
-    q = q.order_by(all_devices.columns.mac.asc())
-    q = q.offset(offset)
-    q = q.limit(limit)
-    r = q.all()
-    results = list(map(dev_to_dict, r))
-
-    headers = {
-        "X-Total-Count": count,
-        "access-control-expose-headers": "X-Total-Count"
-    }
+    except InvalidCursor:
+        return 'Invalid cursor', 400
+    vendors = mac_vendor.get_index(s) if vendor else None
+    results = [dev_to_dict(d, vendors) for d in r]
+
+    headers = page_headers(count, next_cursor)
     return results, 200, headers
 
 
+@auth_simple_user
+def exportDevices(admin, format="ndjson"):
+    """ [API] Stream every device (wired and wireless) """
+    s = db.get_db().get_session()
+    q = s.query(
+        Device.mac, Device.ip, Device.ipv6, Device.type,
+        Adherent.login.label("login"),
+    )
+    q = q.join(Adherent, Adherent.id == Device.adherent_id)
+    q = q.order_by(Device.id)
+    return export.stream(q, dev_to_dict, DEVICE_FIELDS, format, "devices")
+
+
 @auth_simple_user
 def putDevice(admin, macAddress, body):
     """ [API] Put (update or create) a new device in the database """
     s = db.get_db().get_session()
     try:
-        wired = is_wired(macAddress, s)
-        wireless = is_wireless(macAddress, s)
+        devices = find_devices(s, macAddress)
+        wired = devices.get("wired")
+        wireless = devices.get("wireless")
         wanted_type = body["connectionType"]
 
-        # TODO: Make proper IP assignement system
-        if wanted_type == "wired":
-            if 'ipAddress' not in body:
-                body['ipAddress'] = '192.168.0.1'
-            if 'ipv6Address' not in body:
-                body['ipv6Address'] = 'fe80::1'
-
-        if wired and wireless:
-            if wanted_type == "wired":
-                delete_wireless_device(admin, macAddress, s)
-                update_wired_device(admin, macAddress, body, s)
-            else:
-                delete_wired_device(admin, macAddress, s)
-                update_wireless_device(admin, macAddress, body, s)
-        elif wired:
-            if wanted_type == "wireless":
-                delete_wired_device(admin, macAddress, s)
-                create_wireless_device(admin, body, s)
-            else:
-                update_wired_device(admin, macAddress, body, s)
-        elif wireless:
-            if wanted_type == "wired":
-                delete_wireless_device(admin, macAddress, s)
-                create_wired_device(admin, body, s)
-            else:
-                update_wireless_device(admin, macAddress, body, s)
-        else:  # Create device
-            if body["mac"] != macAddress:
-                return 'The MAC address in the query ' + \
-                       'and in the body don\'t match', 400
+        if not wired and not wireless and body["mac"] != macAddress:
+            return 'The MAC address in the query ' + \
+                   'and in the body don\'t match', 400
 
-            if wanted_type == "wired":
+        fill_addresses(s, [(body, wired)],
+                       lambda username: Adherent.find(s, username))
+        if address_error(body) == NO_ADDRESS:
+            return NO_ADDRESS, 400
+
+        # A change of type deletes a device and creates another one, both
+        # (and their modifications) are committed together
+        with unit_of_work(s):
+            if wired and wireless:
+                if wanted_type == "wired":
+                    delete_wireless_device(admin, wireless, s)
+                    update_wired_device(admin, wired, body, s)
+                else:
+                    delete_wired_device(admin, wired, s)
+                    update_wireless_device(admin, wireless, body, s)
+            elif wired:
+                if wanted_type == "wireless":
+                    delete_wired_device(admin, wired, s)
+                    create_wireless_device(admin, body, s)
+                else:
+                    update_wired_device(admin, wired, body, s)
+            elif wireless:
+                if wanted_type == "wired":
+                    delete_wireless_device(admin, wireless, s)
+                    create_wired_device(admin, body, s)
+                else:
+                    update_wireless_device(admin, wireless, body, s)
+            elif wanted_type == "wired":  # Create device
                 create_wired_device(admin, body, s)
             else:
                 create_wireless_device(admin, body, s)
 
-            s.commit()
+        if not wired and not wireless:
             return NoContent, 201
-
-        s.commit()
         return NoContent, 204
 
     except UserNotFound:
@@ -121,25 +156,97 @@ def putDevice(admin, macAddress, body):
     except InvalidIPv4:
         return 'Invalid IPv4', 400
     except MultipleResultsFound:
-        return 'Multiple records for that MAC address found in database. ' + \
-               'A MAC address should be unique. Fix your database.', 500
+        return MULTIPLE_DEVICES, 500
+
+
+@auth_simple_user
+def putDevices(admin, body):
+    """ [API] Create or update many devices at once """
+    s = db.get_db().get_session()
+    try:
+        existing = find_devices_by_mac(s, [d["mac"] for d in body])
+    except MultipleResultsFound:
+        return MULTIPLE_DEVICES, 500
+    owners = find_owners(s, [d.get("username") for d in body])
+
+    checked = []
+    seen = set()
+    for d in body:
+        if d["mac"] in seen:
+            error = "Duplicate MAC address in the request"
+        else:
+            error = device_error(d, owners)
+        seen.add(d["mac"])
+        checked.append((d, error))
+    fill_addresses(s, [(d, existing.get(d["mac"], {}).get("wired"))
+                       for d, error in checked if error is None],
+                   owners.__getitem__)
+
+    # Like putDevice, a change of type deletes the device and creates one
+    deletions, updates, creations = [], [], []
+    result = []
+    for d, error in checked:
+        error = error or address_error(d)
+        if error:
+            result.append({"mac": d["mac"], "status": 400, "message": error})
+            continue
+
+        devices = existing.get(d["mac"], {})
+        wanted_type = d["connectionType"]
+        values = device_values(d, owners[d["username"]])
+        deletions += [dev for dev_type, dev in devices.items()
+                      if dev_type != wanted_type]
+        if wanted_type in devices:
+            updates.append((devices[wanted_type], values))
+        else:
+            creations.append((wanted_type, dict(values, mac=d["mac"])))
+        result.append({"mac": d["mac"], "status": 204 if devices else 201})
+
+    try:
+        with unit_of_work(s):
+            bulk_delete_devices(s, admin, deletions)
+            bulk_update_devices(s, admin, updates)
+            bulk_create_devices(s, admin, creations)
+    except IntegrityError:
+        return "Conflict with another change, retry", 409
+    return result, 200
+
+
+@auth_simple_user
+def deleteDevices(admin, body):
+    """ [API] Delete many devices at once """
+    s = db.get_db().get_session()
+    try:
+        existing = find_devices_by_mac(s, body)
+    except MultipleResultsFound:
+        return MULTIPLE_DEVICES, 500
+
+    devices = []
+    result = []
+    seen = set()
+    for mac in body:
+        if mac in seen:
+            continue
+        seen.add(mac)
+        # Both devices if the mac address is used by a wired and a wireless
+        devices += existing.get(mac, {}).values()
+        result.append({"mac": mac, "status": 204 if mac in existing else 404})
+
+    with unit_of_work(s):
+        bulk_delete_devices(s, admin, devices)
+    return result, 200
 
 
 @auth_simple_user
 def getDevice(admin, macAddress):
     """ [API] Return the device specified by the macAddress """
     s = db.get_db().get_session()
-    if is_wireless(macAddress, s):
-        q = s.query(models.Portable)
-        q = q.filter(models.Portable.mac == macAddress)
-        r = q.one()
-        return dict(r), 200
-
-    elif is_wired(macAddress, s):
-        q = s.query(models.Ordinateur)
-        q = q.filter(models.Ordinateur.mac == macAddress)
-        r = q.one()
-        return dict(r), 200
+    devices = find_devices(s, macAddress)
+    if "wireless" in devices:
+        return dict(devices["wireless"]), 200
+
+    elif "wired" in devices:
+        return dict(devices["wired"]), 200
 
     else:
         return NoContent, 404
@@ -149,12 +256,15 @@ def getDevice(admin, macAddress):
 def deleteDevice(admin, macAddress):
     """ [API] Delete the specified device from the database """
     s = db.get_db().get_session()
-    if is_wireless(macAddress, s):
-        delete_wireless_device(admin, macAddress, s)
+    devices = find_devices(s, macAddress)
+    if "wireless" in devices:
+        with unit_of_work(s):
+            delete_wireless_device(admin, devices["wireless"], s)
         return NoContent, 204
 
-    elif is_wired(macAddress, s):
-        delete_wired_device(admin, macAddress, s)
+    elif "wired" in devices:
+        with unit_of_work(s):
+            delete_wired_device(admin, devices["wired"], s)
         return NoContent, 204
 
     else:
@@ -1,22 +1,145 @@
-from adh.model.models import Adherent, Portable, Ordinateur, Modification
-from sqlalchemy.sql.expression import literal
-from sqlalchemy.types import String
-
-
-def is_wired(macAddress, s):
-    """ Return true if the mac address corresponds to a wired device """
-    queryWired = s.query(Ordinateur)
-    queryWired = queryWired.filter(Ordinateur.mac == macAddress)
-
-    return s.query(queryWired.exists()).scalar()
-
-
-def is_wireless(macAddress, s):
-    """ Return true if the mac address corresponds to a wireless device """
-    queryWireless = s.query(Portable)
-    queryWireless = queryWireless.filter(Portable.mac == macAddress)
+from adh import search
+from adh.util import checks, ip_allocator
+from adh.model.models import Adherent, Chambre, Portable, Ordinateur, \
+        Modification
+from adh.model.models import Device
+from sqlalchemy import String, bindparam, literal, select, union_all
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.exc import MultipleResultsFound
+
+# Model of each connectionType
+DEVICE_CLASSES = {"wired": Ordinateur, "wireless": Portable}
+
+# Field of the body -> (column of Ordinateur, network of the Vlan)
+ADDRESS_FIELDS = {
+    "ipAddress": ("ip", "adresses"),
+    "ipv6Address": ("ipv6", "adressesv6"),
+}
+NO_ADDRESS = 'No IP address available in the VLAN of the room of the user'
+
+
+def find_devices_by_mac(s, macs):
+    """
+    Return {mac: devices} for the mac addresses of macs that have a device,
+    devices being a dict {"wired": Ordinateur, "wireless": Portable} (a type
+    is missing if there is no such device). Everything, owners included, is
+    fetched in a single query. It reads ordinateurs and portables, not the
+    devices index: a device written by ADH5 must be found.
+    """
+    found = union_all(
+        select([literal("wired", type_=String).label("type"),
+                Ordinateur.id.label("id"), Ordinateur.mac.label("mac")])
+        .where(Ordinateur.mac.in_(macs)),
+        select([literal("wireless", type_=String).label("type"),
+                Portable.id.label("id"), Portable.mac.label("mac")])
+        .where(Portable.mac.in_(macs)),
+    ).alias("found")
+    q = s.query(found.c.mac, Ordinateur, Portable).select_from(found)
+    q = q.outerjoin(Ordinateur, (found.c.type == "wired") &
+                    (found.c.id == Ordinateur.id))
+    q = q.outerjoin(Portable, (found.c.type == "wireless") &
+                    (found.c.id == Portable.id))
+    q = q.options(
+        joinedload(Ordinateur.adherent),
+        joinedload(Portable.adherent),
+    )
 
-    return s.query(queryWireless.exists()).scalar()
+    by_mac = {}
+    for mac, *row in q:
+        for dev_type, dev in zip(("wired", "wireless"), row):
+            if dev is None:
+                continue
+            devices = by_mac.setdefault(mac, {})
+            if dev_type in devices:
+                raise MultipleResultsFound()
+            devices[dev_type] = dev
+    return by_mac
+
+
+def find_devices(s, macAddress):
+    """ Return the devices that have this mac address (see above) """
+    return find_devices_by_mac(s, [macAddress]).get(macAddress, {})
+
+
+def find_owners(s, usernames):
+    """ Return {login: Adherent} for the usernames that exist """
+    usernames = set(u for u in usernames if u)
+    if not usernames:
+        return {}
+    q = s.query(Adherent).filter(Adherent.login.in_(usernames))
+    # The VLAN is needed to give addresses to the wired devices
+    q = q.options(joinedload(Adherent.chambre).joinedload(Chambre.vlan))
+    return {a.login: a for a in q}
+
+
+def fill_addresses(s, devices, find_owner):
+    """
+    Give addresses to the wired devices that lack some, devices being a
+    list of (body, current wired device or None). A device keeps its
+    addresses, else new ones are allocated in the VLAN of the room of its
+    owner (find_owner(username), only called then). An address that can not
+    be allocated stays missing.
+    """
+    wanted = []
+    for body, dev in devices:
+        if body["connectionType"] != "wired":
+            continue
+        for field, (column, network) in ADDRESS_FIELDS.items():
+            if field in body:
+                continue
+            if dev is not None and getattr(dev, column):
+                body[field] = getattr(dev, column)
+                continue
+            room = find_owner(body["username"]).chambre
+            vlan = room and room.vlan
+            wanted.append((body, field, vlan and getattr(vlan, network)))
+
+    addresses = ip_allocator.allocate(s, [n for _, _, n in wanted])
+    for (body, field, _), address in zip(wanted, addresses):
+        if address is not None:
+            body[field] = address
+
+
+def device_error(body, owners):
+    """
+    Return why the device described by body can not be written (the message
+    putDevice would answer), None if it can. owners comes from find_owners.
+    """
+    if not checks.isMac(body["mac"]):
+        return "Invalid mac"
+    if body.get("username") not in owners:
+        return "User not found"
+    return None
+
+
+def address_error(body):
+    """ Same as device_error, for the addresses (once filled) """
+    if body["connectionType"] == "wired":
+        if not all(field in body for field in ADDRESS_FIELDS):
+            return NO_ADDRESS
+        if not checks.isIPv4(body["ipAddress"]):
+            return "Invalid IPv4"
+        if not checks.isIPv6(body["ipv6Address"]):
+            return "Invalid IPv6"
+    return None
+
+
+def device_values(body, owner):
+    """ Columns of the device described by body, but the mac address """
+    if body["connectionType"] == "wired":
+        return {
+            "adherent_id": owner.id,
+            "ip": body["ipAddress"],
+            "ipv6": body["ipv6Address"],
+        }
+    return {"adherent_id": owner.id}
+
+
+def _find_owner(s, dev, username):
+    """ Return the owner called username, without a query if it is dev's """
+    if dev.adherent is not None and dev.adherent.login == username:
+        return dev.adherent
+    return Adherent.find(s, username)
 
 
 def create_wireless_device(admin, body, s):
@@ -29,7 +152,7 @@ def create_wireless_device(admin, body, s):
     s.add(dev)
     s.flush()
 
-    Modification.add_and_commit(s, dev.adherent, dev.get_ruby_modif(), admin)
+    Modification.add(s, dev.adherent, dev.get_ruby_modif(), admin)
 
 
 def create_wired_device(admin, body, s):
@@ -44,83 +167,54 @@ def create_wired_device(admin, body, s):
     s.add(dev)
     s.flush()
 
-    Modification.add_and_commit(s, dev.adherent, dev.get_ruby_modif(), admin)
+    Modification.add(s, dev.adherent, dev.get_ruby_modif(), admin)
 
 
-def update_wireless_device(admin, macAddress, body, s):
+def update_wireless_device(admin, dev, body, s):
     """ Update a wireless device in the database """
-    q = s.query(Portable).filter(Portable.mac == macAddress)
-    dev = q.one()
+    owner = _find_owner(s, dev, body['username'])
 
     dev.start_modif_tracking()
     dev.mac = body['mac']
-    dev.adherent = Adherent.find(s, body['username'])
+    dev.adherent = owner
     s.flush()
 
-    Modification.add_and_commit(s, dev.adherent, dev.get_ruby_modif(), admin)
+    Modification.add(s, dev.adherent, dev.get_ruby_modif(), admin)
 
 
-def update_wired_device(admin, macAddress, body, s):
+def update_wired_device(admin, dev, body, s):
     """ Update a wired device in the database """
-    q = s.query(Ordinateur).filter(Ordinateur.mac == macAddress)
-    dev = q.one()
+    owner = _find_owner(s, dev, body['username'])
 
     dev.start_modif_tracking()
     dev.mac = body['mac']
     dev.ip = body['ipAddress']
     dev.ipv6 = body['ipv6Address']
-    dev.adherent = Adherent.find(s, body['username'])
+    dev.adherent = owner
     s.flush()
 
-    Modification.add_and_commit(s, dev.adherent, dev.get_ruby_modif(), admin)
+    Modification.add(s, dev.adherent, dev.get_ruby_modif(), admin)
 
 
-def delete_wired_device(admin, macAddress, s):
+def delete_wired_device(admin, dev, s):
     """ Delete a wired device from the databse """
-    q = s.query(Ordinateur).filter(Ordinateur.mac == macAddress)
-    dev = q.one()
-
     dev.start_modif_tracking()
     s.delete(dev)
     s.flush()
 
-    Modification.add_and_commit(s, dev.adherent, dev.get_ruby_modif(), admin)
+    Modification.add(s, dev.adherent, dev.get_ruby_modif(), admin)
 
 
-def delete_wireless_device(admin, macAddress, s):
+def delete_wireless_device(admin, dev, s):
     """ Delete a wireless device from the database """
-    q = s.query(Portable).filter(Portable.mac == macAddress)
-    dev = q.one()
-
     dev.start_modif_tracking()
     s.delete(dev)
     s.flush()
 
-    Modification.add_and_commit(s, dev.adherent, dev.get_ruby_modif(), admin)
+    Modification.add(s, dev.adherent, dev.get_ruby_modif(), admin)
 
 
-def get_all_devices(s):
-
-    q_wired = s.query(
-        Ordinateur.mac.label("mac"),
-        Ordinateur.ip.label("ip"),
-        Ordinateur.ipv6.label("ipv6"),
-        Ordinateur.adherent_id.label("adherent_id"),
-        literal("wired", type_=String).label("type"),
-    )
-
-    q_wireless = s.query(
-        Portable.mac.label("mac"),
-        literal(None, type_=String).label("ip"),
-        literal(None, type_=String).label("ipv6"),
-        Portable.adherent_id.label("adherent_id"),
-        literal("wireless", type_=String).label("type"),
-    )
-    q = q_wireless.union_all(q_wired)
-    return q.subquery()
-
-
-def _dev_to_gen(d):
+def _dev_to_gen(d, vendors):
     yield "mac", d.mac,
     yield "connectionType", d.type,
     if d.ip:
@@ -128,7 +222,124 @@ def _dev_to_gen(d):
     if d.ipv6:
         yield "ipv6Address", d.ipv6
     yield "username", d.login
-
-
-def dev_to_dict(d):
-    return dict(_dev_to_gen(d))
+    if vendors is not None:
+        vendor = vendors.lookup(d.mac)
+        if vendor:
+            yield "vendor", vendor
+
+
+def dev_to_dict(d, vendors=None):
+    """ vendors is a VendorIndex, to add the vendor of the device """
+    return dict(_dev_to_gen(d, vendors))
+
+
+def _index_values(dev_type, values):
+    """ Values of the devices index of a row of ordinateurs/portables """
+    return {
+        "type": dev_type,
+        "mac": values["mac"],
+        "ip": values.get("ip"),
+        "ipv6": values.get("ipv6"),
+        "adherent_id": values["adherent_id"],
+    }
+
+
+def bulk_delete_devices(s, admin, devices):
+    """
+    Delete devices (Ordinateur and Portable objects) with a DELETE statement
+    per table, and record their deletion. The statements bypass the mapper
+    events, the devices index is updated here.
+    """
+    actions = []
+    index = Device.__table__.c
+    for dev_type, cls in DEVICE_CLASSES.items():
+        ids = [dev.id for dev in devices if isinstance(dev, cls)]
+        if not ids:
+            continue
+        s.execute(cls.__table__.delete().where(cls.__table__.c.id.in_(ids)))
+        s.execute(Device.__table__.delete().where(
+            (index.type == dev_type) & index.device_id.in_(ids)
+        ))
+        search.bulk_written(s, cls)
+        if cls is Ordinateur:
+            ip_allocator.written(
+                s, [a for dev in devices if isinstance(dev, cls)
+                    for a in (dev.ip, dev.ipv6)], [])
+        for dev in devices:
+            if isinstance(dev, cls):
+                changes = {name: (value, None)
+                           for name, value in dev.column_values().items()}
+                actions.append((dev.adherent_id, cls.ruby_modif(changes)))
+    Modification.add_all(s, actions, admin)
+
+
+def bulk_update_devices(s, admin, updates):
+    """
+    Update devices with an executemany UPDATE per table, updates being a
+    list of (Ordinateur or Portable, {column: new value}). The devices index
+    is updated too, and the modifications recorded.
+    """
+    actions = []
+    index = Device.__table__
+    for dev_type, cls in DEVICE_CLASSES.items():
+        rows = [(dev, values) for dev, values in updates
+                if isinstance(dev, cls)]
+        if not rows:
+            continue
+        table = cls.__table__
+        s.execute(
+            table.update().where(table.c.id == bindparam("_id")),
+            [dict(values, _id=dev.id) for dev, values in rows],
+        )
+        s.execute(
+            index.update().where(
+                (index.c.type == dev_type) &
+                (index.c.device_id == bindparam("_id"))
+            ),
+            [dict(_index_values(dev_type, dict(dev.column_values(),
+                                               **values)), _id=dev.id)
+             for dev, values in rows],
+        )
+        search.bulk_written(s, cls)
+        if cls is Ordinateur:
+            ip_allocator.written(
+                s, [a for dev, _ in rows for a in (dev.ip, dev.ipv6)],
+                [values[c] for _, values in rows for c in ("ip", "ipv6")])
+        for dev, values in rows:
+            old = dev.column_values()
+            changes = {name: (old[name], value)
+                       for name, value in values.items()}
+            actions.append((values["adherent_id"], cls.ruby_modif(changes)))
+    Modification.add_all(s, actions, admin)
+
+
+def bulk_create_devices(s, admin, creations):
+    """
+    Insert devices with an executemany INSERT per table, creations being a
+    list of (connectionType, {column: value}). The devices index is filled
+    too, and the modifications recorded.
+    """
+    actions = []
+    for dev_type, cls in DEVICE_CLASSES.items():
+        rows = [values for t, values in creations if t == dev_type]
+        if not rows:
+            continue
+        table = cls.__table__
+        s.execute(table.insert(), rows)
+
+        # executemany does not return the ids, the mac addresses are unique
+        q = s.query(table.c.mac, table.c.id)
+        ids = dict(q.filter(table.c.mac.in_([v["mac"] for v in rows])))
+        s.execute(Device.__table__.insert(), [
+            dict(_index_values(dev_type, values), device_id=ids[values["mac"]])
+            for values in rows
+        ])
+        search.bulk_written(s, cls)
+        if cls is Ordinateur:
+            ip_allocator.written(
+                s, [], [values[c] for values in rows for c in ("ip", "ipv6")])
+        for values in rows:
+            changes = {name: (None, value) for name, value in values.items()}
+            changes["id"] = (None, ids[values["mac"]])
+            actions.append((values["adherent_id"], cls.ruby_modif(changes)))
+    Modification.add_all(s, actions, admin)
@@ -1,14 +1,23 @@
 from connexion import NoContent
 from adh.model.database import Database as db
-from sqlalchemy import or_
+from sqlalchemy.orm import joinedload
 from adh.exceptions import RoomNotFound, SwitchNotFound, PortNotFound
+from adh.exceptions import InvalidCursor
 from adh.model.models import Port, Chambre, Switch
 from adh.auth import auth_simple_user
+from adh import search
+from adh.util.pagination import paginate, page_headers
+from adh.util.count import total_count
+from adh.util import export
+
+# Columns of the CSV export
+PORT_FIELDS = ["id", "portNumber", "roomNumber", "switchID"]
 
 
 @auth_simple_user
 def filterPort(admin, limit=100, offset=0,
-               switchID=None, roomNumber=None, terms=None):
+               switchID=None, roomNumber=None, terms=None, cursor=None,
+               totalCount="exact"):
     """ [API] Filter the port list according to some criteria """
     if limit < 0:
         return 'Limit must be a positive number', 400
@@ -22,26 +31,39 @@ def filterPort(admin, limit=100, offset=0,
         q = q.join(Chambre)
         q = q.filter(Chambre.numero == roomNumber)
     if terms:
-        q = q.filter(or_(
-            Port.numero.contains(terms),
-            Port.oid.contains(terms),
-        ))
-
-    count = q.count()
-    q = q.order_by(Port.switch_id.asc(), Port.numero.asc())
-    q = q.offset(offset)
-    q = q.limit(limit)
-    result = q.all()
+        q = q.filter(search.matches(s, "port", terms))
+
+    filtered = switchID or roomNumber or terms
+    count = total_count(
+        q, totalCount, ("port", switchID, roomNumber, terms),
+        tables=None if filtered else [Port.__table__],
+    )
+    # dict(Port) needs the room
+    q = q.options(joinedload(Port.chambre))
+    try:
+        result, next_cursor = paginate(
+            q, (Port.switch_id, Port.numero, Port.id),
+            lambda p: (p.switch_id, p.numero, p.id),
+            limit, offset, cursor,
+        )
+    except InvalidCursor:
+        return 'Invalid cursor', 400
 
     result = map(dict, result)
     result = list(result)
-    headers = {
-        'access-control-expose-headers': 'X-Total-Count',
-        'X-Total-Count': str(count)
-    }
+    headers = page_headers(count, next_cursor)
     return result, 200, headers
 
 
+@auth_simple_user
+def exportPorts(admin, format="ndjson"):
+    """ [API] Stream every port """
+    s = db.get_db().get_session()
+    q = s.query(Port).options(joinedload(Port.chambre))
+    q = q.order_by(Port.id)
+    return export.stream(q, dict, PORT_FIELDS, format, "ports")
+
+
 @auth_simple_user
 def createPort(admin, switchID, body):
     """ [API] Create a port in the database """
@@ -1,9 +1,16 @@
 from connexion import NoContent
-from sqlalchemy import or_
-from adh.exceptions import RoomNotFound, VlanNotFound
+from adh.exceptions import RoomNotFound, VlanNotFound, InvalidCursor
 from adh.model.database import Database as db
+from sqlalchemy.orm import joinedload
 from adh.model.models import Chambre
 from adh.auth import auth_simple_user
+from adh import search
+from adh.util.pagination import paginate, page_headers
+from adh.util.count import total_count
+from adh.util import export
+
+# Columns of the CSV export
+ROOM_FIELDS = ["roomNumber", "description", "phone", "vlan"]
 
 
 def roomExists(session, roomNumber):
@@ -16,31 +23,42 @@ def roomExists(session, roomNumber):
 
 
 @auth_simple_user
-def filterRoom(admin, limit=100, offset=0, terms=None):
+def filterRoom(admin, limit=100, offset=0, terms=None, cursor=None,
+               totalCount="exact"):
     """ [API] Filter the list of the rooms """
     if limit < 0:
         return "Limit must be a positive integer", 400
     s = db.get_db().get_session()
     q = s.query(Chambre)
     if terms:
-        q = q.filter(or_(
-            Chambre.telephone.contains(terms),
-            Chambre.description.contains(terms),
-        ))
-    count = q.count()
-    q = q.order_by(Chambre.id.asc())
-    q = q.offset(offset)
-    q = q.limit(limit)
-    result = q.all()
+        q = q.filter(search.matches(s, "room", terms))
+    count = total_count(
+        q, totalCount, ("room", terms),
+        tables=None if terms else [Chambre.__table__],
+    )
+    # dict(Chambre) needs the vlan
+    q = q.options(joinedload(Chambre.vlan))
+    try:
+        result, next_cursor = paginate(
+            q, (Chambre.id,), lambda c: (c.id,), limit, offset, cursor,
+        )
+    except InvalidCursor:
+        return "Invalid cursor", 400
     result = map(dict, result)
     result = list(result)
-    headers = {
-        'access-control-expose-headers': 'X-Total-Count',
-        'X-Total-Count': str(count)
-    }
+    headers = page_headers(count, next_cursor)
     return result, 200, headers
 
 
+@auth_simple_user
+def exportRooms(admin, format="ndjson"):
+    """ [API] Stream every room """
+    s = db.get_db().get_session()
+    q = s.query(Chambre).options(joinedload(Chambre.vlan))
+    q = q.order_by(Chambre.id)
+    return export.stream(q, dict, ROOM_FIELDS, format, "rooms")
+
+
 @auth_simple_user
 def putRoom(admin, roomNumber, body):
     """ [API] Update/create a room in the database """
@@ -1,22 +1,123 @@
 from connexion import NoContent
+from sqlalchemy.orm import joinedload
 from adh.auth import auth_simple_user
+from adh.model.database import Database as db
+from adh.exceptions import SwitchNotFound
+from adh.model.models import Port, Switch
+from adh.snmp import SNMPError
+from adh.util import port_state
+
+# Values of ifAdminStatus
+ADMIN_UP = 1
+ADMIN_DOWN = 2
+
+NO_OID = "The port has no SNMP OID"
+
+
+def find_port(switchID, portID):
+    """ Return the port (and its switch), None if it is not on switchID """
+    s = db.get_db().get_session()
+    q = s.query(Port).options(joinedload(Port.switch))
+    q = q.filter(Port.id == portID)
+    q = q.filter(Port.switch_id == switchID)
+    return q.one_or_none()
 
 
 @auth_simple_user
-def getPortStatus(switchID, portID):
-    return 204, NoContent, True
+def getPortStatus(admin, switchID, portID):
+    """ [API] Tell if a port is enabled """
+    port = find_port(switchID, portID)
+    if port is None:
+        return NoContent, 404
+    try:
+        state = port_state.get_port_state(port)
+    except SNMPError:
+        return "The SNMP request to the switch failed", 503
+    if state.admin_status is None:
+        return "Port not found on the switch", 404
+    return state.admin_status == ADMIN_UP, 200
 
 
 @auth_simple_user
-def setPortStatus(switchID, portID, state):
-    return 200, NoContent
+def setPortStatus(admin, switchID, portID, state):
+    """ [API] Enable or shutdown a port """
+    port = find_port(switchID, portID)
+    if port is None:
+        return NoContent, 404
+    if port.oid is None:
+        return NO_OID, 400
+    value = ADMIN_UP if state else ADMIN_DOWN
+    try:
+        port_state.set_port_value(port, "admin_status", value)
+    except SNMPError:
+        return "The SNMP request to the switch failed", 503
+    return NoContent, 204
 
 
 @auth_simple_user
-def getPortVlan(switchID, portID):
-    return 200, NoContent, 42
+def getPortVlan(admin, switchID, portID):
+    """ [API] Get the VLAN assigned to a port """
+    port = find_port(switchID, portID)
+    if port is None:
+        return NoContent, 404
+    try:
+        state = port_state.get_port_state(port)
+    except SNMPError:
+        return "The SNMP request to the switch failed", 503
+    if state.vlan is None:
+        return "Port not found on the switch", 404
+    return state.vlan, 200
 
 
 @auth_simple_user
-def setPortVlan(switchID, portID, vlan):
-    return 204, NoContent
+def setPortVlan(admin, switchID, portID, vlan):
+    """ [API] Assign a VLAN to a port """
+    port = find_port(switchID, portID)
+    if port is None:
+        return NoContent, 404
+    if port.oid is None:
+        return NO_OID, 400
+    try:
+        port_state.set_port_value(port, "vlan", vlan)
+    except SNMPError:
+        return "The SNMP request to the switch failed", 503
+    return NoContent, 204
+
+
+@auth_simple_user
+def setPortsVlan(admin, switchID, body):
+    """ [API] Assign VLANs to many ports of a switch at once """
+    s = db.get_db().get_session()
+    try:
+        Switch.find(s, switchID)
+    except SwitchNotFound:
+        return NoContent, 404
+
+    # The last VLAN given for a port wins
+    vlans = {}
+    for change in body:
+        vlans.pop(change["portID"], None)
+        vlans[change["portID"]] = change["vlan"]
+
+    q = s.query(Port).options(joinedload(Port.switch))
+    q = q.filter(Port.id.in_(list(vlans)))
+    q = q.filter(Port.switch_id == switchID)
+    ports = {port.id: port for port in q}
+
+    changes = [(ports[i], vlan) for i, vlan in vlans.items()
+               if i in ports and ports[i].oid is not None]
+    errors = port_state.set_port_values(changes, "vlan")
+    errors = {port.id: e for (port, _), e in zip(changes, errors)}
+
+    result = []
+    for port_id, vlan in vlans.items():
+        item = {"portID": port_id, "vlan": vlan, "status": 204}
+        if port_id not in ports:
+            item.update(status=404, message="Port not found")
+        elif ports[port_id].oid is None:
+            item.update(status=400, message=NO_OID)
+        elif errors[port_id] is not None:
+            item.update(status=503,
+                        message="The SNMP request to the switch failed")
+        result.append(item)
+    return result, 200
@@ -1,9 +1,12 @@
 from connexion import NoContent
-from sqlalchemy import or_
+from sqlalchemy import func
 from adh.model.database import Database as db
 from adh.model.models import Switch
-from adh.exceptions import InvalidIPv4, SwitchNotFound
+from adh.exceptions import InvalidIPv4, SwitchNotFound, InvalidCursor
 from adh.auth import auth_simple_user
+from adh import search
+from adh.util.pagination import paginate, page_headers
+from adh.util.count import total_count
 
 
 def switchExists(session, switchID):
@@ -16,32 +19,36 @@ def switchExists(session, switchID):
 
 
 @auth_simple_user
-def filterSwitch(admin, limit=100, offset=0, terms=None):
+def filterSwitch(admin, limit=100, offset=0, terms=None, cursor=None,
+                 totalCount="exact"):
     """ [API] Filter the switch list """
     if limit < 0:
         return "Limit must be positive", 400
-    q = db.get_db().get_session().query(Switch)
+    s = db.get_db().get_session()
+    q = s.query(Switch)
     # Filter by terms
     if terms:
-        q = q.filter(or_(
-            Switch.description.contains(terms),
-            Switch.ip.contains(terms),
-            Switch.communaute.contains(terms),
-        ))
-    count = q.count()
-    q = q.order_by(Switch.description.asc())
-    q = q.offset(offset)
-    q = q.limit(limit)  # Limit the number of matches
-    q = q.all()
+        q = q.filter(search.matches(s, "switch", terms))
+    count = total_count(
+        q, totalCount, ("switch", terms),
+        tables=None if terms else [Switch.__table__],
+    )
+    # The description can be NULL, which cannot be compared in a cursor
+    description = func.coalesce(Switch.description, '')
+    try:
+        q, next_cursor = paginate(
+            q, (description, Switch.id),
+            lambda x: (x.description or '', x.id),
+            limit, offset, cursor,
+        )
+    except InvalidCursor:
+        return "Invalid cursor", 400
 
     # Convert the qs into data suited for the API
     q = map(lambda x: {'switchID': x.id, 'switch': dict(x)}, q)
     result = list(q)  # Cast generator as list
 
-    headers = {
-        'access-control-expose-headers': 'X-Total-Count',
-        'X-Total-Count': str(count)
-    }
+    headers = page_headers(count, next_cursor)
     return result, 200, headers
 
 
@@ -1,13 +1,23 @@
 from connexion import NoContent
-from adh.model.database import Database as db
+from adh.model.database import Database as db, unit_of_work
 from adh.model.models import Adherent, Chambre, Adhesion, Modification
 from adh.util.date import string_to_date
 from adh.exceptions import InvalidEmail, RoomNotFound, UserNotFound
+from adh.exceptions import InvalidCursor
+from adh.util.pagination import paginate, page_headers
+from adh.util.count import total_count
+from adh.util import export
 import datetime
 import sqlalchemy
+from sqlalchemy.orm import joinedload
 from adh.auth import auth_simple_user
+from adh import search
 import hashlib
 
+# Columns of the CSV export
+USER_FIELDS = ["username", "email", "firstName", "lastName", "roomNumber",
+               "comment", "departureDate", "associationMode"]
+
 
 def adherentExists(session, username):
     """ Returns true if the user exists """
@@ -19,7 +29,8 @@ def adherentExists(session, username):
 
 
 @auth_simple_user
-def filterUser(admin, limit=100, offset=0, terms=None, roomNumber=None):
+def filterUser(admin, limit=100, offset=0, terms=None, roomNumber=None,
+               cursor=None, totalCount="exact"):
     """ [API] Filter the list of users from the the database """
     if limit < 0:
         return "Limit must be positive", 400
@@ -37,25 +48,35 @@ def filterUser(admin, limit=100, offset=0, terms=None, roomNumber=None):
 
         q = q.filter(Adherent.chambre == result)
     if terms:
-        q = q.filter(
-            (Adherent.nom.contains(terms)) |
-            (Adherent.prenom.contains(terms)) |
-            (Adherent.mail.contains(terms)) |
-            (Adherent.login.contains(terms)) |
-            (Adherent.commentaires.contains(terms))
+        q = q.filter(search.matches(s, "user", terms))
+    filtered = terms or roomNumber
+    count = total_count(
+        q, totalCount, ("user", terms, roomNumber),
+        tables=None if filtered else [Adherent.__table__],
+    )
+    # dict(Adherent) needs the room
+    q = q.options(joinedload(Adherent.chambre))
+    try:
+        r, next_cursor = paginate(
+            q, (Adherent.login, Adherent.id), lambda a: (a.login, a.id),
+            limit, offset, cursor,
         )
-    count = q.count()
-    q = q.order_by(Adherent.login.asc())
-    q = q.offset(offset)
-    q = q.limit(limit)
-    r = q.all()
-    headers = {
-        "X-Total-Count": str(count),
-        'access-control-expose-headers': 'X-Total-Count'
-    }
+    except InvalidCursor:
+        return "Invalid cursor", 400
+
+    headers = page_headers(count, next_cursor)
     return list(map(dict, r)), 200, headers
 
 
+@auth_simple_user
+def exportUsers(admin, format="ndjson"):
+    """ [API] Stream every user """
+    s = db.get_db().get_session()
+    q = s.query(Adherent).options(joinedload(Adherent.chambre))
+    q = q.order_by(Adherent.id)
+    return export.stream(q, dict, USER_FIELDS, format, "users")
+
+
 @auth_simple_user
 def getUser(admin, username):
     """ [API] Get the specified user from the database """
@@ -77,7 +98,7 @@ def deleteUser(admin, username):
     except UserNotFound:
         return NoContent, 404
 
-    try:
+    with unit_of_work(s):
         # if so, start tracking for modifications
         a.start_modif_tracking()
 
@@ -86,10 +107,7 @@ def deleteUser(admin, username):
         s.flush()
 
         # Write it in the modification table
-        Modification.add_and_commit(s, a, a.get_ruby_modif(), admin)
-    except Exception:
-        s.rollback()
-        raise
+        Modification.add(s, a, a.get_ruby_modif(), admin)
     return NoContent, 204
 
 
@@ -108,7 +126,7 @@ def putUser(admin, username, body):
     except ValueError:
         return "String must not be empty", 400
 
-    try:
+    with unit_of_work(s):
         # Check if it already exists
         update = adherentExists(s, username)
 
@@ -122,11 +140,7 @@ def putUser(admin, username, body):
         s.flush()
 
         # Create the corresponding modification
-        Modification.add_and_commit(s, new_user,
-                                    new_user.get_ruby_modif(), admin)
-    except Exception:
-        s.rollback()
-        raise
+        Modification.add(s, new_user, new_user.get_ruby_modif(), admin)
 
     if update:
         return NoContent, 204
@@ -179,16 +193,12 @@ def updatePassword(admin, username, body):
     except UserNotFound:
         return NoContent, 404
 
-    try:
+    with unit_of_work(s):
         a.start_modif_tracking()
         a.password = ntlm_hash(password)
         s.flush()
 
         # Build the corresponding modification
-        Modification.add_and_commit(s, a, a.get_ruby_modif(), admin)
-
-    except Exception:
-        s.rollback()
-        raise
+        Modification.add(s, a, a.get_ruby_modif(), admin)
 
     return NoContent, 204
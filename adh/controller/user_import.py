@@ -0,0 +1,220 @@
+"""
+Bulk creation of users and of their membership, for the start of the year.
+
+Every row is checked first, the rooms and the logins already taken are then
+resolved with a query each. The users, their membership and the Modification
+rows are inserted with executemany, IMPORT_CHUNK_SIZE users per transaction.
+A chunk that conflicts with a user created in the meantime is inserted again
+one user at a time, to tell which row is the conflicting one.
+"""
+import csv
+import datetime
+import io
+import json
+from flask import current_app, request
+from sqlalchemy.exc import IntegrityError
+from adh import search
+from adh.auth import auth_simple_user
+from adh.model.database import Database as db, unit_of_work
+from adh.model.models import Adherent, Adhesion, Chambre, Modification
+from adh.util import checks
+from adh.util.date import string_to_date
+
+# Field of the import -> column of Adherent
+COLUMNS = {
+    "email": "mail",
+    "firstName": "prenom",
+    "lastName": "nom",
+    "username": "login",
+    "comment": "commentaires",
+    "departureDate": "date_de_depart",
+    "associationMode": "mode_association",
+}
+REQUIRED = ("email", "firstName", "lastName", "username")
+DATES = ("departureDate", "associationMode")
+
+
+def read_rows(data, mimetype):
+    """
+    Parse the body of the request, a JSON array of objects or a CSV file
+    whose header holds the field names. Raises ValueError if it is invalid.
+    """
+    if mimetype == "text/csv":
+        reader = csv.DictReader(io.StringIO(data.decode("utf-8-sig")))
+        # An empty cell is a missing value
+        return [{k: v for k, v in row.items() if k and v} for row in reader]
+
+    rows = json.loads(data.decode("utf-8"))
+    if not isinstance(rows, list) or \
+            not all(isinstance(row, dict) for row in rows):
+        raise ValueError("expected an array of users")
+    return rows
+
+
+def _date(row, field):
+    try:
+        return string_to_date(row.get(field))
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError("Invalid " + field)
+
+
+def _integer(row, field):
+    value = row.get(field)
+    if value is None:
+        return None
+    try:
+        return int(value)  # The cells of a CSV file are strings
+    except (TypeError, ValueError):
+        raise ValueError(field + " must be an integer")
+
+
+def parse_row(row):
+    """
+    Return (Adherent columns, room number, membership) from a row of the
+    import, the membership being None or (start, end). Raises ValueError if
+    the row is invalid.
+    """
+    for field in REQUIRED:
+        if not row.get(field):
+            raise ValueError(field + " is required")
+
+    user = {}
+    for field, column in COLUMNS.items():
+        if field in DATES:
+            user[column] = _date(row, field)
+        elif row.get(field) is None or isinstance(row[field], str):
+            user[column] = row.get(field)
+        else:
+            raise ValueError(field + " must be a string")
+    if not checks.isEmail(user["mail"]):
+        raise ValueError("Invalid email")
+
+    start = _date(row, "membershipStart")
+    duration = _integer(row, "membershipDuration")
+    membership = None
+    if duration is not None:
+        if duration < 0:
+            raise ValueError("membershipDuration must be positive")
+        start = start or datetime.datetime.now()
+        membership = (start, start + datetime.timedelta(days=duration))
+    elif start is not None:
+        raise ValueError("membershipDuration is required")
+
+    return user, _integer(row, "roomNumber"), membership
+
+
+def resolve_rows(s, rows, results):
+    """
+    Check the rows against the database, rows being a list of
+    (index, parsed row). Return the rows that can be inserted, with the id
+    of their room set, the errors of the others are put in results.
+    """
+    logins = [user["login"] for _, (user, _, _) in rows]
+    taken = set()
+    if logins:
+        q = s.query(Adherent.login).filter(Adherent.login.in_(logins))
+        taken = {login for login, in q}
+
+    numbers = {number for _, (_, number, _) in rows if number is not None}
+    rooms = {}
+    if numbers:
+        q = s.query(Chambre.numero, Chambre.id)
+        rooms = dict(q.filter(Chambre.numero.in_(numbers)))
+
+    valid = []
+    seen = set()
+    for i, (user, number, membership) in rows:
+        login = user["login"]
+        if login in taken:
+            results[i] = (409, "User already exists")
+        elif login in seen:
+            results[i] = (409, "Duplicate username in the import")
+        elif number is not None and number not in rooms:
+            results[i] = (400, "No room found")
+        else:
+            user["chambre_id"] = rooms.get(number)
+            valid.append((i, user, membership))
+        seen.add(login)
+    return valid
+
+
+def insert_users(s, admin, users):
+    """
+    Insert users, a list of (Adherent columns, membership), and a
+    Modification for each of them. The number of statements does not depend
+    on the number of users.
+    """
+    s.execute(Adherent.__table__.insert(), [user for user, _ in users])
+    search.bulk_written(s, Adherent)
+
+    # executemany does not return the ids, the logins are unique
+    q = s.query(Adherent.login, Adherent.id)
+    ids = dict(q.filter(Adherent.login.in_([u["login"] for u, _ in users])))
+
+    adhesions = [
+        {"adherent_id": ids[user["login"]], "depart": m[0], "fin": m[1]}
+        for user, m in users if m is not None
+    ]
+    if adhesions:
+        s.execute(Adhesion.__table__.insert(), adhesions)
+
+    actions = []
+    for user, _ in users:
+        changes = {column: (None, value) for column, value in user.items()}
+        changes["id"] = (None, ids[user["login"]])
+        actions.append((ids[user["login"]], Adherent.ruby_modif(changes)))
+    Modification.add_all(s, actions, admin)
+
+
+def insert_one_by_one(s, admin, rows, results):
+    """
+    Insert rows, a list of (index, Adherent columns, membership), in a
+    transaction each, so that a conflict is only reported for its own row
+    """
+    for i, user, membership in rows:
+        try:
+            with unit_of_work(s):
+                insert_users(s, admin, [(user, membership)])
+        except IntegrityError:
+            results[i] = (409, "User already exists")
+
+
+@auth_simple_user
+def importUsers(admin, body=None):
+    """ [API] Create many users (and their membership) at once """
+    try:
+        rows = read_rows(body or b"", request.mimetype)
+    except ValueError as e:
+        return "Invalid body: {}".format(e), 400
+
+    results = [(201, None)] * len(rows)
+    parsed = []
+    for i, row in enumerate(rows):
+        try:
+            parsed.append((i, parse_row(row)))
+        except ValueError as e:
+            results[i] = (400, str(e))
+
+    s = db.get_db().get_session()
+    valid = resolve_rows(s, parsed, results)
+
+    size = current_app.config.get("IMPORT_CHUNK_SIZE", 500)
+    for start in range(0, len(valid), size):
+        chunk = valid[start:start + size]
+        try:
+            with unit_of_work(s):
+                insert_users(s, admin, [(u, m) for _, u, m in chunk])
+        except IntegrityError:
+            # Most likely a user created at the same time, nothing of this
+            # chunk was written: find which row it is
+            insert_one_by_one(s, admin, chunk, results)
+
+    report = []
+    for row, (status, message) in zip(rows, results):
+        item = {"status": status}
+        if isinstance(row.get("username"), str):
+            item["username"] = row["username"]
+        if message:
+            item["message"] = message
+        report.append(item)
+    return report, 200
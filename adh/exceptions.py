@@ -32,3 +32,7 @@ class VlanNotFound(ValueError):
 
 class RoomNotFound(ValueError):
     pass
+
+
+class InvalidCursor(ValueError):
+    pass
@@ -1,33 +1,169 @@
+import logging
+import threading
+from contextlib import contextmanager
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import scoped_session
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.engine.url import URL
 from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
 
 
 Base = declarative_base()
 
+DEFAULT_POOL = {
+    "pool_recycle": 3600,
+}
+
+# create_engine() options that are only accepted by a QueuePool (SQLite uses
+# another kind of pool)
+QUEUE_POOL_OPTIONS = ("pool_size", "max_overflow", "pool_timeout",
+                      "pool_use_lifo")
+
+
+def engine_options(db_settings, pool=None):
+    """ Return the create_engine() options of the pool settings """
+    options = dict(DEFAULT_POOL)
+    options.update(pool or {})
+    if db_settings["drivername"].startswith("sqlite"):
+        for name in QUEUE_POOL_OPTIONS:
+            options.pop(name, None)
+    return options
+
+
+class PoolMetrics():
+    """ Checkout counters of the connection pool of an engine """
+
+    def __init__(self, engine):
+        self.pool = engine.pool
+        self.connects = 0
+        self.checkouts = 0
+        self.invalidations = 0
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.peak_overflow = 0
+        self.exhausted = 0
+        self._lock = threading.Lock()
+        event.listen(engine, "connect", self.on_connect)
+        event.listen(engine, "checkout", self.on_checkout)
+        event.listen(engine, "checkin", self.on_checkin)
+        event.listen(engine, "invalidate", self.on_invalidate)
+
+    def capacity(self):
+        """ Maximum number of connections, None if the pool is unbounded """
+        if not isinstance(self.pool, QueuePool):
+            return None
+        return self.pool.size() + self.pool._max_overflow
+
+    def overflow(self):
+        if not isinstance(self.pool, QueuePool):
+            return 0
+        return max(0, self.pool.overflow())
+
+    def on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def on_checkout(self, dbapi_connection, connection_record,
+                    connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak_checked_out = max(self.peak_checked_out,
+                                        self.checked_out)
+            self.peak_overflow = max(self.peak_overflow, self.overflow())
+            exhausted = self.checked_out == self.capacity()
+            if exhausted:
+                self.exhausted += 1
+        if exhausted:
+            logging.warning("All the %d connections of the pool are in use",
+                            self.checked_out)
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.checked_out = max(0, self.checked_out - 1)
+
+    def on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations += 1
+
+    def stats(self):
+        """ Return the counters and the current state of the pool """
+        with self._lock:
+            return {
+                "capacity": self.capacity(),
+                "checked_out": self.checked_out,
+                "overflow": self.overflow(),
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "invalidations": self.invalidations,
+                "peak_checked_out": self.peak_checked_out,
+                "peak_overflow": self.peak_overflow,
+                "exhausted": self.exhausted,
+            }
+
+
+# How the transactions are managed:
+# - native: the transactions of the DB-API driver, nothing more
+# - savepoint: the session starts in a SAVEPOINT, so that the tests can roll
+#   back everything. pysqlite does not support SAVEPOINT, unless the BEGIN
+#   statements are emitted by hand (one more statement per transaction).
+TRANSACTION_MODES = ("native", "savepoint")
+
+
+def emit_begin(engine):
+    """ Let SQLAlchemy, not pysqlite, begin the transactions """
+    @event.listens_for(engine, "connect")
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def do_begin(conn):
+        # emit our own BEGIN
+        conn.execute("BEGIN")
+
+
+@contextmanager
+def unit_of_work(session):
+    """
+    Commit everything done in the block (the changes and the Modification
+    rows that describe them) at once, or roll all of it back on error
+    """
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
 
 class Database():
 
-    def __init__(self, db_settings, testing=False):
-        self.engine = create_engine(URL(**db_settings), pool_recycle=3600)
-        @event.listens_for(self.engine, "connect")
-        def do_connect(dbapi_connection, connection_record):
-            dbapi_connection.isolation_level = None
+    def __init__(self, db_settings, testing=False, pool=None,
+                 transactions=None):
+        if transactions is None:
+            transactions = "savepoint" if testing else "native"
+        if transactions not in TRANSACTION_MODES:
+            raise ValueError("Unknown transaction mode: " + transactions)
 
-        @event.listens_for(self.engine, "begin")
-        def do_begin(conn):
-            # emit our own BEGIN
-            conn.execute("BEGIN")
+        self.engine = create_engine(URL(**db_settings),
+                                    **engine_options(db_settings, pool))
+        self.pool_metrics = PoolMetrics(self.engine)
+        if transactions == "savepoint" \
+                and self.engine.dialect.name == "sqlite":
+            emit_begin(self.engine)
         self.db_session = scoped_session(sessionmaker(bind=self.engine))
+        self.caches = {}
+        self._caches_lock = threading.Lock()
         if testing:
             Base.metadata.drop_all(self.engine)
         Base.metadata.create_all(self.engine)
         self.testing = testing
+        self.transactions = transactions
 
-        self.db_session().begin_nested()
+        if transactions == "savepoint":
+            self.db_session().begin_nested()
 
     def get_session(self):
         return self.db_session()
@@ -35,10 +171,22 @@ class Database():
     def remove_session(self):
         return self.db_session.remove()
 
+    def get_cache(self, name, factory):
+        """
+        Return the process-local cache called name, create it with factory()
+        if needed. The caches are bound to this database, so they are dropped
+        with it when init_db is called again.
+        """
+        with self._caches_lock:
+            if name not in self.caches:
+                self.caches[name] = factory()
+            return self.caches[name]
+
     db = None
 
-    def init_db(settings, testing=False):
-        Database.db = Database(settings, testing=testing)
+    def init_db(settings, testing=False, pool=None, transactions=None):
+        Database.db = Database(settings, testing=testing, pool=pool,
+                               transactions=transactions)
 
     def get_db():
         return Database.db
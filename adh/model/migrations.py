@@ -0,0 +1,95 @@
+"""
+Bring an existing database (for instance the one inherited from ADH5) up to
+date with the indexes declared in adh.model.models.
+
+create_all() only creates the missing tables, it never adds an index to a
+table that already exists. Run this module once after each deployment that
+adds an index:
+
+    python -m adh.model.migrations
+"""
+import logging
+from sqlalchemy import and_, func, inspect, select
+from adh.model.database import Base
+from adh.model.models import FULLTEXT_INDEXES, fulltext_index_ddl
+
+
+def _has_index(existing, index):
+    """ True if an index on the same columns (unique if needed) exists """
+    columns = [c.name for c in index.columns]
+    for other in existing:
+        if other["column_names"] != columns:
+            continue
+        if other.get("unique") or not index.unique:
+            return True
+    return False
+
+
+def find_duplicates(conn, index):
+    """ Return the values that prevent index from being unique """
+    columns = list(index.columns)
+    # Several NULLs do not break a unique index (MySQL, SQLite)
+    q = select(columns).where(and_(*(c.isnot(None) for c in columns)))
+    q = q.group_by(*columns).having(func.count() > 1)
+    return [tuple(row) for row in conn.execute(q)]
+
+
+def upgrade_indexes(engine):
+    """
+    Create the indexes that are declared in the models but missing from the
+    database (the FULLTEXT ones too, on MySQL). A unique index is skipped if
+    the table contains duplicates (they have to be fixed by hand first).
+
+    Returns (created, skipped) where skipped maps the name of the index to
+    the duplicated values.
+    """
+    created, skipped = [], {}
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = inspector.get_indexes(table.name)
+        existing += [
+            {"column_names": u["column_names"], "unique": True}
+            for u in inspector.get_unique_constraints(table.name)
+        ]
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            if _has_index(existing, index):
+                continue
+            with engine.begin() as conn:
+                if index.unique:
+                    duplicates = find_duplicates(conn, index)
+                    if duplicates:
+                        skipped[index.name] = duplicates
+                        continue
+                index.create(bind=conn)
+            created.append(index.name)
+
+    if engine.dialect.name == "mysql":
+        for table, name, columns in FULLTEXT_INDEXES:
+            if table not in tables:
+                continue
+            existing = inspector.get_indexes(table)
+            if name in [i["name"] for i in existing]:
+                continue
+            with engine.begin() as conn:
+                conn.execute(fulltext_index_ddl(table, name, columns))
+            created.append(name)
+
+    return created, skipped
+
+
+if __name__ == "__main__":
+    from adh.model.database import Database
+    from CONFIGURATION import PROD_DATABASE
+
+    logging.basicConfig(level=logging.INFO)
+    Database.init_db(PROD_DATABASE)
+    created, skipped = upgrade_indexes(Database.get_db().engine)
+    for name in created:
+        logging.info("Created index %s", name)
+    for name, duplicates in skipped.items():
+        logging.warning("Skipped unique index %s, duplicated values: %s",
+                        name, duplicates)
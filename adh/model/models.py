@@ -1,7 +1,10 @@
 # coding: utf-8
 from sqlalchemy import Column, Date, DateTime, Integer, \
-        Numeric, String, Text, text, ForeignKey
-from sqlalchemy.orm import relationship, validates
+        Numeric, String, Text, text, ForeignKey, UniqueConstraint
+from sqlalchemy import event, DDL
+from sqlalchemy.dialects import mysql
+from sqlalchemy.orm import relationship, validates, Session
+from sqlalchemy.orm.attributes import NO_VALUE, NEVER_SET
 from sqlalchemy.orm.exc import NoResultFound
 from adh.util import checks
 from adh.model.database import Base
@@ -10,15 +13,63 @@ from adh.exceptions import UserNotFound, RoomNotFound, SwitchNotFound
 from adh.exceptions import VlanNotFound, PortNotFound
 from adh.util.date import string_to_date
 import datetime
+from collections import OrderedDict
 from sqlalchemy import inspect
+from sqlalchemy.sql.expression import literal, null, select
+
+
+_columns_by_class = {}
+
+
+def _tracked_columns(cls):
+    """
+    {attribute: column name} of the columns of cls, sorted by column name.
+    Computed once per class.
+    """
+    columns = _columns_by_class.get(cls)
+    if columns is None:
+        columns = OrderedDict(sorted(
+            ((prop.key, prop.columns[0].name)
+             for prop in inspect(cls).column_attrs),
+            key=lambda c: c[1],
+        ))
+        _columns_by_class[cls] = columns
+    return columns
 
 
 def _get_model_dict(model):
     """
     Converts a SQLAlchemy row to a dictionnary of Column:Value
     """
-    return dict((column.name, getattr(model, column.name))
-                for column in model.__table__.columns)
+    return dict((name, getattr(model, key))
+                for key, name in _tracked_columns(type(model)).items())
+
+
+def _history_changes(model):
+    """
+    Return {column: (old, new)} for the attributes of model modified since
+    it was loaded or flushed. Only the modified attributes are read: they are
+    the ones of which SQLAlchemy keeps the committed value.
+    """
+    state = inspect(model)
+    columns = _tracked_columns(type(model))
+    changes = {}
+    for key, old in state.committed_state.items():
+        name = columns.get(key)
+        if name is None:  # A relationship
+            continue
+        if old is NO_VALUE or old is NEVER_SET:
+            old = None
+        changes[name] = (old, state.dict.get(key))
+    return changes
+
+
+def _merge_changes(changes, more):
+    """ Add more recent changes to changes, keeping the first old value """
+    for name, (old, new) in more.items():
+        if name in changes:
+            old = changes[name][0]
+        changes[name] = (old, new)
 
 
 class ModificationTracker():
@@ -34,18 +85,51 @@ class ModificationTracker():
 
         If start_modif was not called before, it will consider that the object
         was created from scratch.
+
+        Returns {column: (old, new)}.
         """
-        self._old_data = getattr(self, "_old_data", {})
-        self._new_data = _get_model_dict(self)
-        if inspect(self).deleted:
-            self._new_data = {}
+        changes = getattr(self, "_modif_changes", None)
+        state = inspect(self)
+        if state.deleted or state.was_deleted:
+            if changes is None:
+                return {}
+            return {name: (value, None)
+                    for name, value in _get_model_dict(self).items()}
+        if changes is None:
+            return {name: (None, value)
+                    for name, value in _get_model_dict(self).items()}
+
+        changes = dict(changes)
+        _merge_changes(changes, _history_changes(self))
+        return changes
+
+    def column_values(self):
+        """ Return {column: value} for every column of this row """
+        return _get_model_dict(self)
 
     def start_modif_tracking(self):
         """
         Call this function when you want to start recording modifications
         """
-        self._old_data = _get_model_dict(self)
-        self._new_data = None
+        state = inspect(self)
+        if state.expired_attributes:
+            # Load the values before the changes (in a single query), the
+            # history of an unloaded attribute has no old value
+            getattr(self, next(iter(state.expired_attributes)))
+        # What was modified before is not part of this modification
+        self._modif_changes = {
+            name: (new, new)
+            for name, (_, new) in _history_changes(self).items()
+        }
+
+
+@event.listens_for(Session, "after_flush")
+def _record_flushed_changes(session, flush_context):
+    """ The history of the attributes is lost after the flush, save it """
+    for obj in session.dirty:
+        changes = getattr(obj, "_modif_changes", None)
+        if changes is not None:
+            _merge_changes(changes, _history_changes(obj))
 
 
 class RubyHashModificationTracker(ModificationTracker):
@@ -55,22 +139,19 @@ class RubyHashModificationTracker(ModificationTracker):
     """
 
     def get_ruby_modif(self):
-        self._end_modif_tracking()
+        return self.ruby_modif(self._end_modif_tracking())
 
+    @classmethod
+    def ruby_modif(cls, changes):
+        """ Format {column: (old, new)} like get_ruby_modif """
         base_str = '{} !ruby/hash:ActiveSupport::HashWithIndifferentAccess\n'
-        txt = [base_str.format(self._ruby_hash_prefix)]
-        for key in sorted(set().union(
-            self._new_data.keys(),
-            self._old_data.keys()
-        )):
-            old = self._old_data.get(key)
-            new = self._new_data.get(key)
-
+        txt = [base_str.format(cls._ruby_hash_prefix)]
+        for key, (old, new) in sorted(changes.items()):
             old = old if old is not None else ""
             new = new if new is not None else ""
 
             if old != new:
-                txt += ["{}:\n- {}\n- {}\n".format(key, old, new)]
+                txt.append("{}:\n- {}\n- {}\n".format(key, old, new))
 
         return "".join(txt)
 
@@ -79,7 +160,7 @@ class Vlan(Base):
     __tablename__ = 'vlans'
 
     id = Column(Integer, primary_key=True)
-    numero = Column(Integer)
+    numero = Column(Integer, unique=True, index=True)
     adresses = Column(String(255))
     adressesv6 = Column(String(255))
     created_at = Column(DateTime)
@@ -112,7 +193,7 @@ class Chambre(Base):
     __tablename__ = 'chambres'
 
     id = Column(Integer, primary_key=True)
-    numero = Column(Integer)
+    numero = Column(Integer, unique=True, index=True)
     description = Column(String(255))
     telephone = Column(String(255))
     vlan_old = Column(Integer)
@@ -166,7 +247,7 @@ class Adherent(Base, RubyHashModificationTracker):
     nom = Column(String(255))
     prenom = Column(String(255))
     mail = Column(String(255))
-    login = Column(String(255))
+    login = Column(String(255), unique=True, index=True)
     password = Column(String(255))
     chambre_id = Column(Integer, ForeignKey(Chambre.id))
     chambre = relationship(Chambre)
@@ -306,7 +387,11 @@ class Modification(Base):
     utilisateur_id = Column(Integer, index=True)
 
     @staticmethod
-    def add_and_commit(session, adherent, action, admin):
+    def add(session, adherent, action, admin):
+        """
+        Record a modification, it is committed with the change it describes
+        (see unit_of_work)
+        """
         now = datetime.datetime.now()
         m = Modification(
                 adherent_id=adherent.id,
@@ -316,7 +401,27 @@ class Modification(Base):
                 utilisateur_id=admin.id
                 )
         session.add(m)
-        session.commit()
+        return m
+
+    @staticmethod
+    def add_all(session, actions, admin):
+        """
+        Record many modifications with a single INSERT, actions being a list
+        of (adherent id, action)
+        """
+        if not actions:
+            return
+        now = datetime.datetime.now()
+        session.execute(Modification.__table__.insert(), [
+            {
+                "adherent_id": adherent_id,
+                "action": action,
+                "created_at": now,
+                "updated_at": now,
+                "utilisateur_id": admin.id,
+            }
+            for adherent_id, action in actions
+        ])
 
 
 class Ordinateur(Base, RubyHashModificationTracker):
@@ -324,15 +429,16 @@ class Ordinateur(Base, RubyHashModificationTracker):
     _ruby_hash_prefix = 'ordinateurs:'
 
     id = Column(Integer, primary_key=True)
-    mac = Column(String(255))
-    ip = Column(String(255))
+    mac = Column(String(255), unique=True, index=True)
+    # Searched by the address allocator (adh.util.ip_allocator)
+    ip = Column(String(255), index=True)
     dns = Column(String(255))
     adherent_id = Column(Integer, ForeignKey(Adherent.id), nullable=False)
     adherent = relationship(Adherent)
     created_at = Column(DateTime)
     updated_at = Column(DateTime)
     last_seen = Column(DateTime)
-    ipv6 = Column(String(255))
+    ipv6 = Column(String(255), index=True)
 
     @validates('mac')
     def mac_valid(self, key, mac):
@@ -368,7 +474,7 @@ class Portable(Base, RubyHashModificationTracker):
     _ruby_hash_prefix = 'portables:'
 
     id = Column(Integer, primary_key=True)
-    mac = Column(String(255))
+    mac = Column(String(255), unique=True, index=True)
     adherent_id = Column(Integer, ForeignKey(Adherent.id), nullable=False)
     adherent = relationship(Adherent)
     last_seen = Column(DateTime)
@@ -388,12 +494,123 @@ class Portable(Base, RubyHashModificationTracker):
             yield "username", self.adherent.login
 
 
+class Device(Base):
+    """
+    Index of all the devices (wired and wireless) in a single table, so that
+    the device list can be filtered and sorted using indexes instead of going
+    through a UNION of ordinateurs and portables.
+
+    It is kept in sync with ordinateurs/portables by mapper events (see
+    below), rebuild() (python -m adh.model.reindex) must be run after these
+    tables were modified by something else (ADH5 for instance).
+    """
+    __tablename__ = 'devices'
+    __table_args__ = (UniqueConstraint('type', 'device_id'),)
+
+    id = Column(Integer, primary_key=True)
+    type = Column(String(16), nullable=False)
+    device_id = Column(Integer, nullable=False)
+    mac = Column(String(255), index=True)
+    ip = Column(String(255), index=True)
+    ipv6 = Column(String(255), index=True)
+    adherent_id = Column(Integer, ForeignKey(Adherent.id), index=True)
+
+    @staticmethod
+    def rebuild(conn):
+        """
+        Fill the index again from the ordinateurs and portables tables
+        (conn can be a session or a connection)
+        """
+        table = Device.__table__
+        wired = Ordinateur.__table__.c
+        wireless = Portable.__table__.c
+        cols = ['type', 'device_id', 'mac', 'ip', 'ipv6', 'adherent_id']
+        conn.execute(table.delete())
+        conn.execute(table.insert().from_select(cols, select([
+            literal("wired", type_=String),
+            wired.id, wired.mac, wired.ip, wired.ipv6, wired.adherent_id,
+        ])))
+        conn.execute(table.insert().from_select(cols, select([
+            literal("wireless", type_=String),
+            wireless.id, wireless.mac, null(), null(), wireless.adherent_id,
+        ])))
+
+
+class IPReservation(Base):
+    """
+    Address handed out by the allocator (see adh.util.ip_allocator) to a
+    device that may not be committed yet. The primary key prevents two
+    workers from handing out the same address at the same time.
+    """
+    __tablename__ = 'ip_reservations'
+
+    address = Column(String(255), primary_key=True)
+    # To the microsecond: the allocator finds its own rows by this value
+    created_at = Column(
+        DateTime().with_variant(mysql.DATETIME(fsp=6), "mysql"),
+        nullable=False, index=True,
+    )
+
+
+def _device_index_values(target):
+    if isinstance(target, Ordinateur):
+        return {
+            "type": "wired",
+            "mac": target.mac,
+            "ip": target.ip,
+            "ipv6": target.ipv6,
+            "adherent_id": target.adherent_id,
+        }
+    return {
+        "type": "wireless",
+        "mac": target.mac,
+        "ip": None,
+        "ipv6": None,
+        "adherent_id": target.adherent_id,
+    }
+
+
+def _device_index_where(values, target):
+    table = Device.__table__
+    return (table.c.type == values["type"]) & \
+        (table.c.device_id == target.id)
+
+
+@event.listens_for(Ordinateur, "after_insert")
+@event.listens_for(Portable, "after_insert")
+def _device_index_insert(mapper, connection, target):
+    values = _device_index_values(target)
+    connection.execute(
+        Device.__table__.insert().values(device_id=target.id, **values)
+    )
+
+
+@event.listens_for(Ordinateur, "after_update")
+@event.listens_for(Portable, "after_update")
+def _device_index_update(mapper, connection, target):
+    values = _device_index_values(target)
+    connection.execute(
+        Device.__table__.update()
+        .where(_device_index_where(values, target))
+        .values(**values)
+    )
+
+
+@event.listens_for(Ordinateur, "after_delete")
+@event.listens_for(Portable, "after_delete")
+def _device_index_delete(mapper, connection, target):
+    values = _device_index_values(target)
+    connection.execute(
+        Device.__table__.delete().where(_device_index_where(values, target))
+    )
+
+
 class Switch(Base):
     __tablename__ = 'switches'
 
     id = Column(Integer, primary_key=True)
     description = Column(String(255))
-    ip = Column(String(255))
+    ip = Column(String(255), index=True)
     communaute = Column(String(255))
     created_at = Column(DateTime)
     updated_at = Column(DateTime)
@@ -486,7 +703,7 @@ class Utilisateur(Base):
     nom = Column(String(255))
     access = Column(Integer)
     email = Column(String(255))
-    login = Column(String(255))
+    login = Column(String(255), unique=True, index=True)
     password_hash = Column(String(255))
     created_at = Column(DateTime)
     updated_at = Column(DateTime)
@@ -524,3 +741,30 @@ class Adhesion(Base):
     adherent = relationship(Adherent)
     depart = Column(DateTime, nullable=False)
     fin = Column(DateTime, nullable=False)
+
+
+# FULLTEXT indexes used by adh.search on MySQL. The ngram parser makes
+# MATCH ... AGAINST behave like a substring search (what LIKE '%x%' did).
+FULLTEXT_INDEXES = [
+    ("adherents", "ft_adherents",
+     ("nom", "prenom", "mail", "login", "commentaires")),
+    ("adherents", "ft_adherents_login", ("login",)),
+    ("chambres", "ft_chambres", ("telephone", "description")),
+    ("switches", "ft_switches", ("description", "ip", "communaute")),
+    ("ports", "ft_ports", ("numero", "oid")),
+    ("devices", "ft_devices", ("mac", "ip", "ipv6")),
+]
+
+
+def fulltext_index_ddl(table, name, columns):
+    return DDL("CREATE FULLTEXT INDEX {} ON {} ({}) WITH PARSER ngram".format(
+        name, table, ", ".join(columns)
+    ))
+
+
+for _table, _name, _columns in FULLTEXT_INDEXES:
+    event.listen(
+        Base.metadata.tables[_table], "after_create",
+        fulltext_index_ddl(_table, _name, _columns).execute_if(
+            dialect="mysql"),
+    )
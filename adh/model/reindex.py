@@ -0,0 +1,33 @@
+"""
+Fill the devices index (see adh.model.models.Device) again from the
+ordinateurs and portables tables.
+
+The API keeps the index up to date with its own writes only: the devices
+written by anything else (ADH5, a script, SQL by hand) are missing from the
+device list and the search until this module is run. Run it once after the
+deployment that creates the index, then after each such write (from cron if
+ADH5 is still in use):
+
+    python -m adh.model.reindex
+"""
+import logging
+from sqlalchemy import func, select
+from adh.model.models import Device
+
+
+def rebuild_index(engine):
+    """ Rebuild the index in a transaction, return its number of rows """
+    with engine.begin() as conn:
+        Device.rebuild(conn)
+        return conn.execute(select([func.count()])
+                            .select_from(Device.__table__)).scalar()
+
+
+if __name__ == "__main__":
+    from adh.model.database import Database
+    from CONFIGURATION import PROD_DATABASE
+
+    logging.basicConfig(level=logging.INFO)
+    Database.init_db(PROD_DATABASE)
+    count = rebuild_index(Database.get_db().engine)
+    logging.info("Indexed %d devices", count)
@@ -0,0 +1,295 @@
+"""
+Search backends for the "terms" parameter of the filter endpoints.
+
+- fulltext: MATCH ... AGAINST on the FULLTEXT (ngram) indexes of MySQL
+- ngram: in-process inverted index of the trigrams of the searched columns,
+  it narrows the search down to a few ids before checking them with LIKE.
+  Each process has its own index, which is only invalidated by the writes of
+  that process: use it for tests or single process deployments only.
+- like: plain LIKE '%terms%' on every column (full scan)
+
+The backend is chosen by the SEARCH_BACKEND setting, "auto" picks fulltext
+on MySQL, ngram on SQLite (the tests) and like otherwise: the workers of a
+deployment would each hold their own ngram index.
+
+The ngram parser of MySQL drops the ngrams that contain a stopword ("a",
+"in", "of"...) and cannot find terms shorter than ngram_token_size: MATCH
+would silently miss rows. The fulltext backend is only used if the server
+runs with innodb_ft_enable_stopword=OFF and ngram_token_size=2 (set them
+before creating the FULLTEXT indexes), LIKE is used otherwise.
+"""
+import logging
+import threading
+from collections import defaultdict
+from flask import current_app
+from sqlalchemy import event, false, literal, or_, select, text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.expression import ColumnElement
+from sqlalchemy.types import Float
+from adh.model.database import Database as db
+from adh.model.models import Adherent, Chambre, Device, Ordinateur, Port, \
+        Portable, Switch
+
+NGRAM_SIZE = 3
+
+# Below that many characters, MySQL's ngram parser (ngram_token_size=2)
+# cannot match anything, so LIKE is used instead
+FULLTEXT_MIN_LENGTH = 2
+
+
+class Match(ColumnElement):
+    """ MATCH (columns) AGAINST (terms IN BOOLEAN MODE) """
+    # The relevance, not a boolean: "MATCH ... = 1" would miss rows
+    type = Float()
+
+    def __init__(self, columns, terms):
+        self.columns = columns
+        self.terms = terms
+
+
+@compiles(Match, "mysql")
+def _compile_match(element, compiler, **kw):
+    return "MATCH ({}) AGAINST ({} IN BOOLEAN MODE)".format(
+        ", ".join(compiler.process(c, **kw) for c in element.columns),
+        compiler.process(element.terms, **kw),
+    )
+
+
+def _phrase(terms):
+    """ Boolean mode phrase, the ngrams have to be found in this order """
+    return literal('"{}"'.format(terms.replace('"', ' ')))
+
+
+def ngrams(text):
+    text = str(text).lower()
+    return set(text[i:i + NGRAM_SIZE]
+               for i in range(len(text) - NGRAM_SIZE + 1))
+
+
+class NgramIndex():
+    """ Inverted index: trigram -> ids of the rows that contain it """
+
+    def __init__(self):
+        self.postings = {}
+        self.dirty = True
+        self._lock = threading.Lock()
+
+    def build(self, rows):
+        """ rows is an iterable of (id, text1, text2, ...) """
+        postings = defaultdict(set)
+        for row in rows:
+            for text in row[1:]:
+                if text is None:
+                    continue
+                for gram in ngrams(text):
+                    postings[gram].add(row[0])
+        self.postings = dict(postings)
+
+    def candidates(self, terms, load):
+        """
+        Return the ids of the rows that may contain terms, or None if terms
+        is too short to use the index. If the index is dirty, it is built
+        again from the rows returned by load().
+        """
+        grams = ngrams(terms)
+        if not grams:
+            return None
+
+        with self._lock:
+            if self.dirty:
+                self.dirty = False
+                self.build(load())
+            postings = self.postings
+
+        # Start with the rarest trigram, the intersection stays small
+        result = None
+        for gram in sorted(grams, key=lambda g: len(postings.get(g, ()))):
+            ids = postings.get(gram, set())
+            result = ids if result is None else result & ids
+            if not result:
+                return set()
+        return result
+
+
+class Searchable():
+    """ Describes what is searched for one of the filter endpoints """
+
+    def __init__(self, name, id_column, columns, fulltext, models,
+                 joins=()):
+        self.name = name
+        self.id_column = id_column
+        self.columns = columns
+        self.fulltext = fulltext
+        self.models = models
+        self.joins = joins
+
+    def like(self, terms):
+        return or_(*[c.contains(terms) for c in self.columns])
+
+    def rows(self, session):
+        q = session.query(self.id_column, *self.columns)
+        q = q.select_from(self.id_column.class_)
+        for target, on in self.joins:
+            q = q.outerjoin(target, on)
+        return q
+
+    def get_index(self):
+        return db.get_db().get_cache("search:" + self.name, NgramIndex)
+
+    def ngram(self, session, terms):
+        ids = self.get_index().candidates(terms, lambda: self.rows(session))
+        if ids is None:
+            return self.like(terms)
+        if not ids:
+            return false()
+        # The trigrams may come from different columns, check with LIKE
+        return self.id_column.in_(ids) & self.like(terms)
+
+
+SEARCHABLES = {
+    "user": Searchable(
+        "user", Adherent.id,
+        [Adherent.nom, Adherent.prenom, Adherent.mail, Adherent.login,
+         Adherent.commentaires],
+        fulltext=lambda t: Match(
+            [Adherent.nom, Adherent.prenom, Adherent.mail, Adherent.login,
+             Adherent.commentaires], t),
+        models=[Adherent],
+    ),
+    "room": Searchable(
+        "room", Chambre.id,
+        [Chambre.telephone, Chambre.description],
+        fulltext=lambda t: Match(
+            [Chambre.telephone, Chambre.description], t),
+        models=[Chambre],
+    ),
+    "switch": Searchable(
+        "switch", Switch.id,
+        [Switch.description, Switch.ip, Switch.communaute],
+        fulltext=lambda t: Match(
+            [Switch.description, Switch.ip, Switch.communaute], t),
+        models=[Switch],
+    ),
+    "port": Searchable(
+        "port", Port.id,
+        [Port.numero, Port.oid],
+        fulltext=lambda t: Match([Port.numero, Port.oid], t),
+        models=[Port],
+    ),
+    # The query of filterDevice joins the owner, its login is searched too
+    "device": Searchable(
+        "device", Device.id,
+        [Device.mac, Device.ip, Device.ipv6, Adherent.login],
+        fulltext=lambda t: or_(
+            Match([Device.mac, Device.ip, Device.ipv6], t),
+            Device.adherent_id.in_(
+                select([Adherent.id]).where(Match([Adherent.login], t))
+            ),
+        ),
+        models=[Ordinateur, Portable, Adherent],
+        joins=[(Adherent, Adherent.id == Device.adherent_id)],
+    ),
+}
+
+
+def check_fulltext(session):
+    """
+    True if MATCH finds every substring of FULLTEXT_MIN_LENGTH characters or
+    more, like LIKE does (see above)
+    """
+    q = text("SELECT @@innodb_ft_enable_stopword, @@ngram_token_size")
+    stopwords, token_size = session.execute(q).fetchone()
+    if stopwords or token_size > FULLTEXT_MIN_LENGTH:
+        logging.warning(
+            "FULLTEXT search disabled (LIKE is used), run MySQL with "
+            "innodb_ft_enable_stopword=OFF and ngram_token_size=%d, then "
+            "create the FULLTEXT indexes again", FULLTEXT_MIN_LENGTH)
+        return False
+    return True
+
+
+def fulltext_supported(session):
+    """ check_fulltext(), done once per process """
+    return db.get_db().get_cache("search:fulltext",
+                                 lambda: check_fulltext(session))
+
+
+def get_backend(session):
+    backend = current_app.config.get("SEARCH_BACKEND", "auto")
+    if backend == "auto":
+        dialect = session.bind.dialect.name
+        if dialect == "sqlite":
+            return "ngram"
+        if dialect != "mysql":
+            return "like"
+        backend = "fulltext"
+    if backend == "fulltext" and not fulltext_supported(session):
+        return "like"
+    return backend
+
+
+def matches(session, name, terms):
+    """
+    Return a filter selecting the rows of the "name" endpoint that contain
+    terms in one of their searched columns
+    """
+    searchable = SEARCHABLES[name]
+    backend = get_backend(session)
+
+    if backend == "fulltext" and len(terms) >= FULLTEXT_MIN_LENGTH:
+        # The ngrams may be found in different columns, check with LIKE
+        return searchable.fulltext(_phrase(terms)) & searchable.like(terms)
+    if backend == "ngram":
+        return searchable.ngram(session, terms)
+    return searchable.like(terms)
+
+
+def _mark_dirty(names):
+    database = db.get_db()
+    if database is None:
+        return
+    for name in names:
+        database.get_cache("search:" + name, NgramIndex).dirty = True
+
+
+def _written(session, names):
+    _mark_dirty(names)
+    # The index may be rebuilt before the end of this transaction, without
+    # its rows (another thread) or with them (rolled back): rebuild it again
+    if session is not None:
+        session.info.setdefault("search_dirty", set()).update(names)
+
+
+def _listen_model(model, names):
+    def after_write(mapper, connection, target):
+        _written(Session.object_session(target), names)
+
+    for e in ("after_insert", "after_update", "after_delete"):
+        event.listen(model, e, after_write)
+
+
+def bulk_written(session, model):
+    """
+    Call it after writing rows of model with a bulk statement (INSERT
+    executemany, UPDATE/DELETE ... WHERE), those emit no mapper event
+    """
+    _written(session, _names_by_model[model])
+
+
+_names_by_model = defaultdict(set)
+for _searchable in SEARCHABLES.values():
+    for _model in _searchable.models:
+        _names_by_model[_model].add(_searchable.name)
+for _model, _names in _names_by_model.items():
+    _listen_model(_model, _names)
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session):
+    _mark_dirty(session.info.pop("search_dirty", ()))
+
+
+@event.listens_for(Session, "after_rollback")
+def _after_rollback(session):
+    _mark_dirty(session.info.pop("search_dirty", ()))
@@ -1,8 +1,58 @@
+import asyncio
+import itertools
+import os
+import random
+import socket
+import threading
+import weakref
+from collections import namedtuple
+from flask import current_app, has_app_context
+from pyasn1.codec.ber import decoder, encoder
+from pyasn1.error import PyAsn1Error
+from pysnmp.proto import api
 from pysnmp.hlapi import (
     setCmd, SnmpEngine, CommunityData, ObjectType, ObjectIdentity, Integer,
     UdpTransportTarget, ContextData, getCmd
 )
 
+# SnmpEngine is not thread safe and a transport target is bound to the
+# engine that opened its socket, so both are kept per thread (and per
+# process, uWSGI forks after importing us).
+_local = threading.local()
+
+
+def _thread_state():
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.engine = SnmpEngine()
+        _local.targets = {}
+        _local.communities = {}
+    return _local
+
+
+def get_engine():
+    """ Return the SnmpEngine of the current thread """
+    return _thread_state().engine
+
+
+def get_target(server, port):
+    """ Return the cached transport target of a switch """
+    targets = _thread_state().targets
+    key = (server, port)
+    if key not in targets:
+        targets[key] = UdpTransportTarget((server, port))
+    return targets[key]
+
+
+def get_community(secret):
+    communities = _thread_state().communities
+    if secret not in communities:
+        communities[secret] = CommunityData(secret)
+    return communities[secret]
+
+
+_context = ContextData()
+
 
 class SNMPError(Exception):
     def __init__(self, value):
@@ -16,14 +66,29 @@ class SNMPManager:
         self.secret = secret
         self.port = port
 
+    def _session(self):
+        """ Arguments common to all the hlapi commands """
+        return (
+            get_engine(),
+            get_community(self.secret),
+            get_target(self.server, self.port),
+            _context,
+        )
+
+    def port_states(self, oids=None):
+        """
+        Snapshot of the state of the ports, read with a few GETBULK requests
+        instead of one request per port and per variable.
+        See AsyncSNMPManager.port_states.
+        """
+        manager = AsyncSNMPManager(self.server, self.secret, self.port)
+        return run(manager.port_states(oids))
+
     def change_value(self, req, oid, value):
 
         try:
             errorIndication, errorStatus, errorIndex, varBinds = next(
-                setCmd(
-                    SnmpEngine(), CommunityData(
-                        self.secret), UdpTransportTarget(
-                        (self.server, self.port)), ContextData(), ObjectType(
+                setCmd(*self._session(), ObjectType(
                         ObjectIdentity(
                             req + str(oid)), Integer(value))), )
         except Exception:
@@ -42,10 +107,7 @@ class SNMPManager:
     def make_request(self, req, oid):
         try:
             errorIndication, errorStatus, errorIndex, varBinds = next(
-                getCmd(SnmpEngine(),
-                       CommunityData(self.secret),
-                       UdpTransportTarget((self.server, self.port)),
-                       ContextData(),
+                getCmd(*self._session(),
                        ObjectType(ObjectIdentity(req + str(oid)))),
             )
         except Exception:
@@ -61,3 +123,320 @@ class SNMPManager:
                     return varBinds[0][1]
                 else:
                     raise SNMPError("Multiple MIB variables returned.")
+
+
+# Asynchronous client
+#
+# pysnmp's asyncio hlapi is built on asyncio.coroutine, which is gone since
+# Python 3.11, so the v2c messages are encoded with pysnmp's protocol API and
+# sent from an asyncio datagram endpoint instead.
+
+_v2c = api.protoModules[api.protoVersion2c]
+
+# Maximum number of variables sent in a single PDU, larger requests are split
+MAX_VAR_BINDS = 32
+
+# Columns of the interface tables, indexed by the Port.oid of the ports
+IF_ADMIN_STATUS = "1.3.6.1.2.1.2.2.1.7"
+IF_OPER_STATUS = "1.3.6.1.2.1.2.2.1.8"
+# CISCO-VLAN-MEMBERSHIP-MIB::vmVlan, VLAN of an access port
+VM_VLAN = "1.3.6.1.4.1.9.9.68.1.2.2.1.2"
+
+PORT_COLUMNS = (IF_OPER_STATUS, IF_ADMIN_STATUS, VM_VLAN)
+
+PortState = namedtuple("PortState", ["oper_status", "admin_status", "vlan"])
+
+_NO_VALUE = (_v2c.EndOfMibView, _v2c.NoSuchObject, _v2c.NoSuchInstance)
+
+
+def _setting(name, default):
+    if has_app_context():
+        return current_app.config.get(name, default)
+    return default
+
+
+class _Dispatcher(asyncio.DatagramProtocol):
+    """
+    UDP socket shared by all the requests of an event loop, the responses are
+    matched to the requests by their request-id
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+        self._ids = itertools.count(random.randrange(1, 2 ** 30))
+
+    def next_id(self):
+        return next(self._ids) % (2 ** 31)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        try:
+            message, _ = decoder.decode(data, asn1Spec=_v2c.Message())
+        except PyAsn1Error:
+            return
+        pdu = _v2c.apiMessage.getPDU(message)
+        future = self.pending.get(int(_v2c.apiPDU.getRequestID(pdu)))
+        if future is not None and not future.done():
+            future.set_result(pdu)
+
+    def error_received(self, exc):
+        # ICMP errors are not tied to a request, the requests time out
+        pass
+
+
+_dispatchers = weakref.WeakKeyDictionary()
+
+
+async def get_dispatcher():
+    """ Return the dispatcher of the running event loop """
+    loop = asyncio.get_event_loop()
+    dispatcher = _dispatchers.get(loop)
+    if dispatcher is None or dispatcher.transport.is_closing():
+        _, dispatcher = await loop.create_datagram_endpoint(
+            _Dispatcher, family=socket.AF_INET)
+        _dispatchers[loop] = dispatcher
+    return dispatcher
+
+
+def _new_pdu(cls):
+    pdu = cls()
+    _v2c.apiPDU.setDefaults(pdu)
+    return pdu
+
+
+def _oid_key(oid):
+    return tuple(int(i) for i in oid.split("."))
+
+
+def _value(value):
+    if isinstance(value, int):
+        return Integer(value)
+    return value
+
+
+class AsyncSNMPManager:
+    """
+    asyncio variant of SNMPManager, several variables are read or written
+    with each request
+    """
+
+    def __init__(self, server, secret, port=161, timeout=None, retries=None):
+        self.server = server
+        self.secret = secret
+        self.port = port
+        self.timeout = timeout or _setting("SNMP_REQUEST_TIMEOUT", 1)
+        if retries is None:
+            retries = _setting("SNMP_RETRIES", 2)
+        self.retries = retries
+        self._address = None
+
+    async def _resolve(self):
+        if self._address is None:
+            loop = asyncio.get_event_loop()
+            infos = await loop.getaddrinfo(self.server, self.port,
+                                           family=socket.AF_INET,
+                                           type=socket.SOCK_DGRAM)
+            self._address = infos[0][4]
+        return self._address
+
+    async def _request(self, pdu, var_binds):
+        """ Send pdu, retrying on timeout, and return its response varBinds """
+        dispatcher = await get_dispatcher()
+        address = await self._resolve()
+        request_id = dispatcher.next_id()
+
+        _v2c.apiPDU.setRequestID(pdu, request_id)
+        _v2c.apiPDU.setVarBinds(pdu, var_binds)
+        message = _v2c.Message()
+        _v2c.apiMessage.setDefaults(message)
+        _v2c.apiMessage.setCommunity(message, self.secret)
+        _v2c.apiMessage.setPDU(message, pdu)
+        data = encoder.encode(message)
+
+        loop = asyncio.get_event_loop()
+        for _ in range(self.retries + 1):
+            future = loop.create_future()
+            dispatcher.pending[request_id] = future
+            dispatcher.transport.sendto(data, address)
+            try:
+                response = await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                continue
+            finally:
+                dispatcher.pending.pop(request_id, None)
+
+            errorStatus = _v2c.apiPDU.getErrorStatus(response)
+            if errorStatus:
+                raise SNMPError(errorStatus.prettyPrint())
+            return [(str(oid), value)
+                    for oid, value in _v2c.apiPDU.getVarBinds(response)]
+
+        raise SNMPError("No SNMP response received before timeout")
+
+    async def get(self, oids):
+        """ Return the values of oids, in the same order """
+        values = []
+        for i in range(0, len(oids), MAX_VAR_BINDS):
+            chunk = oids[i:i + MAX_VAR_BINDS]
+            var_binds = await self._request(
+                _new_pdu(_v2c.GetRequestPDU),
+                [(oid, _v2c.null) for oid in chunk])
+            values += [value for _, value in var_binds]
+        return values
+
+    async def set(self, changes):
+        """ changes is a list of (oid, value), return the new values """
+        values = []
+        for i in range(0, len(changes), MAX_VAR_BINDS):
+            chunk = changes[i:i + MAX_VAR_BINDS]
+            var_binds = await self._request(
+                _new_pdu(_v2c.SetRequestPDU),
+                [(oid, _value(value)) for oid, value in chunk])
+            values += [value for _, value in var_binds]
+        return values
+
+    async def walk(self, columns, max_repetitions=None):
+        """
+        Read every row of the columns of a table with GETBULK requests (all
+        the columns are walked together). Returns a dict column -> {index:
+        value}, index being the part of the oid that follows the column.
+        """
+        max_repetitions = max_repetitions or \
+            _setting("SNMP_MAX_REPETITIONS", 16)
+        columns = [c.rstrip(".") for c in columns]
+        result = {c: {} for c in columns}
+        last = {c: c for c in columns}
+        active = list(columns)
+
+        while active:
+            pdu = _v2c.GetBulkRequestPDU()
+            _v2c.apiBulkPDU.setDefaults(pdu)
+            _v2c.apiBulkPDU.setNonRepeaters(pdu, 0)
+            _v2c.apiBulkPDU.setMaxRepetitions(pdu, max_repetitions)
+            var_binds = await self._request(
+                pdu, [(last[c], _v2c.null) for c in active])
+            if not var_binds:
+                raise SNMPError("Empty GETBULK response")
+
+            # The response is a list of rows of len(active) variables,
+            # truncated if it does not fit in a message
+            done = set()
+            for i, (oid, value) in enumerate(var_binds):
+                column = active[i % len(active)]
+                if column in done:
+                    continue
+                prefix = column + "."
+                if isinstance(value, _NO_VALUE) \
+                        or not oid.startswith(prefix) \
+                        or _oid_key(oid) <= _oid_key(last[column]):
+                    done.add(column)
+                    continue
+                result[column][oid[len(prefix):]] = value
+                last[column] = oid
+            active = [c for c in active if c not in done]
+
+        return result
+
+    async def port_states(self, oids=None):
+        """
+        Snapshot of the state of the ports of the switch, as a dict Port.oid
+        -> PortState. If oids is given, only these ports are returned.
+        """
+        table = await self.walk(PORT_COLUMNS)
+        if oids is None:
+            oids = set()
+            for rows in table.values():
+                oids.update(rows)
+
+        states = {}
+        for oid in oids:
+            values = [table[c].get(str(oid)) for c in PORT_COLUMNS]
+            states[oid] = PortState(*[
+                None if v is None else int(v) for v in values
+            ])
+        return states
+
+    async def make_request(self, req, oid):
+        try:
+            return (await self.get([req + str(oid)]))[0]
+        except SNMPError as e:
+            return e
+
+    async def change_value(self, req, oid, value):
+        try:
+            return (await self.set([(req + str(oid), value)]))[0]
+        except SNMPError as e:
+            return e
+
+
+async def fan_out(jobs, concurrency=None, timeout=None):
+    """
+    Await the coroutine functions of jobs (a dict key -> function), at most
+    concurrency of them at a time and each one for at most timeout seconds.
+    Returns a dict key -> result, or SNMPError if the job failed.
+    """
+    concurrency = concurrency or _setting("SNMP_CONCURRENCY", 16)
+    timeout = timeout or _setting("SNMP_TIMEOUT", 5)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(job):
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(job(), timeout)
+            except asyncio.TimeoutError:
+                return SNMPError("Switch did not answer in time")
+            except SNMPError as e:
+                return e
+
+    keys = list(jobs)
+    results = await asyncio.gather(*[run(jobs[k]) for k in keys])
+    return dict(zip(keys, results))
+
+
+def run(coroutine):
+    """ Run coroutine in a new event loop, from synchronous code """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        dispatcher = _dispatchers.pop(loop, None)
+        if dispatcher is not None:
+            dispatcher.transport.close()
+            # Let the transport release its socket
+            loop.run_until_complete(asyncio.sleep(0))
+        loop.close()
+
+
+def batch_get(queries, concurrency=None, timeout=None):
+    """
+    Read many switches concurrently. queries maps a key to a tuple
+    (AsyncSNMPManager, oids); returns a dict key -> values (or SNMPError).
+    """
+    jobs = {key: (lambda m=manager, o=oids: m.get(o))
+            for key, (manager, oids) in queries.items()}
+    return run(fan_out(jobs, concurrency, timeout))
+
+
+def batch_port_states(switches, concurrency=None, timeout=None):
+    """
+    Snapshot the ports of many switches concurrently. switches maps a key to
+    a tuple (AsyncSNMPManager, oids or None); returns key -> {Port.oid:
+    PortState} (or SNMPError).
+    """
+    jobs = {key: (lambda m=manager, o=oids: m.port_states(o))
+            for key, (manager, oids) in switches.items()}
+    return run(fan_out(jobs, concurrency, timeout))
+
+
+def batch_set(changes, concurrency=None, timeout=None):
+    """
+    Write to many switches concurrently. changes maps a key to a tuple
+    (AsyncSNMPManager, [(oid, value), ...]); returns key -> new values (or
+    SNMPError).
+    """
+    jobs = {key: (lambda m=manager, c=values: m.set(c))
+            for key, (manager, values) in changes.items()}
+    return run(fan_out(jobs, concurrency, timeout))
@@ -0,0 +1,58 @@
+from flask import current_app
+from sqlalchemy import text, bindparam
+from adh.model.database import Database as db
+from adh.util.cache import TTLCache
+
+
+def get_count_cache():
+    """ Return the (endpoint, filters) -> count cache of this worker """
+    ttl = current_app.config.get("COUNT_CACHE_TTL", 10)
+    return db.get_db().get_cache(
+        "counts",
+        lambda: TTLCache(maxsize=512, ttl=ttl)
+    )
+
+
+def estimate_rows(session, tables):
+    """
+    Return the approximate number of rows of tables, read from the table
+    statistics of MySQL (no scan at all). Returns None if the database does
+    not provide such statistics.
+    """
+    if session.bind.dialect.name != "mysql":
+        return None
+    q = text(
+        "SELECT SUM(TABLE_ROWS) FROM information_schema.TABLES "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN :names"
+    ).bindparams(bindparam("names", expanding=True))
+    result = session.execute(q, {"names": [t.name for t in tables]}).scalar()
+    return int(result) if result is not None else None
+
+
+def total_count(q, mode, cache_key, tables=None):
+    """
+    Count the results of q according to mode:
+    - exact: always run the COUNT query
+    - cached: reuse the count computed for the same cache_key during the
+      last few seconds
+    - estimate: read the table statistics if the query is not filtered
+      (tables is the list of the tables it reads), else same as cached
+    - none: do not count at all, return None
+    """
+    if mode == "none":
+        return None
+
+    if mode == "exact":
+        return q.count()
+
+    if mode == "estimate" and tables:
+        estimate = estimate_rows(q.session, tables)
+        if estimate is not None:
+            return estimate
+
+    cache = get_count_cache()
+    count = cache.get(cache_key)
+    if count is None:
+        count = q.count()
+        cache.set(cache_key, count)
+    return count
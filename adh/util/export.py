@@ -0,0 +1,81 @@
+"""
+Streaming export of a whole table, as NDJSON (one JSON object per line) or
+as CSV.
+
+The rows are read from a server-side cursor (Query.yield_per) and sent as
+they come, EXPORT_BATCH_SIZE at a time: the memory used by the worker does
+not depend on the number of rows.
+"""
+import csv
+import datetime
+import io
+from flask import Response, current_app, stream_with_context
+
+MIMETYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def _ndjson_lines(rows):
+    # flask.json.dumps() would create an encoder for each row
+    encode = current_app.json_encoder(separators=(",", ":")).encode
+    for row in rows:
+        yield encode(row) + "\n"
+
+
+def _pop(buf):
+    value = buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+    return value
+
+
+def _csv_lines(rows, fields):
+    # Dates are written like in the JSON answers of the API
+    encoder = current_app.json_encoder()
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fields, extrasaction="ignore")
+    writer.writeheader()
+    yield _pop(buf)
+    for row in rows:
+        writer.writerow({
+            k: encoder.default(v) if isinstance(v, datetime.date) else v
+            for k, v in row.items()
+        })
+        yield _pop(buf)
+
+
+def _batches(lines, size):
+    """ Join the lines size by size, to send fewer and larger writes """
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= size:
+            yield "".join(batch)
+            batch = []
+    if batch:
+        yield "".join(batch)
+
+
+def stream(query, to_dict, fields, fmt, name):
+    """
+    Return a response streaming to_dict() of each result of query in the
+    format fmt. fields are the columns of the CSV format, name is the name
+    of the file proposed to the client.
+    """
+    size = current_app.config.get("EXPORT_BATCH_SIZE", 1000)
+    rows = map(to_dict, query.yield_per(size))
+    if fmt == "csv":
+        lines = _csv_lines(rows, fields)
+    else:
+        lines = _ndjson_lines(rows)
+
+    # The rows are read after the view returned, the request context (and
+    # so the session) must be kept until the end
+    return Response(
+        stream_with_context(_batches(lines, size)),
+        mimetype=MIMETYPES[fmt],
+        headers={"Content-Disposition":
+                 "attachment; filename={}.{}".format(name, fmt)},
+    )
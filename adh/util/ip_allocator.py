@@ -0,0 +1,347 @@
+"""
+Allocation of the addresses of the wired devices.
+
+Each worker keeps a bitmap of the addresses of every VLAN network, a set bit
+being an address used by a device. The bitmaps are loaded from ordinateurs
+on first use, kept up to date with the writes of the worker, and loaded
+again every IP_POOL_MAX_AGE seconds to see those of the other workers (and
+of ADH5).
+
+A bitmap may be stale, so an address is only handed out if no device of
+ordinateurs uses it and a row of ip_reservations could be inserted for it:
+two workers picking the same address conflict on its primary key (the
+INSERT skips it, so the transaction goes on). The reservation is committed
+with the device and kept IP_RESERVATION_TTL seconds, ordinateurs is enough
+once the device is committed. An address released is not handed out again
+before that. Each worker deletes the expired reservations at most once every
+IP_RESERVATION_TTL seconds, not on every allocation: a reservation may last
+up to twice as long.
+"""
+import datetime
+import functools
+import ipaddress
+import threading
+import time
+from flask import current_app
+from sqlalchemy import event, select, union_all
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+from adh.model.database import Database as db
+from adh.model.models import IPReservation, Ordinateur, Vlan
+
+CACHE = "ip_pools"
+
+
+@functools.lru_cache(maxsize=256)
+def _network(value):
+    """ Parse Vlan.adresses or adressesv6, None if it is not a network """
+    try:
+        return ipaddress.ip_network(value, strict=False)
+    except (TypeError, ValueError):
+        return None
+
+
+def _address(value):
+    try:
+        return ipaddress.ip_address(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class AddressPool():
+    """ Bitmap of the addresses of a network that can be handed out """
+
+    def __init__(self, network, skip, max_size):
+        first = int(network.network_address)
+        last = int(network.broadcast_address)
+        if network.version == 4 and network.prefixlen < 31:
+            first, last = first + 1, last - 1  # Network and broadcast
+        elif network.version == 6 and network.prefixlen < 127:
+            first += 1  # Subnet-Router anycast address
+        # The first addresses are kept for the routers
+        first += skip
+
+        self.network = network
+        self.first = first
+        self.size = max(0, min(last - first + 1, max_size))
+        self.free = self.size
+        self._bits = bytearray((self.size + 7) // 8)
+        if self.size % 8:
+            # The padding of the last byte is never handed out
+            self._bits[-1] = 0xFF << self.size % 8 & 0xFF
+        # There is no free address in the bytes before this one
+        self._cursor = 0
+
+    def _position(self, address):
+        offset = int(address) - self.first
+        if 0 <= offset < self.size:
+            return divmod(offset, 8)
+        return None, None
+
+    def mark(self, address):
+        """ Mark address as used (ignored if it is not in the pool) """
+        byte, bit = self._position(address)
+        if byte is not None and not self._bits[byte] & 1 << bit:
+            self._bits[byte] |= 1 << bit
+            self.free -= 1
+
+    def release(self, address):
+        """ Mark address as free (ignored if it is not in the pool) """
+        byte, bit = self._position(address)
+        if byte is not None and self._bits[byte] & 1 << bit:
+            self._bits[byte] &= ~(1 << bit)
+            self.free += 1
+            self._cursor = min(self._cursor, byte)
+
+    def take(self):
+        """ Mark a free address as used and return it, None if full """
+        if not self.free:
+            return None
+        # The cursor only moves back when an address is released, the
+        # full bytes are skipped once: amortised O(1)
+        while self._bits[self._cursor] == 0xFF:
+            self._cursor += 1
+        byte = self._bits[self._cursor]
+        bit = (~byte & byte + 1).bit_length() - 1  # Lowest unset bit
+        self._bits[self._cursor] |= 1 << bit
+        self.free -= 1
+        offset = self._cursor * 8 + bit
+        return self.network.network_address.__class__(self.first + offset)
+
+
+class AddressPools():
+    """ Network -> AddressPool, for the networks of the VLANs """
+
+    def __init__(self, max_age, clock=time.monotonic):
+        self.max_age = max_age
+        self.clock = clock
+        self._pools = {}
+        self._prefixes = set()
+        self._loaded_at = None
+        self._purged_at = None
+        self._lock = threading.Lock()
+
+    def _find(self, address):
+        for version, prefixlen in self._prefixes:
+            if address.version == version:
+                network = ipaddress.ip_network((address, prefixlen),
+                                               strict=False)
+                if network in self._pools:
+                    return self._pools[network]
+        return None
+
+    def load(self, s, skip, max_size, reserved_since):
+        """
+        Build the bitmaps from the VLANs, the wired devices and the
+        reservations made since reserved_since
+        """
+        pools = {}
+        for row in s.query(Vlan.adresses, Vlan.adressesv6):
+            for network in map(_network, row):
+                if network is not None and network not in pools:
+                    pools[network] = AddressPool(network, skip, max_size)
+
+        used = list(s.query(Ordinateur.ip, Ordinateur.ipv6))
+        q = s.query(IPReservation.address)
+        used += q.filter(IPReservation.created_at >= reserved_since)
+
+        with self._lock:
+            self._pools = pools
+            self._prefixes = {(n.version, n.prefixlen) for n in pools}
+            for row in used:
+                for address in filter(None, map(_address, row)):
+                    pool = self._find(address)
+                    if pool is not None:
+                        pool.mark(address)
+            self._loaded_at = self.clock()
+
+    def expired(self):
+        return self._loaded_at is None or \
+            self._loaded_at + self.max_age <= self.clock()
+
+    def purge_due(self, interval):
+        """ Tell if the expired reservations are to be deleted now """
+        with self._lock:
+            now = self.clock()
+            if self._purged_at is not None and \
+                    self._purged_at + interval > now:
+                return False
+            self._purged_at = now
+            return True
+
+    def take(self, network):
+        """ Take a free address of network, None if full or unknown """
+        with self._lock:
+            pool = self._pools.get(_network(network))
+            return pool and pool.take()
+
+    def apply(self, released, used):
+        """ Release then mark addresses (ipaddress objects) """
+        with self._lock:
+            for address in released:
+                pool = self._find(address)
+                if pool is not None:
+                    pool.release(address)
+            for address in used:
+                pool = self._find(address)
+                if pool is not None:
+                    pool.mark(address)
+
+
+def _cached_pools():
+    database = db.get_db()
+    return database and database.caches.get(CACHE)
+
+
+def get_pools(s):
+    """ Return the pools of the worker, (re)loaded if they are too old """
+    config = current_app.config
+    pools = db.get_db().get_cache(CACHE, lambda: AddressPools(
+        config.get("IP_POOL_MAX_AGE", 600)))
+    if pools.expired():
+        pools.load(
+            s,
+            config.get("IP_RESERVED_ADDRESSES", 1),
+            config.get("IP_POOL_MAX_SIZE", 65536),
+            _reservation_cutoff(),
+        )
+    return pools
+
+
+def _reservation_cutoff():
+    ttl = current_app.config.get("IP_RESERVATION_TTL", 60)
+    return datetime.datetime.now() - datetime.timedelta(seconds=ttl)
+
+
+def _used(s, addresses):
+    """
+    The addresses of addresses that a wired device has or that are
+    reserved. ordinateurs is read, not the devices index: ADH5 writes to it.
+    """
+    wired = Ordinateur.__table__.c
+    reserved = IPReservation.__table__.c
+    q = union_all(
+        select([wired.ip]).where(wired.ip.in_(addresses)),
+        select([wired.ipv6]).where(wired.ipv6.in_(addresses)),
+        select([reserved.address]).where(reserved.address.in_(addresses)),
+    )
+    return {address for address, in s.execute(q)}
+
+
+def _insert_ignore(dialect):
+    """ INSERT into ip_reservations that skips the addresses taken """
+    table = IPReservation.__table__
+    if dialect.name == "mysql":
+        return table.insert().prefix_with("IGNORE")
+    if dialect.name == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    return table.insert().prefix_with("OR IGNORE")  # SQLite
+
+
+def _reserve(s, addresses):
+    """
+    Insert a reservation for each address, the conflicting ones are skipped
+    (no SAVEPOINT needed). Returns the set of the addresses reserved.
+    """
+    if not addresses:
+        return set()
+    now = datetime.datetime.now()
+    r = s.execute(_insert_ignore(s.bind.dialect), [
+        {"address": address, "created_at": now} for address in addresses
+    ])
+    if r.rowcount == len(addresses):
+        return set(addresses)
+    # Some were reserved by another worker in the meantime, ours are those
+    # created just now
+    q = s.query(IPReservation.address)
+    q = q.filter(IPReservation.address.in_(addresses))
+    q = q.filter(IPReservation.created_at == now)
+    return {address for address, in q}
+
+
+def allocate(s, networks):
+    """
+    Reserve a free address in each network of networks (values of
+    Vlan.adresses or adressesv6) for devices written in the current
+    transaction. Return the addresses as strings, None for a network that
+    is full or unknown. The number of statements does not depend on the
+    number of addresses, unless other workers allocate at the same time.
+    """
+    if not networks:
+        return []
+    pools = get_pools(s)
+    if pools.purge_due(current_app.config.get("IP_RESERVATION_TTL", 60)):
+        q = s.query(IPReservation)
+        q.filter(IPReservation.created_at < _reservation_cutoff()) \
+            .delete(synchronize_session=False)
+
+    result = [None] * len(networks)
+    pending = range(len(networks))
+    while pending:
+        candidates = {}
+        for i in pending:
+            address = pools.take(networks[i])
+            if address is not None:
+                candidates[i] = str(address)
+                s.info.setdefault("ip_taken", []).append(address)
+
+        used = _used(s, list(candidates.values())) if candidates else ()
+        free = {i: a for i, a in candidates.items() if a not in used}
+        reserved = _reserve(s, list(free.values()))
+        free = {i: a for i, a in free.items() if a in reserved}
+        for i, address in free.items():
+            result[i] = address
+        # The others are in use, their bit is set: try the next ones
+        pending = [i for i in candidates if i not in free]
+    return result
+
+
+def written(session, old, new):
+    """
+    Record that the wired devices stopped using the addresses old and now
+    use the addresses new, the pools are updated once it is committed. Call
+    it after bulk statements, those emit no mapper event.
+    """
+    if session is None:
+        return
+    released, used = session.info.setdefault("ip_changes", ([], []))
+    released += filter(None, map(_address, old))
+    used += filter(None, map(_address, new))
+
+
+def _after_write(mapper, connection, target):
+    old = list(get_history(target, "ip").deleted) + \
+        list(get_history(target, "ipv6").deleted)
+    written(Session.object_session(target), old, [target.ip, target.ipv6])
+
+
+def _after_delete(mapper, connection, target):
+    written(Session.object_session(target), [target.ip, target.ipv6], [])
+
+
+event.listen(Ordinateur, "after_insert", _after_write)
+event.listen(Ordinateur, "after_update", _after_write)
+event.listen(Ordinateur, "after_delete", _after_delete)
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session):
+    session.info.pop("ip_taken", None)
+    changes = session.info.pop("ip_changes", None)
+    pools = _cached_pools()
+    if changes and pools:
+        released, used = changes
+        pools.apply(set(released) - set(used), used)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _after_transaction_end(session, transaction):
+    if transaction.parent is not None:
+        return
+    # Not committed: the addresses taken are free again
+    session.info.pop("ip_changes", None)
+    taken = session.info.pop("ip_taken", None)
+    pools = _cached_pools()
+    if taken and pools:
+        pools.apply(taken, ())
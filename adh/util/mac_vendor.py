@@ -0,0 +1,92 @@
+"""
+Name of the vendor of a device, found from the OUI (the first 24 bits) of
+its mac address.
+
+Each worker keeps the mac_vendors table in a dict keyed by the prefix (as
+an integer), loaded with a single query on first use. It is loaded again
+after this worker commits a write to mac_vendors, and every
+VENDOR_INDEX_MAX_AGE seconds for the writes of the others.
+"""
+import string
+import threading
+import time
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from adh.model.database import Database as db
+from adh.model.models import MacVendor
+
+CACHE = "mac_vendors"
+
+
+def oui(value):
+    """ The first 24 bits of a mac address or prefix, None if invalid """
+    digits = [c for c in value or "" if c in string.hexdigits]
+    if len(digits) < 6:
+        return None
+    return int("".join(digits[:6]), 16)
+
+
+class VendorIndex():
+    """ OUI -> name of the vendor """
+
+    def __init__(self, max_age, clock=time.monotonic):
+        self.max_age = max_age
+        self.clock = clock
+        self.vendors = {}
+        self.dirty = True
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def stale(self):
+        return self.dirty or self._loaded_at + self.max_age <= self.clock()
+
+    def load(self, rows):
+        """ rows is an iterable of (prefix, name) """
+        vendors = {}
+        for prefix, name in rows:
+            key = oui(prefix)
+            if key is not None and name:
+                vendors[key] = name
+        with self._lock:
+            self.vendors = vendors
+            self.dirty = False
+            self._loaded_at = self.clock()
+
+    def lookup(self, mac):
+        """ Return the vendor of the mac address, None if unknown """
+        return self.vendors.get(oui(mac))
+
+
+def get_index(s):
+    """ Return the index of the worker, loaded again if needed """
+    index = db.get_db().get_cache(CACHE, lambda: VendorIndex(
+        current_app.config.get("VENDOR_INDEX_MAX_AGE", 3600)))
+    if index.stale():
+        index.load(s.query(MacVendor.prefix, MacVendor.nom))
+    return index
+
+
+def _after_write(mapper, connection, target):
+    session = Session.object_session(target)
+    if session is not None:
+        session.info["mac_vendors_written"] = True
+
+
+for _event in ("after_insert", "after_update", "after_delete"):
+    event.listen(MacVendor, _event, _after_write)
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session):
+    # Not before the commit, the index could be loaded without the write
+    if session.info.pop("mac_vendors_written", False):
+        database = db.get_db()
+        index = database and database.caches.get(CACHE)
+        if index is not None:
+            index.dirty = True
+
+
+@event.listens_for(Session, "after_rollback")
+def _after_rollback(session):
+    session.info.pop("mac_vendors_written", None)
@@ -0,0 +1,73 @@
+import base64
+import json
+from sqlalchemy import and_, or_
+from adh.exceptions import InvalidCursor
+
+
+def encode_cursor(values):
+    """ Build an opaque cursor from the sort key of the last row of a page """
+    data = json.dumps(list(values), separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+
+def decode_cursor(cursor, length):
+    """ Get back the sort key stored in a cursor """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, TypeError):
+        raise InvalidCursor()
+    if not isinstance(values, list) or len(values) != length:
+        raise InvalidCursor()
+    # The values end up in the SQL comparison of after()
+    for value in values:
+        if isinstance(value, bool) or not isinstance(value, (str, int)):
+            raise InvalidCursor()
+    return values
+
+
+def after(keys, values):
+    """
+    Return a filter selecting the rows that come strictly after values when
+    ordering by keys: (k1, k2, ...) > (v1, v2, ...)
+    (Row value comparison is not supported everywhere, so expand it.)
+    """
+    clauses = []
+    for i, (key, value) in enumerate(zip(keys, values)):
+        equal = [k == v for k, v in zip(keys[:i], values[:i])]
+        clauses.append(and_(*equal, key > value))
+    return or_(*clauses)
+
+
+def paginate(q, keys, row_key, limit, offset=0, cursor=None):
+    """
+    Order q by keys and return one page of it as (rows, next_cursor).
+
+    If a cursor is given, the page starts right after the row it points to
+    (keyset pagination, offset is ignored). Otherwise the classic offset is
+    used. next_cursor is None when there is no page after this one.
+
+    row_key(row) must return the values of keys for a row of the result.
+    """
+    q = q.order_by(*[k.asc() for k in keys])
+    if cursor:
+        q = q.filter(after(keys, decode_cursor(cursor, len(keys))))
+    else:
+        q = q.offset(offset)
+    rows = q.limit(limit).all()
+
+    next_cursor = None
+    if limit and len(rows) == limit:
+        next_cursor = encode_cursor(row_key(rows[-1]))
+    return rows, next_cursor
+
+
+def page_headers(count, next_cursor):
+    """ Headers describing a page of results (count can be None) """
+    headers = {
+        "access-control-expose-headers": "X-Total-Count, X-Next-Cursor",
+    }
+    if count is not None:
+        headers["X-Total-Count"] = str(count)
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    return headers
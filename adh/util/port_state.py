@@ -0,0 +1,256 @@
+"""
+In-memory snapshot of the state (enabled, VLAN) of the ports of the switches.
+
+Each worker runs a background thread that walks every switch once every
+SNMP_POLL_INTERVAL seconds (0 disables it). A snapshot older than
+SNMP_PORT_MAX_AGE seconds is never served, the switch is read again instead.
+The values written to a switch are applied to the snapshot right away.
+"""
+import logging
+import os
+import threading
+import time
+from flask import current_app
+from adh.model.database import Database as db
+from adh.model.models import Switch
+from adh.snmp import AsyncSNMPManager, PortState, SNMPError, SNMPManager, \
+        IF_ADMIN_STATUS, MAX_VAR_BINDS, VM_VLAN, batch_port_states, fan_out, \
+        run
+
+UNKNOWN = PortState(oper_status=None, admin_status=None, vlan=None)
+
+# Column written for each field of PortState
+COLUMNS = {
+    "admin_status": IF_ADMIN_STATUS,
+    "vlan": VM_VLAN,
+}
+
+
+class PortStateCache():
+    """ Switch id -> {Port.oid: PortState} snapshots """
+
+    def __init__(self, max_age, clock=time.monotonic):
+        self.max_age = max_age
+        self.clock = clock
+        self._snapshots = {}
+        # Values written since the snapshots being read were started
+        self._writes = {}
+        self._lock = threading.Lock()
+
+    def get(self, switch_id):
+        """ Return the snapshot of the switch, None if absent or too old """
+        with self._lock:
+            entry = self._snapshots.get(switch_id)
+            if entry is None or entry[0] + self.max_age <= self.clock():
+                return None
+            return entry[1]
+
+    def store(self, switch_id, states, taken_at):
+        """
+        Store a snapshot of the switch, read from the time taken_at. The
+        values written since then are applied to it.
+        """
+        with self._lock:
+            current = self._snapshots.get(switch_id)
+            if current is not None and current[0] > taken_at:
+                return
+            writes = [w for w in self._writes.get(switch_id, ())
+                      if w[0] >= taken_at]
+            self._writes[switch_id] = writes
+            states = dict(states)
+            for _, oid, field, value in writes:
+                states[oid] = states.get(oid, UNKNOWN)._replace(
+                    **{field: value})
+            self._snapshots[switch_id] = (taken_at, states)
+
+    def update(self, switch_id, oid, field, value):
+        """ Apply a value that was written to the switch """
+        with self._lock:
+            now = self.clock()
+            writes = [w for w in self._writes.get(switch_id, ())
+                      if w[0] + self.max_age > now]
+            writes.append((now, oid, field, value))
+            self._writes[switch_id] = writes
+
+            entry = self._snapshots.get(switch_id)
+            if entry is not None:
+                # Copy on write, the readers keep a consistent snapshot
+                states = dict(entry[1])
+                states[oid] = states.get(oid, UNKNOWN)._replace(
+                    **{field: value})
+                self._snapshots[switch_id] = (entry[0], states)
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+            self._writes.clear()
+
+
+def get_state_cache():
+    """ Return the port state cache of this worker """
+    max_age = current_app.config.get("SNMP_PORT_MAX_AGE", 30)
+    return db.get_db().get_cache(
+        "port_states",
+        lambda: PortStateCache(max_age)
+    )
+
+
+def snmp_port():
+    return current_app.config.get("SNMP_PORT", 161)
+
+
+def refresh_switch(switch):
+    """ Read the state of all the ports of switch, and cache it """
+    cache = get_state_cache()
+    taken_at = cache.clock()
+    manager = SNMPManager(switch.ip, switch.communaute, snmp_port())
+    states = manager.port_states()
+    cache.store(switch.id, states, taken_at)
+    return cache.get(switch.id) or states
+
+
+def get_port_state(port):
+    """
+    Return the PortState of port, from the snapshot of its switch if it is
+    recent enough. Raises SNMPError if the switch does not answer.
+    """
+    ensure_poller()
+    states = get_state_cache().get(port.switch_id)
+    if states is None:
+        states = refresh_switch(port.switch)
+    return states.get(port.oid, UNKNOWN)
+
+
+def set_port_value(port, field, value):
+    """
+    Write a field of the PortState of port to the switch and to the cache.
+    Raises SNMPError if the switch refused it or did not answer.
+    """
+    switch = port.switch
+    manager = SNMPManager(switch.ip, switch.communaute, snmp_port())
+    result = manager.change_value(COLUMNS[field] + ".", port.oid, value)
+    if isinstance(result, SNMPError):
+        raise result
+    get_state_cache().update(switch.id, port.oid, field, int(result))
+
+
+async def _set_in_chunks(manager, changes):
+    """
+    Send changes with as few SET requests as possible. Returns the new value
+    of each change, or the SNMPError of the request that contained it.
+    """
+    results = []
+    for i in range(0, len(changes), MAX_VAR_BINDS):
+        chunk = changes[i:i + MAX_VAR_BINDS]
+        try:
+            results += await manager.set(chunk)
+        except SNMPError as e:
+            results += [e] * len(chunk)
+    return results
+
+
+def set_port_values(port_values, field):
+    """
+    Write a field of the PortState of many ports, port_values being a list of
+    (port, value). The ports of each switch are written together, and the
+    switches concurrently. Returns a list with None for each port that was
+    written, or the SNMPError that prevented it.
+    """
+    by_switch = {}
+    for port, value in port_values:
+        by_switch.setdefault(port.switch_id, []).append((port, value))
+
+    jobs = {}
+    for switch_id, changes in by_switch.items():
+        switch = changes[0][0].switch
+        manager = AsyncSNMPManager(switch.ip, switch.communaute, snmp_port())
+        oids = [(COLUMNS[field] + "." + port.oid, value)
+                for port, value in changes]
+        jobs[switch_id] = (
+            lambda m=manager, o=oids: _set_in_chunks(m, o)
+        )
+    results = run(fan_out(jobs))
+
+    cache = get_state_cache()
+    errors = {}
+    for switch_id, changes in by_switch.items():
+        values = results[switch_id]
+        if isinstance(values, SNMPError):
+            values = [values] * len(changes)
+        for (port, _), value in zip(changes, values):
+            if isinstance(value, SNMPError):
+                errors[port.id] = value
+            else:
+                cache.update(switch_id, port.oid, field, int(value))
+    return [errors.get(port.id) for port, _ in port_values]
+
+
+def poll_switches():
+    """ Snapshot the ports of every switch into the cache """
+    s = db.get_db().get_session()
+    switches = s.query(Switch.id, Switch.ip, Switch.communaute).all()
+
+    cache = get_state_cache()
+    taken_at = cache.clock()
+    results = batch_port_states({
+        switch.id: (AsyncSNMPManager(switch.ip, switch.communaute,
+                                     snmp_port()), None)
+        for switch in switches
+    })
+    for switch_id, states in results.items():
+        if isinstance(states, SNMPError):
+            logging.warning("Could not poll switch %s: %s", switch_id,
+                            states.value)
+            continue
+        cache.store(switch_id, states, taken_at)
+    return results
+
+
+class PortPoller(threading.Thread):
+    """ Calls poll_switches() every interval seconds """
+
+    def __init__(self, app, interval):
+        super().__init__(name="port-poller", daemon=True)
+        self.app = app
+        self.interval = interval
+        self.pid = os.getpid()
+        self.stopped = threading.Event()
+
+    def run(self):
+        with self.app.app_context():
+            while not self.stopped.is_set():
+                start = time.monotonic()
+                try:
+                    poll_switches()
+                except Exception:
+                    logging.exception("Could not poll the switches")
+                finally:
+                    db.get_db().remove_session()
+                elapsed = time.monotonic() - start
+                self.stopped.wait(max(0, self.interval - elapsed))
+
+    def stop(self):
+        self.stopped.set()
+
+
+_poller = None
+_poller_lock = threading.Lock()
+
+
+def ensure_poller():
+    """
+    Start the poller of this worker if needed. It is started lazily because
+    uWSGI forks the workers after loading the application, and the threads
+    do not survive a fork.
+    """
+    global _poller
+    config = current_app.config
+    interval = config.get("SNMP_POLL_INTERVAL", 0)
+    if not interval or config["TESTING"]:
+        return None
+    with _poller_lock:
+        if _poller is None or _poller.pid != os.getpid() \
+                or not _poller.is_alive():
+            _poller = PortPoller(current_app._get_current_object(), interval)
+            _poller.start()
+        return _poller
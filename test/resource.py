@@ -1,3 +1,6 @@
+from contextlib import contextmanager
+from sqlalchemy import event
+
 base_url = "api"
 device_cazal = {
     'mac': 'FF:FF:FF:FF:FF:FF',
@@ -46,3 +49,33 @@ INVALID_MAC = [
 ]
 
 TEST_HEADERS = {"Authorization": "Bearer TEST_TOKEN"}
+
+
+@contextmanager
+def count_queries(engine):
+    """ Count the SQL statements sent to the database inside the block """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+@contextmanager
+def count_commits(engine):
+    """ Count the transactions committed inside the block """
+    commits = []
+
+    def commit(conn):
+        commits.append(conn)
+
+    event.listen(engine, "commit", commit)
+    try:
+        yield commits
+    finally:
+        event.remove(engine, "commit", commit)
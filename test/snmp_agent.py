@@ -0,0 +1,102 @@
+import bisect
+import socket
+import threading
+import time
+from pyasn1.codec.ber import decoder, encoder
+from pysnmp.proto import api
+
+
+class FakeSwitch():
+    """
+    Minimal SNMP v2c agent standing in for a switch in the tests.
+    It answers GET, GETNEXT, GETBULK and SET requests from an oid -> int dict,
+    after waiting delay seconds (like a slow switch CPU).
+    """
+
+    def __init__(self, values=None, community="public", delay=0):
+        self.values = dict(values or {})
+        self.community = community
+        self.delay = delay
+        self.requests = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.settimeout(0.05)
+        self.port = self.sock.getsockname()[1]
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self.sock.close()
+
+    def _next(self, oid):
+        keys = sorted(tuple(map(int, o.split("."))) for o in self.values)
+        i = bisect.bisect_right(keys, tuple(oid))
+        if i == len(keys):
+            return None
+        return ".".join(map(str, keys[i]))
+
+    def _serve(self):
+        while not self._stop.is_set():
+            try:
+                data, address = self.sock.recvfrom(65535)
+            except socket.timeout:
+                continue
+            response = self._handle(data)
+            if self.delay:
+                time.sleep(self.delay)
+            if response is not None:
+                self.sock.sendto(response, address)
+
+    def _handle(self, data):
+        if int(api.decodeMessageVersion(data)) != api.protoVersion2c:
+            return None
+        pMod = api.protoModules[api.protoVersion2c]
+        request, _ = decoder.decode(data, asn1Spec=pMod.Message())
+        if str(pMod.apiMessage.getCommunity(request)) != self.community:
+            return None
+        self.requests += 1
+
+        response = pMod.apiMessage.getResponse(request)
+        reqPDU = pMod.apiMessage.getPDU(request)
+        rspPDU = pMod.apiMessage.getPDU(response)
+        varBinds = []
+
+        if reqPDU.isSameTypeWith(pMod.SetRequestPDU()):
+            for oid, value in pMod.apiPDU.getVarBinds(reqPDU):
+                self.values[str(oid)] = int(value)
+                varBinds.append((oid, value))
+
+        elif reqPDU.isSameTypeWith(pMod.GetRequestPDU()):
+            for oid, _ in pMod.apiPDU.getVarBinds(reqPDU):
+                value = self.values.get(str(oid))
+                if value is None:
+                    varBinds.append((oid, pMod.NoSuchObject()))
+                else:
+                    varBinds.append((oid, pMod.Integer(value)))
+
+        elif reqPDU.isSameTypeWith(pMod.GetNextRequestPDU()):
+            for oid, _ in pMod.apiPDU.getVarBinds(reqPDU):
+                varBinds.append(self._next_var_bind(pMod, oid))
+
+        elif reqPDU.isSameTypeWith(pMod.GetBulkRequestPDU()):
+            repetitions = pMod.apiBulkPDU.getMaxRepetitions(reqPDU)
+            oids = [o for o, _ in pMod.apiBulkPDU.getVarBinds(reqPDU)]
+            for _ in range(repetitions):
+                row = [self._next_var_bind(pMod, oid) for oid in oids]
+                varBinds += row
+                oids = [o for o, _ in row]
+
+        pMod.apiPDU.setVarBinds(rspPDU, varBinds)
+        return encoder.encode(response)
+
+    def _next_var_bind(self, pMod, oid):
+        nxt = self._next(oid)
+        if nxt is None:
+            return (oid, pMod.EndOfMibView())
+        return (pMod.ObjectIdentifier(nxt), pMod.Integer(self.values[nxt]))
@@ -0,0 +1,197 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+import requests.exceptions
+from adh import auth
+from adh.model.database import Database as db
+from adh.model.models import Utilisateur
+from CONFIGURATION import TEST_DATABASE as db_settings
+
+from .resource import count_queries
+
+
+class FakeAuthHandler(BaseHTTPRequestHandler):
+    """ Stand-in for the /api/me endpoint of the OAuth server """
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    # Authorization headers received
+    calls = []
+    # The "hang" token is answered once this is set
+    released = threading.Event()
+
+    def do_GET(self):
+        token = self.headers["Authorization"]
+        self.calls.append(token)
+        if token == "Bearer valid":
+            status, body = 200, {"uid": "bonnet_n", "groups": ["adh6_user"]}
+        elif token == "Bearer error":
+            status, body = 503, {}
+        elif token == "Bearer hang":
+            self.released.wait(2)
+            status, body = 200, {}
+        else:
+            status, body = 401, {}
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def local_auth_server():
+    FakeAuthHandler.calls = []
+    FakeAuthHandler.released = threading.Event()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeAuthHandler)
+    t = threading.Thread(target=server.serve_forever, args=(0.05,),
+                         daemon=True)
+    t.start()
+    yield "http://127.0.0.1:{}".format(server.server_port)
+    FakeAuthHandler.released.set()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def prod_context(monkeypatch):
+    from .context import app
+    monkeypatch.setitem(app.app.config, "TESTING", False)
+    monkeypatch.setitem(app.app.config, "AUTH_SERVER_ADDRESS", "http://auth")
+    monkeypatch.setattr(auth, "_token_cache", None)
+    with app.app.test_request_context():
+        yield
+
+
+@pytest.fixture
+def auth_server(monkeypatch):
+    calls = []
+
+    def fake_request_groups(token):
+        calls.append(token)
+        if token == "timeout":
+            raise requests.exceptions.ReadTimeout()
+        if token == "valid":
+            return {"uid": "bonnet_n", "groups": ["adh6_user"]}
+        return None
+
+    monkeypatch.setattr(auth, "_request_groups", fake_request_groups)
+    yield calls
+
+
+def test_auth_token_info_cached(prod_context, auth_server):
+    for _ in range(3):
+        infos = auth.token_info("valid")
+        assert infos["uid"] == "bonnet_n"
+        assert infos["groups"] == ["adh6_user"]
+    assert auth_server == ["valid"]
+    assert auth.get_token_cache().hits == 2
+
+
+def test_auth_invalid_token_cached(prod_context, auth_server):
+    assert auth.token_info("invalid") is None
+    assert auth.token_info("invalid") is None
+    assert auth_server == ["invalid"]
+
+
+def test_auth_timeout_not_cached(prod_context, auth_server):
+    assert auth.token_info("timeout") is None
+    assert auth.token_info("timeout") is None
+    assert auth_server == ["timeout", "timeout"]
+
+
+def test_auth_token_not_stored_in_clear(prod_context, auth_server):
+    auth.token_info("valid")
+    assert "valid" not in auth.get_token_cache()
+
+
+def test_auth_client_reuses_connections(local_auth_server):
+    client = auth.AuthClient(local_auth_server)
+    for _ in range(10):
+        assert client.get_groups("valid")["uid"] == "bonnet_n"
+    assert client.get_groups("invalid") is None
+
+    stats = client.stats()
+    assert stats["requests"] == 11
+    assert stats["connections"] == 1
+    assert stats["reused"] == 10
+    client.close()
+
+
+def test_auth_client_server_error(prod_context, local_auth_server,
+                                  monkeypatch):
+    """ Retried, then neither an invalid token nor cached """
+    client = auth.AuthClient(local_auth_server, retries=1, backoff=0)
+    with pytest.raises(requests.exceptions.HTTPError):
+        client.get_groups("error")
+    assert FakeAuthHandler.calls == ["Bearer error"] * 2
+
+    monkeypatch.setattr(auth, "_auth_client", client)
+    assert auth.token_info("error") is None
+    assert auth._token_key("error") not in auth.get_token_cache()
+    client.close()
+
+
+def test_auth_client_read_timeout_not_retried(local_auth_server):
+    client = auth.AuthClient(local_auth_server, retries=2, timeout=0.2)
+    with pytest.raises(requests.exceptions.RequestException):
+        client.get_groups("hang")
+    FakeAuthHandler.released.set()
+    assert FakeAuthHandler.calls == ["Bearer hang"]
+    client.close()
+
+
+def test_auth_token_info_through_client(prod_context, local_auth_server,
+                                        monkeypatch):
+    monkeypatch.setattr(auth, "_auth_client",
+                        auth.AuthClient(local_auth_server))
+    assert auth.token_info("valid")["uid"] == "bonnet_n"
+    assert auth.token_info("invalid") is None
+    assert auth.get_auth_client().stats()["connections"] == 1
+
+
+@pytest.fixture
+def db_context():
+    from .context import app
+    with app.app.test_request_context():
+        db.init_db(db_settings, testing=True)
+        yield db.get_db().get_session()
+
+
+def test_auth_get_admin_created_not_cached(db_context):
+    s = db_context
+    admin = auth.get_admin(s, "bonnet_n")
+    assert isinstance(admin, Utilisateur)
+    assert "bonnet_n" not in auth.get_admin_cache()
+
+
+def test_auth_get_admin_cached(db_context):
+    s = db_context
+    admin_id = Utilisateur.find_or_create(s, "bonnet_n").id
+    s.commit()
+
+    admin = auth.get_admin(s, "bonnet_n")
+    assert admin == auth.AdminHandle(admin_id, "bonnet_n")
+
+    with count_queries(db.get_db().engine) as statements:
+        for _ in range(5):
+            assert auth.get_admin(s, "bonnet_n").id == admin_id
+    assert statements == []
+
+
+def test_auth_admin_cache_dropped_with_database(db_context):
+    s = db_context
+    Utilisateur.find_or_create(s, "bonnet_n")
+    s.commit()
+    auth.get_admin(s, "bonnet_n")
+    assert "bonnet_n" in auth.get_admin_cache()
+
+    db.init_db(db_settings, testing=True)
+    assert "bonnet_n" not in auth.get_admin_cache()
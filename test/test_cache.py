@@ -0,0 +1,53 @@
+from adh.util.cache import TTLCache
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_cache_hit_and_miss():
+    c = TTLCache(maxsize=2, ttl=10)
+    assert c.get("a") is None
+    c.set("a", 1)
+    assert c.get("a") == 1
+    assert c.hits == 1
+    assert c.misses == 1
+
+
+def test_cache_expiration():
+    clock = FakeClock()
+    c = TTLCache(maxsize=2, ttl=10, clock=clock)
+    c.set("a", 1)
+    c.set("b", 2, ttl=1)
+    clock.now = 5
+    assert c.get("a") == 1
+    assert "b" not in c
+    assert c.get("b") is None
+    clock.now = 10
+    assert c.get("a") is None
+
+
+def test_cache_lru_eviction():
+    c = TTLCache(maxsize=2, ttl=10)
+    c.set("a", 1)
+    c.set("b", 2)
+    c.get("a")  # "b" is now the least recently used
+    c.set("c", 3)
+    assert "a" in c
+    assert "b" not in c
+    assert "c" in c
+    assert len(c) == 2
+
+
+def test_cache_invalidate_and_clear():
+    c = TTLCache(maxsize=2, ttl=10)
+    c.set("a", 1)
+    c.invalidate("a")
+    assert c.get("a") is None
+    c.set("a", 1)
+    c.clear()
+    assert c.stats() == {"size": 0, "maxsize": 2, "hits": 0, "misses": 0}
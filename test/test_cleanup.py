@@ -0,0 +1,97 @@
+import datetime
+import pytest
+from adh.cleanup import cleanup
+from adh.model.database import Database as db
+from adh.model.models import Adherent, Adhesion, Device, Modification, \
+        Ordinateur, Portable, Utilisateur
+from CONFIGURATION import TEST_DATABASE as db_settings
+
+from .resource import count_queries
+
+NOW = datetime.datetime(2019, 9, 1)
+
+
+def member(login, departure=None, memberships=()):
+    a = Adherent(nom=login, prenom=login, mail=login + "@free.fr",
+                 login=login, password="a", date_de_depart=departure)
+    return [a] + [
+        Adhesion(adherent=a, depart=start, fin=end)
+        for start, end in memberships
+    ]
+
+
+@pytest.fixture
+def session():
+    db.init_db(db_settings, testing=True)
+    s = db.get_db().get_session()
+    start, end = datetime.datetime(2018, 9, 1), datetime.datetime(2019, 6, 30)
+    year = (start, end)
+    next_year = (end, end + datetime.timedelta(days=366))
+    rows = (
+        # Left
+        member("departed", departure=datetime.date(2019, 6, 30)) +
+        member("ended", memberships=[year]) +
+        # Still members
+        member("renewed", departure=datetime.date(2019, 6, 30),
+               memberships=[year, next_year]) +
+        member("staying", departure=datetime.date(2020, 6, 30)) +
+        member("unknown")
+    )
+    s.add_all(rows)
+    for i, a in enumerate(r for r in rows if isinstance(r, Adherent)):
+        s.add(Ordinateur(mac="00:00:00:00:00:{:02X}".format(i),
+                         ip="192.168.0.{}".format(i + 1), ipv6="fe80::1",
+                         adherent=a))
+        s.add(Portable(mac="00:00:00:00:01:{:02X}".format(i), adherent=a))
+    s.add(Utilisateur(login="cleanup"))
+    s.commit()
+    yield s
+
+
+def admin(s):
+    return s.query(Utilisateur).filter(Utilisateur.login == "cleanup").one()
+
+
+def logins(s, cls):
+    q = s.query(Adherent.login).join(cls, cls.adherent_id == Adherent.id)
+    return sorted(set(login for login, in q))
+
+
+def test_cleanup(session):
+    devices, _, _ = cleanup(session, admin(session), NOW)
+    assert sorted(devices) == [
+        ("departed", "00:00:00:00:00:00"),
+        ("departed", "00:00:00:00:01:00"),
+        ("ended", "00:00:00:00:00:01"),
+        ("ended", "00:00:00:00:01:01"),
+    ]
+    for cls in (Ordinateur, Portable, Device):
+        assert logins(session, cls) == ["renewed", "staying", "unknown"]
+
+    modifications = session.query(Modification).all()
+    assert len(modifications) == 4
+    assert all(m.utilisateur_id == admin(session).id for m in modifications)
+    assert "ip:\n- 192.168.0.1\n- \n" in modifications[0].action
+
+
+def test_cleanup_dry_run(session):
+    devices, _, _ = cleanup(session, admin(session), NOW, dry_run=True)
+    assert len(devices) == 4
+    assert session.query(Ordinateur).count() == 5
+    assert session.query(Modification).count() == 0
+
+
+def test_cleanup_set_based(session):
+    """ The statements do not depend on the number of devices """
+    s = session
+    s.add_all(member("departed2", departure=datetime.date(2019, 6, 30)))
+    s.commit()
+    a = Adherent.find(s, "departed2")
+    s.add_all([Portable(mac="00:00:00:00:02:{:02X}".format(i), adherent=a)
+               for i in range(50)])
+    s.commit()
+
+    with count_queries(db.get_db().engine) as statements:
+        devices, _, _ = cleanup(s, admin(s), NOW)
+    assert len(devices) == 54
+    assert len(statements) < 20
@@ -0,0 +1,150 @@
+import json
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+from adh.model.database import Database, PoolMetrics, engine_options
+from adh.model.models import Switch
+
+from .resource import base_url, TEST_HEADERS, count_queries
+
+MYSQL = {"drivername": "mysql+mysqldb", "host": "db", "database": "adh6"}
+SQLITE = {"drivername": "sqlite", "database": ":memory:"}
+
+POOL = {
+    "pool_size": 8,
+    "max_overflow": 2,
+    "pool_timeout": 5,
+    "pool_pre_ping": True,
+    "pool_use_lifo": True,
+}
+
+
+def test_engine_options_default():
+    assert engine_options(MYSQL) == {"pool_recycle": 3600}
+
+
+def test_engine_options_mysql():
+    assert engine_options(MYSQL, POOL) == dict(POOL, pool_recycle=3600)
+
+
+def test_engine_options_sqlite():
+    """ SQLite does not use a QueuePool, the sizing options are dropped """
+    assert engine_options(SQLITE, POOL) == {"pool_recycle": 3600,
+                                            "pool_pre_ping": True}
+
+
+def test_database_pool_settings():
+    database = Database(SQLITE, testing=True, pool=POOL)
+    assert database.engine.pool._pre_ping
+    database.remove_session()
+
+
+@pytest.fixture
+def queue_engine():
+    engine = create_engine("sqlite://", poolclass=QueuePool, pool_size=1,
+                           max_overflow=1, pool_timeout=0.1)
+    yield engine
+    engine.dispose()
+
+
+def test_pool_metrics(queue_engine):
+    metrics = PoolMetrics(queue_engine)
+    c1 = queue_engine.connect()
+    c2 = queue_engine.connect()
+    stats = metrics.stats()
+    assert stats["capacity"] == 2
+    assert stats["checked_out"] == 2
+    assert stats["overflow"] == 1
+    assert stats["exhausted"] == 1
+
+    with pytest.raises(TimeoutError):
+        queue_engine.connect()
+
+    c1.close()
+    c2.close()
+    stats = metrics.stats()
+    assert stats["checked_out"] == 0
+    assert stats["checkouts"] == 2
+    assert stats["peak_checked_out"] == 2
+    assert stats["peak_overflow"] == 1
+
+
+def test_pool_metrics_invalidations(queue_engine):
+    metrics = PoolMetrics(queue_engine)
+    conn = queue_engine.connect()
+    conn.invalidate()
+    conn.close()
+    assert metrics.stats()["invalidations"] == 1
+
+
+def test_database_transaction_modes():
+    assert Database(SQLITE).transactions == "native"
+    assert Database(SQLITE, testing=True).transactions == "savepoint"
+    with pytest.raises(ValueError):
+        Database(SQLITE, transactions="autocommit")
+
+
+def switch_client(transactions):
+    from .context import app
+    Database.init_db(SQLITE, testing=True, transactions=transactions)
+    s = Database.get_db().get_session()
+    s.add(Switch(id=1, description="Switch", ip="192.168.102.2",
+                 communaute="communaute"))
+    s.commit()
+    s.commit()
+    return app.app.test_client()
+
+
+def update_switch(client, description):
+    body = {"description": description, "ip": "192.168.102.2",
+            "community": "communaute"}
+    return client.put("{}/switch/1".format(base_url), data=json.dumps(body),
+                      content_type='application/json', headers=TEST_HEADERS)
+
+
+@pytest.mark.parametrize("transactions,expected", [
+    ("savepoint", 0),
+    ("native", 1),
+])
+def test_database_first_commit(transactions, expected):
+    """
+    In savepoint mode, the first commit of the thread only releases the
+    SAVEPOINT: the write is lost when the session is removed.
+    """
+    Database.init_db(SQLITE, testing=True, transactions=transactions)
+    s = Database.get_db().get_session()
+    s.add(Switch(description="Switch", ip="192.168.102.2",
+                 communaute="communaute"))
+    s.commit()
+    Database.get_db().remove_session()
+
+    s = Database.get_db().get_session()
+    assert s.query(Switch).count() == expected
+
+
+def statements_per_request(transactions):
+    with switch_client(transactions) as c:
+        c.get("{}/switch/1".format(base_url), headers=TEST_HEADERS)
+        update_switch(c, "Warm up")
+        engine = Database.get_db().engine
+        with count_queries(engine) as reads:
+            c.get("{}/switch/1".format(base_url), headers=TEST_HEADERS)
+        with count_queries(engine) as writes:
+            update_switch(c, "Modified")
+    return reads, writes
+
+
+def test_database_statements_per_request():
+    """
+    On SQLite, the savepoint mode emits BEGIN itself. The native mode
+    relies on the driver, like MySQLdb does (no BEGIN statement at all).
+    """
+    before = statements_per_request("savepoint")
+    after = statements_per_request("native")
+    print("statements per request: GET {} -> {}, PUT {} -> {}".format(
+        len(before[0]), len(after[0]), len(before[1]), len(after[1])))
+    assert "BEGIN" in before[0]
+    assert "BEGIN" not in after[0] + after[1]
+    assert len(after[0]) < len(before[0])
+    assert len(after[1]) < len(before[1])
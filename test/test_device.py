@@ -1,12 +1,19 @@
+import datetime
 import json
 
 import pytest
+from sqlalchemy import func
 from adh.model.database import Database as db
 from CONFIGURATION import TEST_DATABASE as db_settings
-from adh.model.models import Ordinateur, Portable, Adherent
+from adh.model.models import Ordinateur, Portable, Adherent, Device, \
+        Chambre, Vlan, MacVendor
+from adh.model.models import Utilisateur, Modification
+from adh.util.mac_vendor import oui
+from adh.util.pagination import encode_cursor
 
 from .resource import (
-    base_url, INVALID_MAC, INVALID_IP, INVALID_IPv6, TEST_HEADERS
+    base_url, INVALID_MAC, INVALID_IP, INVALID_IPv6, TEST_HEADERS,
+    count_queries, count_commits,
 )
 
 
@@ -196,6 +203,73 @@ def test_device_filter_hit_limit(api_client, member1):
     assert len(response) == LIMIT
 
 
+def test_device_filter_with_cursor(api_client, member1):
+    s = db.get_db().get_session()
+    LIMIT = 7
+
+    for i in range(LIMIT*3):
+        suffix = "{0:04X}".format(i)
+        dev = Portable(
+            adherent=member1,
+            mac='00:00:00:00:'+suffix[:2]+":"+suffix[2:]
+        )
+        s.add(dev)
+    s.commit()
+
+    r = api_client.get(
+        '{}/device/?limit={}'.format(base_url, 1000),
+        headers=TEST_HEADERS,
+    )
+    expected = [d['mac'] for d in json.loads(r.data.decode('utf-8'))]
+
+    macs = []
+    url = '{}/device/?limit={}'.format(base_url, LIMIT)
+    while url:
+        r = api_client.get(url, headers=TEST_HEADERS)
+        assert r.status_code == 200
+        macs += [d['mac'] for d in json.loads(r.data.decode('utf-8'))]
+        url = None
+        if 'X-Next-Cursor' in r.headers:
+            url = '{}/device/?limit={}&cursor={}'.format(
+                base_url, LIMIT, r.headers['X-Next-Cursor'])
+
+    assert macs == expected
+    assert len(macs) == LIMIT*3 + 2
+
+
+def test_device_filter_with_invalid_cursor(api_client):
+    r = api_client.get(
+        '{}/device/?cursor={}'.format(base_url, 'W10='),  # "[]"
+        headers=TEST_HEADERS,
+    )
+    assert r.status_code == 400
+
+
+@pytest.mark.parametrize('values', [
+    [{'x': 1}, 1],
+    [None, 1],
+    [['a'], 1],
+    [True, 1],
+])
+def test_device_filter_with_tampered_cursor(api_client, values):
+    cursor = encode_cursor(values)
+    r = api_client.get(
+        '{}/device/?cursor={}'.format(base_url, cursor),
+        headers=TEST_HEADERS,
+    )
+    assert r.status_code == 400
+
+
+def test_device_filter_estimated_count(api_client):
+    # SQLite has no table statistics, the count is computed then cached
+    r = api_client.get(
+        '{}/device/?totalCount={}'.format(base_url, 'estimate'),
+        headers=TEST_HEADERS,
+    )
+    assert r.status_code == 200
+    assert r.headers['X-Total-Count'] == '2'
+
+
 def test_device_put_create_wireless_without_ip(api_client,
                                                wireless_device_dict):
     ''' Can create a valid wireless device ? '''
@@ -218,8 +292,16 @@ def test_device_put_create_wireless(api_client, wireless_device_dict):
     assert r.status_code == 201
 
 
-def test_device_put_create_wired_without_ip(api_client, wired_device_dict):
+def give_room(member):
+    member.chambre = Chambre(numero=1234, vlan=Vlan(
+        numero=42, adresses="192.168.42.0/24", adressesv6="fe80::/64"))
+    db.get_db().get_session().commit()
+
+
+def test_device_put_create_wired_without_ip(api_client, member1,
+                                            wired_device_dict):
     ''' Can create a valid wired device ? '''
+    give_room(member1)
     del wired_device_dict['ipAddress']
     r = api_client.put('{}/device/{}'.format(base_url,
                                              wired_device_dict['mac']),
@@ -228,6 +310,24 @@ def test_device_put_create_wired_without_ip(api_client, wired_device_dict):
                        headers=TEST_HEADERS)
     assert r.status_code == 201
 
+    s = db.get_db().get_session()
+    dev = s.query(Ordinateur).filter(
+        Ordinateur.mac == wired_device_dict['mac']).one()
+    assert dev.ip == "192.168.42.2"
+    assert dev.ipv6 == wired_device_dict['ipv6Address']
+
+
+def test_device_put_create_wired_without_room(api_client,
+                                              wired_device_dict):
+    ''' No address can be given if the owner has no room '''
+    del wired_device_dict['ipAddress']
+    r = api_client.put('{}/device/{}'.format(base_url,
+                                             wired_device_dict['mac']),
+                       data=json.dumps(wired_device_dict),
+                       content_type='application/json',
+                       headers=TEST_HEADERS)
+    assert r.status_code == 400
+
 
 def test_device_put_create_wired(api_client, wired_device_dict):
     ''' Can create a valid wired device ? '''
@@ -466,3 +566,474 @@ def test_device_delete_unexistant(api_client):
         headers=TEST_HEADERS,
     )
     assert r.status_code == 404
+
+
+def assert_device_index_in_sync():
+    s = db.get_db().get_session()
+    indexed = set(
+        (d.type, d.device_id, d.mac, d.ip, d.ipv6, d.adherent_id)
+        for d in s.query(Device)
+    )
+    expected = set(
+        ("wired", d.id, d.mac, d.ip, d.ipv6, d.adherent_id)
+        for d in s.query(Ordinateur)
+    ) | set(
+        ("wireless", d.id, d.mac, None, None, d.adherent_id)
+        for d in s.query(Portable)
+    )
+    assert indexed == expected
+
+
+def test_device_index_follows_writes(api_client, wired_device,
+                                     wireless_device, wired_device_dict,
+                                     wireless_device_dict):
+    assert_device_index_in_sync()
+
+    # Create, then change the type of a device
+    r = api_client.put(
+        '{}/device/{}'.format(base_url, wired_device_dict['mac']),
+        data=json.dumps(wired_device_dict),
+        content_type='application/json',
+        headers=TEST_HEADERS)
+    assert r.status_code == 201
+    assert_device_index_in_sync()
+
+    wireless_device_dict['mac'] = wired_device_dict['mac']
+    r = api_client.put(
+        '{}/device/{}'.format(base_url, wired_device_dict['mac']),
+        data=json.dumps(wireless_device_dict),
+        content_type='application/json',
+        headers=TEST_HEADERS)
+    assert r.status_code == 204
+    assert_device_index_in_sync()
+
+    # Update and delete
+    wired_device_dict['mac'] = wired_device.mac
+    wired_device_dict['ipAddress'] = '157.159.42.43'
+    r = api_client.put(
+        '{}/device/{}'.format(base_url, wired_device.mac),
+        data=json.dumps(wired_device_dict),
+        content_type='application/json',
+        headers=TEST_HEADERS)
+    assert r.status_code == 204
+    assert_device_index_in_sync()
+
+    r = api_client.delete(
+        '{}/device/{}'.format(base_url, wireless_device.mac),
+        headers=TEST_HEADERS,
+    )
+    assert r.status_code == 204
+    assert_device_index_in_sync()
+
+
+def test_device_written_elsewhere(api_client, member1, wired_device_dict):
+    """ A device missing from the index (written by ADH5) is found """
+    mac = wired_device_dict['mac']
+    s = db.get_db().get_session()
+    s.execute(Ordinateur.__table__.insert().values(
+        mac=mac, ip='157.159.42.43', ipv6='fe80::43',
+        adherent_id=member1.id))
+    s.commit()
+
+    url = '{}/device/{}'.format(base_url, mac)
+    r = api_client.get(url, headers=TEST_HEADERS)
+    assert r.status_code == 200
+    r = api_client.put(url, data=json.dumps(wired_device_dict),
+                       content_type='application/json',
+                       headers=TEST_HEADERS)
+    assert r.status_code == 204
+    r = api_client.delete(url, headers=TEST_HEADERS)
+    assert r.status_code == 204
+    assert api_client.get(url, headers=TEST_HEADERS).status_code == 404
+
+
+def test_device_index_rebuild(api_client):
+    s = db.get_db().get_session()
+    s.execute(Device.__table__.delete())
+    assert s.query(Device).count() == 0
+
+    Device.rebuild(s)
+    assert s.query(Device).count() == 2
+    assert_device_index_in_sync()
+
+
+def select_statements(statements):
+    return [s for s in statements if s.lstrip().upper().startswith("SELECT")]
+
+
+@pytest.fixture
+def warm_api_client(api_client):
+    """ Commit the sample data and get the testing admin in the cache """
+    s = db.get_db().get_session()
+    Utilisateur.find_or_create(s, "TestingClient")
+    s.commit()
+    api_client.get('{}/device/{}'.format(base_url, '00:00:00:00:00:00'),
+                   headers=TEST_HEADERS)
+    yield api_client
+
+
+def test_device_get_single_query(warm_api_client, wired_device):
+    mac = wired_device.mac
+    with count_queries(db.get_db().engine) as statements:
+        r = warm_api_client.get(
+            '{}/device/{}'.format(base_url, mac),
+            headers=TEST_HEADERS,
+        )
+    assert r.status_code == 200
+    assert len(select_statements(statements)) == 1
+
+
+def add_vendor(prefix, name):
+    s = db.get_db().get_session()
+    now = datetime.datetime.now()
+    s.add(MacVendor(prefix=prefix, nom=name, created_at=now, updated_at=now))
+    s.commit()
+
+
+def filter_vendors(client, query):
+    r = client.get('{}/device/?{}'.format(base_url, query),
+                   headers=TEST_HEADERS)
+    assert r.status_code == 200
+    return {d['mac']: d.get('vendor') for d in json.loads(r.data.decode())}
+
+
+@pytest.mark.parametrize('value,expected', [
+    ('96:24:F6:D0:48:A7', 0x9624F6),
+    ('96-24-f6', 0x9624F6),
+    ('9624F6', 0x9624F6),
+    ('96:24', None),
+    (None, None),
+])
+def test_device_oui(value, expected):
+    assert oui(value) == expected
+
+
+def test_device_filter_vendor(warm_api_client, wired_device,
+                              wireless_device):
+    wired_mac, wireless_mac = wired_device.mac, wireless_device.mac
+    add_vendor('96-24-F6', 'Vendor')
+    assert filter_vendors(warm_api_client, 'vendor=true') == {
+        wired_mac: 'Vendor', wireless_mac: None,
+    }
+    # Opt-in
+    assert filter_vendors(warm_api_client, '') == {
+        wired_mac: None, wireless_mac: None,
+    }
+
+    # Read again once a vendor is written
+    add_vendor('80:65:F3', 'Other vendor')
+    assert filter_vendors(warm_api_client, 'vendor=true') == {
+        wired_mac: 'Vendor', wireless_mac: 'Other vendor',
+    }
+
+
+def test_device_filter_vendor_no_query(warm_api_client):
+    """ Once loaded, the vendors of a page cost no query """
+    add_vendor('96:24:F6', 'Vendor')
+    filter_vendors(warm_api_client, 'vendor=true')
+    engine = db.get_db().engine
+    with count_queries(engine) as without:
+        filter_vendors(warm_api_client, 'limit=100')
+    with count_queries(engine) as with_vendors:
+        filter_vendors(warm_api_client, 'limit=100&vendor=true')
+    assert len(with_vendors) == len(without)
+
+
+def test_device_put_update_single_query(warm_api_client, wired_device,
+                                        wired_device_dict):
+    wired_device_dict['mac'] = wired_device.mac
+    wired_device_dict['username'] = wired_device.adherent.login
+    with count_queries(db.get_db().engine) as statements:
+        r = warm_api_client.put(
+            '{}/device/{}'.format(base_url, wired_device.mac),
+            data=json.dumps(wired_device_dict),
+            content_type='application/json',
+            headers=TEST_HEADERS)
+    assert r.status_code == 204
+    assert len(select_statements(statements)) == 1
+
+
+def test_device_put_update_new_owner_two_queries(warm_api_client,
+                                                 wireless_device,
+                                                 wireless_device_dict):
+    mac = wireless_device.mac
+    with count_queries(db.get_db().engine) as statements:
+        r = warm_api_client.put(
+            '{}/device/{}'.format(base_url, mac),
+            data=json.dumps(wireless_device_dict),
+            content_type='application/json',
+            headers=TEST_HEADERS)
+    assert r.status_code == 204
+    assert len(select_statements(statements)) == 2
+
+
+def test_device_delete_single_query(warm_api_client, wireless_device):
+    mac = wireless_device.mac
+    with count_queries(db.get_db().engine) as statements:
+        r = warm_api_client.delete(
+            '{}/device/{}'.format(base_url, mac),
+            headers=TEST_HEADERS,
+        )
+    assert r.status_code == 204
+    assert len(select_statements(statements)) == 1
+
+
+def test_device_put_update_wired_to_wireless_single_commit(
+        warm_api_client, wired_device, wireless_device_dict):
+    """ The deletion, the creation and both modifications at once """
+    mac = wired_device.mac
+    wireless_device_dict['mac'] = mac
+    with count_commits(db.get_db().engine) as commits:
+        r = warm_api_client.put(
+            '{}/device/{}'.format(base_url, mac),
+            data=json.dumps(wireless_device_dict),
+            content_type='application/json',
+            headers=TEST_HEADERS)
+    assert r.status_code == 204
+    assert len(commits) == 1
+
+
+def test_device_put_update_type_change_atomic(warm_api_client, wired_device,
+                                              wireless_device_dict):
+    """ If the new device cannot be created, the old one is not deleted """
+    mac = wired_device.mac
+    wireless_device_dict['mac'] = mac
+    wireless_device_dict['username'] = 'unknown_user'
+    r = warm_api_client.put(
+        '{}/device/{}'.format(base_url, mac),
+        data=json.dumps(wireless_device_dict),
+        content_type='application/json',
+        headers=TEST_HEADERS)
+    assert r.status_code == 400
+
+    r = warm_api_client.get('{}/device/{}'.format(base_url, mac),
+                            headers=TEST_HEADERS)
+    assert r.status_code == 200
+    assert json.loads(r.data.decode())['connectionType'] == 'wired'
+
+
+def put_devices(client, devices):
+    return client.put('{}/device/'.format(base_url),
+                      data=json.dumps(devices),
+                      content_type='application/json',
+                      headers=TEST_HEADERS)
+
+
+def delete_devices(client, macs):
+    return client.post('{}/device/delete/'.format(base_url),
+                       data=json.dumps(macs),
+                       content_type='application/json',
+                       headers=TEST_HEADERS)
+
+
+def statuses(r):
+    assert r.status_code == 200
+    return [d["status"] for d in json.loads(r.data.decode())]
+
+
+def last_actions(n):
+    s = db.get_db().get_session()
+    q = s.query(Modification.action).order_by(Modification.id.desc())
+    return [action for action, in q.limit(n)][::-1]
+
+
+def test_device_put_devices(api_client, member2, wired_device,
+                            wireless_device, wired_device_dict,
+                            wireless_device_dict):
+    give_room(member2)
+    wired_mac, wireless_mac = wired_device.mac, wireless_device.mac
+    devices = [
+        wired_device_dict,
+        wireless_device_dict,
+        # Update
+        {'mac': wired_mac, 'connectionType': 'wired',
+         'ipAddress': '157.159.42.43', 'ipv6Address': 'fe80::42',
+         'username': 'reignier'},
+        # Change of type
+        {'mac': wireless_mac, 'connectionType': 'wired',
+         'username': 'reignier'},
+        dict(wired_device_dict, mac='01:23:45:67:89:AE', username='nobody'),
+        dict(wired_device_dict, mac='01:23:45:67:89:AF', ipAddress='a.b'),
+        dict(wireless_device_dict, mac='not a mac'),
+        wireless_device_dict,
+    ]
+    r = put_devices(api_client, devices)
+    assert statuses(r) == [201, 201, 204, 204, 400, 400, 400, 400]
+    result = json.loads(r.data.decode())
+    assert result[4]['message'] == 'User not found'
+    assert result[7]['message'] == 'Duplicate MAC address in the request'
+
+    r = api_client.get('{}/device/{}'.format(base_url, wired_mac),
+                       headers=TEST_HEADERS)
+    assert json.loads(r.data.decode()) == devices[2]
+
+    r = api_client.get('{}/device/{}'.format(base_url, wireless_mac),
+                       headers=TEST_HEADERS)
+    assert json.loads(r.data.decode()) == {
+        'mac': wireless_mac, 'connectionType': 'wired',
+        'ipAddress': '192.168.42.2', 'ipv6Address': 'fe80::2',
+        'username': 'reignier',
+    }
+    assert_device_index_in_sync()
+    # 2 creations, an update, a deletion and a creation
+    s = db.get_db().get_session()
+    assert s.query(Modification).count() == 5
+
+
+def test_device_put_devices_same_modifications(warm_api_client,
+                                               wired_device,
+                                               wireless_device_dict):
+    """ The batch records what putDevice records """
+    wired_mac, wired_ipv6 = wired_device.mac, wired_device.ipv6
+    single = dict(wireless_device_dict, mac='01:23:45:67:89:B0')
+    batch = dict(wireless_device_dict, mac='01:23:45:67:89:B1')
+    warm_api_client.put('{}/device/{}'.format(base_url, single['mac']),
+                        data=json.dumps(single),
+                        content_type='application/json',
+                        headers=TEST_HEADERS)
+    put_devices(warm_api_client, [batch])
+    created_single, created_batch = last_actions(2)
+    assert created_batch == created_single \
+        .replace('B0', 'B1').replace('id:\n- \n- 2\n', 'id:\n- \n- 3\n')
+
+    update = {'mac': wired_mac, 'connectionType': 'wired',
+              'ipAddress': '157.159.42.43', 'ipv6Address': wired_ipv6,
+              'username': 'reignier'}
+    put_devices(warm_api_client, [update])
+    assert last_actions(1) == [
+        'ordinateurs: !ruby/hash:ActiveSupport::HashWithIndifferentAccess\n'
+        'adherent_id:\n'
+        '- 1\n'
+        '- 2\n'
+        'ip:\n'
+        '- 157.159.42.42\n'
+        '- 157.159.42.43\n'
+    ]
+
+
+def test_device_put_devices_single_transaction(warm_api_client,
+                                               wired_device_dict):
+    engine = db.get_db().engine
+    few = [dict(wired_device_dict, mac='01:23:45:67:89:{:02X}'.format(i))
+           for i in range(2)]
+    many = [dict(wired_device_dict, mac='01:23:45:67:8A:{:02X}'.format(i))
+            for i in range(50)]
+    with count_queries(engine) as few_statements:
+        put_devices(warm_api_client, few)
+    with count_commits(engine) as commits:
+        with count_queries(engine) as many_statements:
+            r = put_devices(warm_api_client, many)
+    assert statuses(r) == [201] * 50
+    assert len(commits) == 1
+    assert len(many_statements) == len(few_statements)
+    assert_device_index_in_sync()
+
+
+def test_device_put_devices_atomic(warm_api_client, wired_device,
+                                   wireless_device_dict):
+    """ Nothing is written if one of the writes fails """
+    s = db.get_db().get_session()
+    # Out of date index: the row of the next wireless device is taken
+    next_id = s.query(func.max(Portable.id)).scalar() + 1
+    s.add(Device(type='wireless', device_id=next_id, mac='stale',
+                 adherent_id=1))
+    s.commit()
+
+    r = put_devices(warm_api_client, [
+        {'mac': wired_device.mac, 'connectionType': 'wireless',
+         'username': 'dubois_j'},
+        dict(wireless_device_dict, mac='01:23:45:67:89:B0'),
+    ])
+    assert r.status_code == 409
+    r = warm_api_client.get('{}/device/{}'.format(base_url, wired_device.mac),
+                            headers=TEST_HEADERS)
+    assert json.loads(r.data.decode())['connectionType'] == 'wired'
+
+
+def test_device_delete_devices(api_client, wired_device, wireless_device):
+    r = delete_devices(api_client, [
+        wired_device.mac,
+        '01:23:45:67:89:B0',
+        wireless_device.mac,
+        wired_device.mac,
+    ])
+    assert statuses(r) == [204, 404, 204]
+
+    s = db.get_db().get_session()
+    assert s.query(Ordinateur).count() == 0
+    assert s.query(Portable).count() == 0
+    assert_device_index_in_sync()
+    assert sorted(last_actions(2)) == [
+        'ordinateurs: !ruby/hash:ActiveSupport::HashWithIndifferentAccess\n'
+        'adherent_id:\n'
+        '- 1\n'
+        '- \n'
+        'dns:\n'
+        '- bonnet_n4651\n'
+        '- \n'
+        'id:\n'
+        '- 1\n'
+        '- \n'
+        'ip:\n'
+        '- 157.159.42.42\n'
+        '- \n'
+        'ipv6:\n'
+        '- e91f:bd71:56d9:13f3:5499:25b:cc84:f7e4\n'
+        '- \n'
+        'mac:\n'
+        '- 96:24:F6:D0:48:A7\n'
+        '- \n',
+        'portables: !ruby/hash:ActiveSupport::HashWithIndifferentAccess\n'
+        'adherent_id:\n'
+        '- 2\n'
+        '- \n'
+        'id:\n'
+        '- 1\n'
+        '- \n'
+        'mac:\n'
+        '- 80:65:F3:FC:44:A9\n'
+        '- \n',
+    ]
+
+
+def test_device_delete_devices_same_modification(warm_api_client,
+                                                 wireless_device_dict):
+    """ The batch records what deleteDevice records """
+    for mac in ('01:23:45:67:89:B0', '01:23:45:67:89:B1'):
+        warm_api_client.put('{}/device/{}'.format(base_url, mac),
+                            data=json.dumps(dict(wireless_device_dict,
+                                                 mac=mac)),
+                            content_type='application/json',
+                            headers=TEST_HEADERS)
+    warm_api_client.delete('{}/device/{}'.format(base_url,
+                                                 '01:23:45:67:89:B0'),
+                           headers=TEST_HEADERS)
+    delete_devices(warm_api_client, ['01:23:45:67:89:B1'])
+    deleted_single, deleted_batch = last_actions(2)
+    assert deleted_batch == deleted_single \
+        .replace('B0', 'B1').replace('id:\n- 2\n', 'id:\n- 3\n')
+
+
+def test_device_put_devices_statements(warm_api_client, wired_device_dict):
+    """ One putDevice per device vs a single batch """
+    engine = db.get_db().engine
+    N = 20
+    devices = [dict(wired_device_dict, mac='01:23:45:67:8A:{:02X}'.format(i))
+               for i in range(N)]
+    with count_queries(engine) as one_by_one:
+        for device in devices:
+            warm_api_client.put(
+                '{}/device/{}'.format(base_url, device['mac']),
+                data=json.dumps(device),
+                content_type='application/json',
+                headers=TEST_HEADERS)
+
+    devices = [dict(d, mac=d['mac'].replace('8A', '8B')) for d in devices]
+    with count_queries(engine) as batch:
+        r = put_devices(warm_api_client, devices)
+    assert statuses(r) == [201] * N
+    assert_device_index_in_sync()
+    # Several statements per device one by one, a fixed number in a batch
+    # (see test_device_put_devices_single_transaction)
+    assert len(one_by_one) >= 2 * N
+    assert len(batch) < N
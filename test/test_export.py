@@ -0,0 +1,203 @@
+import csv
+import datetime
+import io
+import json
+import pytest
+from adh.model.database import Database as db
+from adh.model.models import Adherent, Chambre, Ordinateur, Port, Portable, \
+        Switch, Vlan
+from CONFIGURATION import TEST_DATABASE as db_settings
+
+from .resource import base_url, TEST_HEADERS, count_queries
+
+
+@pytest.fixture
+def sample_room():
+    yield Chambre(
+        numero=1234,
+        description="chambre 1",
+        telephone="6842",
+        vlan=Vlan(numero=42, adresses="192.168.42.1", adressesv6="fe80::1"),
+    )
+
+
+@pytest.fixture
+def sample_member(sample_room):
+    yield Adherent(
+        nom="Dubois",
+        prenom="Jean-Louis",
+        mail="j.dubois@free.fr",
+        login="dubois_j",
+        password="a",
+        chambre=sample_room,
+        date_de_depart=datetime.date(2019, 6, 30),
+    )
+
+
+@pytest.fixture
+def sample_member2():
+    yield Adherent(
+        nom="Reignier",
+        prenom="Edouard",
+        mail="bgdu78@hotmail.fr",
+        login="reignier",
+        password="b",
+    )
+
+
+def prep_db(session, sample_room, sample_member, sample_member2):
+    switch = Switch(description="Switch", ip="192.168.102.2",
+                    communaute="communaute")
+    session.add_all([
+        sample_room,
+        sample_member,
+        sample_member2,
+        switch,
+        Port(numero="0/0/1", oid="1.1.1", switch=switch,
+             chambre=sample_room),
+        Ordinateur(mac="96:24:F6:D0:48:A7", ip="157.159.42.42",
+                   ipv6="fe80::42", adherent=sample_member),
+        Portable(mac="80:65:F3:FC:44:A9", adherent=sample_member2),
+    ])
+    session.commit()
+
+
+@pytest.fixture
+def api_client(sample_room, sample_member, sample_member2):
+    from .context import app
+    with app.app.test_client() as c:
+        db.init_db(db_settings, testing=True)
+        prep_db(db.get_db().get_session(), sample_room, sample_member,
+                sample_member2)
+        # Several requests are made, commit the sample data for good
+        db.get_db().get_session().commit()
+        yield c
+
+
+def export(client, path, fmt="ndjson"):
+    r = client.get("{}/{}/export/?format={}".format(base_url, path, fmt),
+                   headers=TEST_HEADERS)
+    assert r.status_code == 200
+    return r
+
+
+def ndjson(r):
+    assert r.mimetype == "application/x-ndjson"
+    return [json.loads(line) for line in r.data.decode().splitlines()]
+
+
+def csv_rows(r):
+    assert r.mimetype == "text/csv"
+    return list(csv.DictReader(io.StringIO(r.data.decode())))
+
+
+def get_json(client, path):
+    r = client.get("{}/{}".format(base_url, path), headers=TEST_HEADERS)
+    return json.loads(r.data.decode())
+
+
+@pytest.mark.parametrize("path,filter_path", [
+    ("user", "user/"),
+    ("device", "device/"),
+    ("room", "room/"),
+    ("ports", "ports/"),
+])
+def test_export_same_as_filter(api_client, path, filter_path):
+    """ A row of the NDJSON export is what the filter endpoint returns """
+    rows = ndjson(export(api_client, path))
+    assert len(rows) == (2 if path in ("user", "device") else 1)
+    key = lambda row: json.dumps(row, sort_keys=True)  # noqa: E731
+    assert sorted(rows, key=key) == \
+        sorted(get_json(api_client, filter_path), key=key)
+
+
+def test_export_users_csv(api_client):
+    rows = csv_rows(export(api_client, "user", "csv"))
+    assert rows[0] == {
+        "username": "dubois_j",
+        "email": "j.dubois@free.fr",
+        "firstName": "Jean-Louis",
+        "lastName": "Dubois",
+        "roomNumber": "1234",
+        "comment": "",
+        "departureDate": "2019-06-30",
+        "associationMode": "2011-04-30T17:50:17Z",
+    }
+    assert rows[1]["username"] == "reignier"
+    assert rows[1]["roomNumber"] == ""
+
+
+def test_export_devices_csv(api_client):
+    rows = csv_rows(export(api_client, "device", "csv"))
+    assert sorted(rows, key=lambda row: row["mac"]) == [
+        {"mac": "80:65:F3:FC:44:A9", "connectionType": "wireless",
+         "ipAddress": "", "ipv6Address": "", "username": "reignier"},
+        {"mac": "96:24:F6:D0:48:A7", "connectionType": "wired",
+         "ipAddress": "157.159.42.42", "ipv6Address": "fe80::42",
+         "username": "dubois_j"},
+    ]
+
+
+def test_export_empty_csv(api_client):
+    db.get_db().get_session().query(Port).delete()
+    r = export(api_client, "ports", "csv")
+    assert r.data.decode().splitlines() == [
+        "id,portNumber,roomNumber,switchID",
+    ]
+
+
+def test_export_invalid_format(api_client):
+    r = api_client.get("{}/user/export/?format=xml".format(base_url),
+                       headers=TEST_HEADERS)
+    assert r.status_code == 400
+
+
+def add_devices(member, n):
+    s = db.get_db().get_session()
+    s.add_all([
+        Portable(mac="00:11:22:33:{:02X}:{:02X}".format(i // 256, i % 256),
+                 adherent=member)
+        for i in range(n)
+    ])
+    s.commit()
+
+
+def test_export_streamed(api_client, sample_member, monkeypatch):
+    from .context import app
+    monkeypatch.setitem(app.app.config, "EXPORT_BATCH_SIZE", 10)
+    add_devices(sample_member, 48)
+    r = api_client.get("{}/device/export/".format(base_url),
+                       headers=TEST_HEADERS)
+    assert r.is_streamed
+    assert r.headers["Content-Disposition"] == \
+        "attachment; filename=devices.ndjson"
+    # 50 devices, sent 10 by 10
+    chunks = list(r.response)
+    assert len(chunks) == 5
+    assert sum(len(c.splitlines()) for c in chunks) == 50
+
+
+def test_export_constant_number_of_queries(api_client, sample_member):
+    """ Paging through filterDevice vs a single export """
+    engine = db.get_db().engine
+    add_devices(sample_member, 2000)
+
+    devices = []
+    url = "{}/device/?limit=100&totalCount=none".format(base_url)
+    with count_queries(engine) as paged:
+        while url:
+            r = api_client.get(url, headers=TEST_HEADERS)
+            devices += json.loads(r.data.decode())
+            cursor = r.headers.get("X-Next-Cursor")
+            url = cursor and "{}/device/?limit=100&totalCount=none&cursor={}" \
+                .format(base_url, cursor)
+    with count_queries(engine) as streamed:
+        exported = ndjson(export(api_client, "device"))
+
+    def reads(statements):
+        return [q for q in statements if "FROM devices" in q]
+
+    assert len(exported) == len(devices) == 2002
+    # A SELECT per page of 100 devices, a single one for the export
+    assert len(reads(paged)) >= 21
+    assert len(reads(streamed)) == 1
@@ -0,0 +1,214 @@
+import datetime
+import ipaddress
+import json
+import pytest
+from adh.model.database import Database as db
+from adh.model.models import Adherent, Chambre, IPReservation, \
+        Ordinateur, Vlan
+from adh.util.ip_allocator import AddressPool
+from CONFIGURATION import TEST_DATABASE as db_settings
+
+from .resource import base_url, TEST_HEADERS, count_queries
+
+
+def test_address_pool_ipv4():
+    """ Neither the network, the broadcast nor the router are handed out """
+    pool = AddressPool(ipaddress.ip_network("10.0.0.0/29"), 1, 65536)
+    assert pool.size == 5
+    pool.mark(ipaddress.ip_address("10.0.0.3"))
+    taken = [str(pool.take()) for _ in range(4)]
+    assert taken == ["10.0.0.2", "10.0.0.4", "10.0.0.5", "10.0.0.6"]
+    assert pool.take() is None
+
+    pool.release(ipaddress.ip_address("10.0.0.4"))
+    assert str(pool.take()) == "10.0.0.4"
+    # Not in the pool
+    pool.release(ipaddress.ip_address("10.0.0.1"))
+    assert pool.take() is None
+
+
+def test_address_pool_ipv6_bounded():
+    pool = AddressPool(ipaddress.ip_network("fe80::/64"), 1, 100)
+    assert pool.size == 100
+    assert str(pool.take()) == "fe80::2"
+    pool.mark(ipaddress.ip_address("fe80::1:0"))  # Out of the bitmap
+    assert pool.free == 99
+
+
+@pytest.fixture
+def sample_vlan():
+    yield Vlan(numero=42, adresses="192.168.42.0/29", adressesv6="fe80::/64")
+
+
+@pytest.fixture
+def sample_member(sample_vlan):
+    yield Adherent(
+        nom='Dubois',
+        prenom='Jean-Louis',
+        mail='j.dubois@free.fr',
+        login='dubois_j',
+        password='a',
+        chambre=Chambre(numero=1234, vlan=sample_vlan),
+    )
+
+
+def prep_db(session, sample_member):
+    session.add_all([
+        sample_member,
+        Ordinateur(mac='96:24:F6:D0:48:A7', ip='192.168.42.2',
+                   ipv6='fe80::2', adherent=sample_member),
+    ])
+    session.commit()
+
+
+@pytest.fixture
+def api_client(sample_member):
+    from .context import app
+    with app.app.test_client() as c:
+        db.init_db(db_settings, testing=True)
+        prep_db(db.get_db().get_session(), sample_member)
+        # Several requests are made, commit the sample data for good
+        db.get_db().get_session().commit()
+        yield c
+
+
+def mac(i):
+    return '00:11:22:33:44:{:02X}'.format(i)
+
+
+def put_device(client, i, **kwargs):
+    body = dict({'mac': mac(i), 'connectionType': 'wired',
+                 'username': 'dubois_j'}, **kwargs)
+    return client.put('{}/device/{}'.format(base_url, body['mac']),
+                      data=json.dumps(body),
+                      content_type='application/json',
+                      headers=TEST_HEADERS)
+
+
+def put_devices(client, n, start=0):
+    body = [{'mac': mac(i), 'connectionType': 'wired',
+             'username': 'dubois_j'} for i in range(start, start + n)]
+    return client.put('{}/device/'.format(base_url), data=json.dumps(body),
+                      content_type='application/json', headers=TEST_HEADERS)
+
+
+def addresses(i):
+    s = db.get_db().get_session()
+    dev = s.query(Ordinateur).filter(Ordinateur.mac == mac(i)).one()
+    return dev.ip, dev.ipv6
+
+
+def test_ip_allocator_put_device(api_client):
+    assert put_device(api_client, 1).status_code == 201
+    assert addresses(1) == ('192.168.42.3', 'fe80::3')
+    # The addresses given are kept, as well as those of an update
+    assert put_device(api_client, 2, ipAddress='192.168.42.4') \
+        .status_code == 201
+    assert addresses(2) == ('192.168.42.4', 'fe80::4')
+    assert put_device(api_client, 2, ipv6Address='fe80::42') \
+        .status_code == 204
+    assert addresses(2) == ('192.168.42.4', 'fe80::42')
+    # fe80::4 is still reserved
+    assert put_device(api_client, 3).status_code == 201
+    assert addresses(3) == ('192.168.42.5', 'fe80::5')
+
+
+def test_ip_allocator_put_devices(api_client):
+    r = put_devices(api_client, 5)
+    assert [d['status'] for d in json.loads(r.data.decode())] == \
+        [201, 201, 201, 201, 400]
+    assert [addresses(i)[0] for i in range(4)] == \
+        ['192.168.42.3', '192.168.42.4', '192.168.42.5', '192.168.42.6']
+    # The /29 is full
+    r = put_device(api_client, 4)
+    assert r.status_code == 400
+
+
+def test_ip_allocator_reuses_deleted_addresses(api_client, monkeypatch):
+    from .context import app
+    monkeypatch.setitem(app.app.config, "IP_RESERVATION_TTL", 0)
+    put_devices(api_client, 4)
+    r = api_client.delete('{}/device/{}'.format(base_url, mac(1)),
+                          headers=TEST_HEADERS)
+    assert r.status_code == 204
+    assert put_device(api_client, 4).status_code == 201
+    assert addresses(4)[0] == '192.168.42.4'
+
+
+def test_ip_allocator_releases_on_rollback(api_client):
+    r = put_device(api_client, 1, ipv6Address='not an address')
+    assert r.status_code == 400
+    assert put_device(api_client, 1).status_code == 201
+    assert addresses(1)[0] == '192.168.42.3'
+
+
+def test_ip_allocator_stale_bitmap(api_client, sample_member):
+    """ The database wins over the bitmap of the worker """
+    member_id = sample_member.id
+    put_device(api_client, 1)
+
+    # Written by another worker: a reservation, and a device by ADH5
+    s = db.get_db().get_session()
+    s.add(IPReservation(address='192.168.42.4',
+                        created_at=datetime.datetime.now()))
+    s.execute(Ordinateur.__table__.insert().values(
+        mac=mac(42), ip='192.168.42.5', ipv6='fe80::42',
+        adherent_id=member_id))
+    s.commit()
+
+    assert put_device(api_client, 2).status_code == 201
+    assert addresses(2)[0] == '192.168.42.6'
+
+
+def test_ip_allocator_reservation_conflict(api_client, monkeypatch):
+    """ Reserved by another worker after the check: no SAVEPOINT """
+    from adh.util import ip_allocator
+    put_device(api_client, 1)
+    s = db.get_db().get_session()
+    s.add(IPReservation(address='192.168.42.4',
+                        created_at=datetime.datetime.now()))
+    s.commit()
+    monkeypatch.setattr(ip_allocator, "_used", lambda s, addresses: set())
+
+    with count_queries(db.get_db().engine) as statements:
+        assert put_device(api_client, 2).status_code == 201
+    assert addresses(2)[0] == '192.168.42.5'
+    assert not [q for q in statements if "SAVEPOINT" in q]
+
+
+def test_ip_allocator_partial_reservation_conflict(api_client, monkeypatch):
+    """ The addresses reserved by the batch are kept when others conflict """
+    from adh.util import ip_allocator
+    put_device(api_client, 1)
+    s = db.get_db().get_session()
+    s.add(IPReservation(address='192.168.42.4',
+                        created_at=datetime.datetime.now()))
+    s.commit()
+    monkeypatch.setattr(ip_allocator, "_used", lambda s, addresses: set())
+
+    r = put_devices(api_client, 2, 2)
+    assert [d['status'] for d in json.loads(r.data.decode())] == [201, 201]
+    assert sorted([addresses(2)[0], addresses(3)[0]]) == \
+        ['192.168.42.5', '192.168.42.6']
+
+
+def test_ip_allocator_purges_once_per_ttl(api_client):
+    with count_queries(db.get_db().engine) as statements:
+        for i in range(3):
+            put_device(api_client, i)
+    deletes = [q for q in statements if "DELETE FROM ip_reservations" in q]
+    assert len(deletes) == 1
+
+
+def test_ip_allocator_constant_number_of_queries(api_client, sample_vlan):
+    sample_vlan.adresses = "10.0.0.0/16"
+    db.get_db().get_session().commit()
+    # Create the admin and load the pools, then cache the admin
+    put_devices(api_client, 1)
+    put_devices(api_client, 0)
+    engine = db.get_db().engine
+    with count_queries(engine) as few:
+        put_devices(api_client, 3, 1)
+    with count_queries(engine) as many:
+        put_devices(api_client, 30, 4)
+    assert len(few) == len(many)
@@ -0,0 +1,76 @@
+import pytest
+from sqlalchemy import create_engine, inspect
+from adh.model.database import Base
+from adh.model.migrations import upgrade_indexes
+from adh.model.models import Device, Ordinateur, Portable, Switch
+from adh.model.reindex import rebuild_index
+
+
+@pytest.fixture
+def legacy_engine():
+    """ A database created without any of the indexes (like ADH5's) """
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.drop(bind=conn)
+    yield engine
+
+
+def index_names(engine, table):
+    return set(i["name"] for i in inspect(engine).get_indexes(table))
+
+
+def test_migration_creates_missing_indexes(legacy_engine):
+    created, skipped = upgrade_indexes(legacy_engine)
+    assert skipped == {}
+    assert "ix_ordinateurs_mac" in created
+    assert "ix_adherents_login" in created
+    assert "ix_ordinateurs_mac" in index_names(legacy_engine, "ordinateurs")
+
+    # Running it again does nothing
+    assert upgrade_indexes(legacy_engine) == ([], {})
+
+
+def test_migration_skips_unique_index_on_duplicates(legacy_engine):
+    with legacy_engine.begin() as conn:
+        for _ in range(2):
+            conn.execute(Ordinateur.__table__.insert().values(
+                mac="00:00:00:00:00:01", adherent_id=1))
+            conn.execute(Switch.__table__.insert().values(ip="10.0.0.1"))
+
+    created, skipped = upgrade_indexes(legacy_engine)
+    assert skipped == {"ix_ordinateurs_mac": [("00:00:00:00:00:01",)]}
+    # Non unique indexes do not care about duplicates
+    assert "ix_switches_ip" in created
+    assert "ix_ordinateurs_mac" not in index_names(legacy_engine,
+                                                   "ordinateurs")
+
+
+def test_migration_unique_index_with_nulls(legacy_engine):
+    """ Several NULLs are not duplicates """
+    with legacy_engine.begin() as conn:
+        for _ in range(2):
+            conn.execute(Ordinateur.__table__.insert().values(
+                mac=None, adherent_id=1))
+
+    created, skipped = upgrade_indexes(legacy_engine)
+    assert skipped == {}
+    assert "ix_ordinateurs_mac" in created
+
+
+def test_reindex_devices_written_elsewhere(legacy_engine):
+    with legacy_engine.begin() as conn:
+        conn.execute(Ordinateur.__table__.insert().values(
+            mac="00:00:00:00:00:01", adherent_id=1))
+        conn.execute(Portable.__table__.insert().values(
+            mac="00:00:00:00:00:02", adherent_id=1))
+        conn.execute(Device.__table__.insert().values(
+            type="wired", device_id=42, mac="00:00:00:00:00:42"))
+
+    assert rebuild_index(legacy_engine) == 2
+    with legacy_engine.connect() as conn:
+        macs = conn.execute(Device.__table__.select()
+                            .order_by(Device.mac)).fetchall()
+    assert [d.mac for d in macs] == ["00:00:00:00:00:01", "00:00:00:00:00:02"]
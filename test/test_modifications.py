@@ -1,8 +1,8 @@
 import pytest
-from adh.model.database import Database as db
+from adh.model.database import Database as db, unit_of_work
 from CONFIGURATION import TEST_DATABASE as db_settings
 from adh.model.models import (
-    Adherent, Chambre, Vlan, Modification, Utilisateur
+    Adherent, Chambre, Vlan, Modification, Utilisateur, Ordinateur, Portable
 )
 import datetime
 
@@ -80,8 +80,9 @@ def test_modification_pass_updated(api_client, sample_member):
     s.flush()
 
     # Build the corresponding modification
-    Modification.add_and_commit(s, a, a.get_ruby_modif(),
-                                Utilisateur.find_or_create(s, "test"))
+    with unit_of_work(s):
+        Modification.add(s, a, a.get_ruby_modif(),
+                         Utilisateur.find_or_create(s, "test"))
     q = s.query(Modification)
     m = q.first()
     assert m.action == (
@@ -110,8 +111,9 @@ def test_modification_multiple_changes_updated(api_client, sample_member):
     s.flush()
 
     # Build the corresponding modification
-    Modification.add_and_commit(s, a, a.get_ruby_modif(),
-                                Utilisateur.find_or_create(s, "test"))
+    with unit_of_work(s):
+        Modification.add(s, a, a.get_ruby_modif(),
+                         Utilisateur.find_or_create(s, "test"))
     q = s.query(Modification)
     m = q.first()
     assert m.action == (
@@ -145,8 +147,9 @@ def test_modification_add_new_user(api_client, sample_member2):
     s.flush()
 
     # Build the corresponding modification
-    Modification.add_and_commit(s, a, a.get_ruby_modif(),
-                                Utilisateur.find_or_create(s, "test"))
+    with unit_of_work(s):
+        Modification.add(s, a, a.get_ruby_modif(),
+                         Utilisateur.find_or_create(s, "test"))
     q = s.query(Modification)
     m = q.first()
     assert m.action == (
@@ -196,8 +199,9 @@ def test_modification_delete_member(api_client, sample_member):
     s.flush()
 
     # Build the corresponding modification
-    Modification.add_and_commit(s, a, a.get_ruby_modif(),
-                                Utilisateur.find_or_create(s, "test"))
+    with unit_of_work(s):
+        Modification.add(s, a, a.get_ruby_modif(),
+                         Utilisateur.find_or_create(s, "test"))
     q = s.query(Modification)
     m = q.first()
     assert m.action == (
@@ -233,3 +237,107 @@ def test_modification_delete_member(api_client, sample_member):
     assert now - m.created_at < one_sec
     assert now - m.updated_at < one_sec
     assert m.utilisateur_id == 1
+
+
+def test_modification_device_new_owner(api_client, sample_member,
+                                       sample_member2):
+    """ The foreign key is only set during the flush """
+    s = db.get_db().get_session()
+    s.add(sample_member2)
+    dev = Ordinateur(mac="00:11:22:33:44:55", ip="192.168.42.2",
+                     adherent=Adherent.find(s, sample_member.login))
+    s.add(dev)
+    s.commit()
+
+    dev.start_modif_tracking()
+    dev.adherent = sample_member2
+    s.flush()
+
+    assert dev.get_ruby_modif() == (
+        'ordinateurs: !ruby/hash:ActiveSupport::HashWithIndifferentAccess\n'
+        'adherent_id:\n'
+        '- 1\n'
+        '- 2\n'
+    )
+
+
+def test_modification_several_flushes(api_client, sample_member):
+    s = db.get_db().get_session()
+    a = Adherent.find(s, sample_member.login)
+
+    a.start_modif_tracking()
+    a.nom = "First"
+    a.prenom = "Jean"
+    s.flush()
+    a.nom = "Second"
+    a.prenom = "Jean-Louis"  # Back to the old value
+    s.flush()
+    a.mail = "second@free.fr"  # Not flushed
+
+    assert a.get_ruby_modif() == (
+        '--- !ruby/hash:ActiveSupport::HashWithIndifferentAccess\n'
+        'mail:\n'
+        '- j.dubois@free.fr\n'
+        '- second@free.fr\n'
+        'nom:\n'
+        '- Dubois\n'
+        '- Second\n'
+    )
+
+
+def test_modification_before_tracking_ignored(api_client, sample_member):
+    s = db.get_db().get_session()
+    a = Adherent.find(s, sample_member.login)
+    a.nom = "Before"
+
+    a.start_modif_tracking()
+    a.prenom = "After"
+    s.flush()
+
+    assert a.get_ruby_modif() == (
+        '--- !ruby/hash:ActiveSupport::HashWithIndifferentAccess\n'
+        'prenom:\n'
+        '- Jean-Louis\n'
+        '- After\n'
+    )
+
+
+def legacy_ruby_modif(obj, old_data):
+    """ The previous implementation: full row before and after, diffed """
+    new_data = dict((c.name, getattr(obj, c.name))
+                    for c in obj.__table__.columns)
+    base_str = '{} !ruby/hash:ActiveSupport::HashWithIndifferentAccess\n'
+    txt = [base_str.format(obj._ruby_hash_prefix)]
+    for key in sorted(set().union(new_data.keys(), old_data.keys())):
+        old = old_data.get(key)
+        new = new_data.get(key)
+        old = old if old is not None else ""
+        new = new if new is not None else ""
+        if old != new:
+            txt += ["{}:\n- {}\n- {}\n".format(key, old, new)]
+    return "".join(txt)
+
+
+def test_modification_tracking_same_as_legacy(api_client, sample_member):
+    """ Update of a single attribute of Adherent/Ordinateur/Portable """
+    s = db.get_db().get_session()
+    a = Adherent.find(s, sample_member.login)
+    wired = Ordinateur(mac="00:11:22:33:44:55", ip="192.168.42.2",
+                       adherent=a)
+    wireless = Portable(mac="00:11:22:33:44:66", adherent=a)
+    s.add_all([wired, wireless])
+    s.commit()
+    objects = [
+        (a, "commentaires", "comment {}".format),
+        (wired, "ip", lambda i: "10.0.{}.{}".format(i // 256, i % 256)),
+        (wireless, "mac", lambda i: "00:11:22:33:{:02X}:{:02X}".format(
+            i // 256, i % 256)),
+    ]
+    for i in range(3):
+        for obj, attr, value in objects:
+            obj.start_modif_tracking()
+            old_data = dict((c.name, getattr(obj, c.name))
+                            for c in obj.__table__.columns)
+            setattr(obj, attr, value(i))
+            assert obj.get_ruby_modif() == legacy_ruby_modif(obj, old_data)
+    s.rollback()
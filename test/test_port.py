@@ -4,7 +4,7 @@ from adh.model.database import Database as db
 from CONFIGURATION import TEST_DATABASE as db_settings
 from adh.model.models import Port, Switch, Chambre
 
-from .resource import base_url, TEST_HEADERS
+from .resource import base_url, TEST_HEADERS, count_queries
 
 
 @pytest.fixture
@@ -133,6 +133,55 @@ def test_port_get_filter_all_with_limit(api_client):
     assert len(switches) == 1
 
 
+def test_port_get_filter_all_with_cursor(api_client):
+    # Several requests are made, commit the sample data for good
+    db.get_db().get_session().commit()
+    r = api_client.get(
+        "{}/ports/?limit={}".format(base_url, 1),
+        headers=TEST_HEADERS,
+    )
+    first = json.loads(r.data.decode())
+    r = api_client.get(
+        "{}/ports/?limit={}&cursor={}".format(
+            base_url, 1, r.headers['X-Next-Cursor']),
+        headers=TEST_HEADERS,
+    )
+    assert r.status_code == 200
+    second = json.loads(r.data.decode())
+    assert [p['portNumber'] for p in first + second] == ['0/0/1', '0/0/2']
+
+
+def test_port_get_filter_all_with_invalid_cursor(api_client):
+    r = api_client.get(
+        "{}/ports/?cursor={}".format(base_url, "notacursor"),
+        headers=TEST_HEADERS,
+    )
+    assert r.status_code == 400
+
+
+def test_port_get_filter_constant_number_of_queries(api_client,
+                                                    sample_switch1):
+    s = db.get_db().get_session()
+    for i in range(10):
+        room = Chambre(numero=1000 + i, description="room")
+        s.add(Port(numero="1/0/{}".format(i), oid="1.2.{}".format(i),
+                   switch=sample_switch1, chambre=room))
+    s.commit()
+    # Several requests are made, commit the sample data for good
+    s.commit()
+
+    def number_of_queries(limit):
+        with count_queries(db.get_db().engine) as statements:
+            r = api_client.get(
+                "{}/ports/?limit={}".format(base_url, limit),
+                headers=TEST_HEADERS,
+            )
+        assert len(json.loads(r.data.decode())) == limit
+        return len(statements)
+
+    assert number_of_queries(1) == number_of_queries(12)
+
+
 def test_port_get_filter_by_switchid(api_client, sample_switch2):
     r = api_client.get(
         "{}/ports/?switchID={}".format(base_url, sample_switch2.id),
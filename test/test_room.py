@@ -3,7 +3,7 @@ import pytest
 from adh.model.database import Database as db
 from adh.model.models import Chambre, Vlan
 from CONFIGURATION import TEST_DATABASE as db_settings
-from .resource import base_url, TEST_HEADERS
+from .resource import base_url, TEST_HEADERS, count_queries
 
 
 @pytest.fixture
@@ -89,6 +89,55 @@ def test_room_filter_all_rooms_limit(api_client):
     assert len(response) == 1
 
 
+def test_room_filter_with_cursor(api_client):
+    # Several requests are made, commit the sample data for good
+    db.get_db().get_session().commit()
+    r = api_client.get(
+        "{}/room/?limit={}".format(base_url, 1),
+        headers=TEST_HEADERS,
+    )
+    first = json.loads(r.data.decode())
+    r = api_client.get(
+        "{}/room/?limit={}&cursor={}".format(
+            base_url, 1, r.headers['X-Next-Cursor']),
+        headers=TEST_HEADERS,
+    )
+    assert r.status_code == 200
+    second = json.loads(r.data.decode())
+    assert len(second) == 1
+    assert first != second
+
+
+def test_room_filter_with_invalid_cursor(api_client):
+    r = api_client.get(
+        "{}/room/?cursor={}".format(base_url, "notacursor"),
+        headers=TEST_HEADERS,
+    )
+    assert r.status_code == 400
+
+
+def test_room_filter_constant_number_of_queries(api_client):
+    s = db.get_db().get_session()
+    for i in range(10):
+        vlan = Vlan(numero=100 + i, adresses="192.168.1.0/24",
+                    adressesv6="fe80::0")
+        s.add(Chambre(numero=1000 + i, description="room", vlan=vlan))
+    s.commit()
+    # Several requests are made, commit the sample data for good
+    s.commit()
+
+    def number_of_queries(limit):
+        with count_queries(db.get_db().engine) as statements:
+            r = api_client.get(
+                "{}/room/?limit={}".format(base_url, limit),
+                headers=TEST_HEADERS,
+            )
+        assert len(json.loads(r.data.decode())) == limit
+        return len(statements)
+
+    assert number_of_queries(1) == number_of_queries(12)
+
+
 def test_room_filter_by_term(api_client):
     r = api_client.get(
         "{}/room/?terms={}".format(base_url, "voisin"),
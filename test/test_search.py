@@ -0,0 +1,171 @@
+import json
+import pytest
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from adh import search
+from adh.model.database import Database as db
+from adh.model.models import Adherent
+from CONFIGURATION import TEST_DATABASE as db_settings
+
+from .resource import base_url, TEST_HEADERS
+
+
+@pytest.fixture
+def members():
+    yield [
+        Adherent(nom='Dubois', prenom='Jean-Louis', mail='j.dubois@free.fr',
+                 login='dubois_j', password='a'),
+        Adherent(nom='Reignier', prenom='Edouard', mail='bgdu78@hotmail.fr',
+                 login='reignier', password='a',
+                 commentaires='Desauthent pour routeur'),
+    ]
+
+
+@pytest.fixture
+def api_client(members):
+    from .context import app
+    with app.app.test_client() as c:
+        db.init_db(db_settings, testing=True)
+        s = db.get_db().get_session()
+        s.add_all(members)
+        s.commit()
+        # Several requests are made, commit the sample data for good
+        s.commit()
+        yield c
+
+
+def filter_users(api_client, terms):
+    r = api_client.get(
+        '{}/user/?terms={}'.format(base_url, terms),
+        headers=TEST_HEADERS,
+    )
+    assert r.status_code == 200
+    return sorted(u['username'] for u in json.loads(r.data.decode()))
+
+
+def test_search_ngram_index():
+    index = search.NgramIndex()
+    rows = [(1, 'Dubois', None), (2, 'Reignier', 'routeur')]
+    assert index.candidates('bois', lambda: rows) == {1}
+    assert index.candidates('OUT', lambda: rows) == {2}
+    assert index.candidates('xyz', lambda: rows) == set()
+    assert index.candidates('ou', lambda: rows) is None  # Too short
+
+
+def test_search_fulltext_compiles_to_match():
+    expr = search.SEARCHABLES['room'].fulltext(
+        search._phrase('chambre'))
+    sql = str(expr.compile(dialect=mysql.dialect()))
+    assert sql == ('MATCH (chambres.telephone, chambres.description) '
+                   'AGAINST (%s IN BOOLEAN MODE)')
+
+
+def test_search_fulltext_checked_with_like():
+    """ MATCH finds the ngrams, LIKE checks that they are a substring """
+    from .context import app
+    with app.app.app_context():
+        expr = search.matches(FakeSession('mysql'), 'room', 'chambre')
+    sql = str(expr.compile(dialect=mysql.dialect()))
+    assert sql.startswith('MATCH (chambres.telephone, chambres.description) '
+                          'AGAINST (%s IN BOOLEAN MODE) AND ')
+    assert 'LIKE' in sql
+
+
+def test_search_fulltext_device_no_comparison():
+    expr = search.SEARCHABLES['device'].fulltext(search._phrase('dubois'))
+    sql = str(expr.compile(dialect=mysql.dialect()))
+    assert 'BOOLEAN MODE) OR ' in sql
+    assert '= 1' not in sql
+
+
+class FakeSession():
+    """ Answers the query of the settings of check_fulltext """
+
+    def __init__(self, dialect, settings=(0, 2)):
+        self.bind = type('Bind', (), {})()
+        self.bind.dialect = {
+            'mysql': mysql, 'postgresql': postgresql, 'sqlite': sqlite,
+        }[dialect].dialect()
+        self.settings = settings
+
+    def execute(self, q):
+        settings = self.settings
+        return type('Result', (), {'fetchone': lambda self: settings})()
+
+
+@pytest.mark.parametrize('settings,expected', [
+    ((0, 2), True),
+    ((1, 2), False),   # Stopwords
+    ((0, 3), False),   # Terms of 2 characters cannot be found
+    ((0, 1), True),
+])
+def test_search_check_fulltext(settings, expected):
+    assert search.check_fulltext(FakeSession('mysql', settings)) == expected
+
+
+@pytest.mark.parametrize('backend', ['auto', 'fulltext'])
+def test_search_fulltext_fallback_to_like(api_client, backend, monkeypatch):
+    from .context import app
+    monkeypatch.setitem(app.app.config, 'SEARCH_BACKEND', backend)
+    db.get_db().caches['search:fulltext'] = False
+    with app.app.app_context():
+        assert search.get_backend(FakeSession('mysql')) == 'like'
+        db.get_db().caches['search:fulltext'] = True
+        assert search.get_backend(FakeSession('mysql')) == 'fulltext'
+
+
+@pytest.mark.parametrize('dialect,expected', [
+    ('sqlite', 'ngram'),
+    ('postgresql', 'like'),
+])
+def test_search_auto_backend(api_client, dialect, expected, monkeypatch):
+    """ Each worker would have its own ngram index in production """
+    from .context import app
+    monkeypatch.setitem(app.app.config, 'SEARCH_BACKEND', 'auto')
+    with app.app.app_context():
+        assert search.get_backend(FakeSession(dialect)) == expected
+
+
+@pytest.mark.parametrize('terms', [
+    'dubois', 'DUBOIS_J', 'ou', 'hotmail', 'routeur', 'e', 'nothing',
+])
+def test_search_ngram_same_results_as_like(api_client, terms, monkeypatch):
+    from .context import app
+    monkeypatch.setitem(app.app.config, 'SEARCH_BACKEND', 'like')
+    expected = filter_users(api_client, terms)
+    monkeypatch.setitem(app.app.config, 'SEARCH_BACKEND', 'ngram')
+    assert filter_users(api_client, terms) == expected
+
+
+def test_search_ngram_index_follows_writes(api_client):
+    assert filter_users(api_client, 'martin') == []
+
+    s = db.get_db().get_session()
+    s.add(Adherent(nom='Martin', prenom='Paul', mail='p.martin@free.fr',
+                   login='martin_p', password='a'))
+    s.commit()
+    assert filter_users(api_client, 'martin') == ['martin_p']
+
+
+def test_search_ngram_index_after_rollback(api_client):
+    s = db.get_db().get_session()
+    a = s.query(Adherent).filter(Adherent.login == 'dubois_j').one()
+    a.nom = 'Martin'
+    s.flush()
+    # The index is rebuilt with the uncommitted change...
+    assert search.SEARCHABLES['user'].ngram(s, 'martin') is not None
+    s.rollback()
+    # ... and rebuilt again once it is rolled back
+    assert search.SEARCHABLES['user'].get_index().dirty
+    assert filter_users(api_client, 'dubois') == ['dubois_j']
+
+
+def test_search_ngram_index_rebuilt_before_commit(api_client):
+    s = db.get_db().get_session()
+    s.add(Adherent(nom='Martin', prenom='Paul', mail='p.martin@free.fr',
+                   login='martin_p', password='a'))
+    s.flush()
+    # Rebuilt by another thread, which cannot see the uncommitted row
+    index = search.SEARCHABLES['user'].get_index()
+    index.dirty = False
+    s.commit()
+    assert index.dirty
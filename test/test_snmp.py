@@ -0,0 +1,259 @@
+import threading
+import time
+import pytest
+from pysnmp.hlapi import SnmpEngine, UdpTransportTarget
+from adh import snmp
+from adh.snmp import AsyncSNMPManager, SNMPError, SNMPManager
+
+from .snmp_agent import FakeSwitch
+
+IF_ADMIN_STATUS = "1.3.6.1.2.1.2.2.1.7."
+
+
+@pytest.fixture
+def fake_switch():
+    values = {IF_ADMIN_STATUS + str(i): 1 for i in range(1, 49)}
+    with FakeSwitch(values) as switch:
+        yield switch
+
+
+def test_snmp_get(fake_switch):
+    manager = SNMPManager("127.0.0.1", "public", port=fake_switch.port)
+    assert manager.make_request(IF_ADMIN_STATUS, 1) == 1
+
+
+def test_snmp_set(fake_switch):
+    manager = SNMPManager("127.0.0.1", "public", port=fake_switch.port)
+    assert manager.change_value(IF_ADMIN_STATUS, 2, 2) == 2
+    assert fake_switch.values[IF_ADMIN_STATUS + "2"] == 2
+    assert manager.make_request(IF_ADMIN_STATUS, 2) == 2
+
+
+def test_snmp_engine_and_target_reused(fake_switch):
+    manager = SNMPManager("127.0.0.1", "public", port=fake_switch.port)
+    manager.make_request(IF_ADMIN_STATUS, 1)
+    engine = snmp.get_engine()
+    target = snmp.get_target("127.0.0.1", fake_switch.port)
+
+    manager.make_request(IF_ADMIN_STATUS, 2)
+    assert snmp.get_engine() is engine
+    assert snmp.get_target("127.0.0.1", fake_switch.port) is target
+
+
+def test_snmp_engine_and_target_created_once(fake_switch, monkeypatch):
+    """ Creating an engine is very slow, the requests share it """
+    created = []
+
+    def counted(cls):
+        def create(*args, **kwargs):
+            created.append(cls)
+            return cls(*args, **kwargs)
+        return create
+
+    monkeypatch.setattr(snmp, "_local", threading.local())
+    monkeypatch.setattr(snmp, "SnmpEngine", counted(SnmpEngine))
+    monkeypatch.setattr(snmp, "UdpTransportTarget",
+                        counted(UdpTransportTarget))
+    manager = SNMPManager("127.0.0.1", "public", port=fake_switch.port)
+    for _ in range(10):
+        assert manager.make_request(IF_ADMIN_STATUS, 1) == 1
+    assert created.count(SnmpEngine) == 1
+    assert created.count(UdpTransportTarget) == 1
+
+
+@pytest.fixture
+def fake_switches():
+    values = {IF_ADMIN_STATUS + str(i): 1 for i in range(1, 49)}
+    with FakeSwitch(values, delay=0.1) as s1, \
+            FakeSwitch(values, delay=0.1) as s2, \
+            FakeSwitch(values, delay=0.1) as s3, \
+            FakeSwitch(values, delay=0.1) as s4:
+        yield [s1, s2, s3, s4]
+
+
+def async_manager(switch, **kwargs):
+    return AsyncSNMPManager("127.0.0.1", "public", port=switch.port,
+                            **kwargs)
+
+
+def test_async_snmp_get(fake_switch):
+    manager = async_manager(fake_switch)
+    assert snmp.run(manager.make_request(IF_ADMIN_STATUS, 1)) == 1
+
+
+def test_async_snmp_set(fake_switch):
+    manager = async_manager(fake_switch)
+    assert snmp.run(manager.change_value(IF_ADMIN_STATUS, 2, 2)) == 2
+    assert fake_switch.values[IF_ADMIN_STATUS + "2"] == 2
+
+
+def test_async_snmp_get_many_oids(fake_switch):
+    """ More variables than fit in one PDU """
+    oids = [IF_ADMIN_STATUS + str(i) for i in range(1, 49)]
+    fake_switch.values[IF_ADMIN_STATUS + "48"] = 2
+
+    values = snmp.run(async_manager(fake_switch).get(oids))
+    assert list(map(int, values)) == [1] * 47 + [2]
+    assert fake_switch.requests == 2
+
+
+def test_async_snmp_timeout(fake_switch):
+    manager = AsyncSNMPManager("127.0.0.1", "wrong", port=fake_switch.port,
+                               timeout=0.05, retries=1)
+    result = snmp.run(manager.make_request(IF_ADMIN_STATUS, 1))
+    assert isinstance(result, SNMPError)
+
+
+def test_batch_get(fake_switches):
+    oids = [IF_ADMIN_STATUS + "1", IF_ADMIN_STATUS + "2"]
+    queries = {i: (async_manager(s), oids)
+               for i, s in enumerate(fake_switches)}
+
+    result = snmp.batch_get(queries)
+
+    assert sorted(result) == [0, 1, 2, 3]
+    for values in result.values():
+        assert list(map(int, values)) == [1, 1]
+    # Both variables in a single GET per switch
+    assert [s.requests for s in fake_switches] == [1] * 4
+
+
+def test_batch_get_concurrency_limit(fake_switches):
+    oids = [IF_ADMIN_STATUS + "1"]
+    queries = {i: (async_manager(s), oids)
+               for i, s in enumerate(fake_switches)}
+
+    start = time.perf_counter()
+    snmp.batch_get(queries, concurrency=1)
+    assert time.perf_counter() - start >= 0.4
+
+
+def test_batch_get_switch_timeout(fake_switches):
+    """ A slow switch fails alone, the others still answer """
+    fake_switches[0].delay = 1
+    oids = [IF_ADMIN_STATUS + "1"]
+    queries = {i: (async_manager(s, timeout=2), oids)
+               for i, s in enumerate(fake_switches)}
+
+    result = snmp.batch_get(queries, timeout=0.5)
+    assert isinstance(result[0], SNMPError)
+    for i in (1, 2, 3):
+        assert list(map(int, result[i])) == [1]
+
+
+def test_batch_set(fake_switches):
+    changes = {
+        i: (async_manager(s), [(IF_ADMIN_STATUS + str(i + 1), 2)])
+        for i, s in enumerate(fake_switches)
+    }
+    result = snmp.batch_set(changes)
+
+    for i, s in enumerate(fake_switches):
+        assert list(map(int, result[i])) == [2]
+        assert s.values[IF_ADMIN_STATUS + str(i + 1)] == 2
+
+
+def test_batch_latency(fake_switches):
+    """ Whole switch audit: sequential SNMPManager vs batch_get """
+    oids = [IF_ADMIN_STATUS + str(i) for i in range(1, 49)]
+    for s in fake_switches:
+        s.delay = 0.005
+
+    start = time.perf_counter()
+    for s in fake_switches:
+        manager = SNMPManager("127.0.0.1", "public", port=s.port)
+        for i in range(1, 49):
+            manager.make_request(IF_ADMIN_STATUS, i)
+    sequential = time.perf_counter() - start
+
+    assert [s.requests for s in fake_switches] == [48] * 4
+
+    start = time.perf_counter()
+    snmp.batch_get({i: (async_manager(s), oids)
+                    for i, s in enumerate(fake_switches)})
+    batch = time.perf_counter() - start
+
+    print("4 switches x 48 ports: {:.0f}ms sequential, {:.0f}ms batch"
+          .format(sequential * 1000, batch * 1000))
+    # 48 variables, at most 32 per GET
+    assert [s.requests for s in fake_switches] == [50] * 4
+
+
+@pytest.fixture
+def port_switch():
+    """ 48 ports, indexed like 10101..10148, and a few unrelated rows """
+    values = {"1.3.6.1.2.1.2.2.1.2.1": 0, "1.3.6.1.2.1.2.2.1.9.1": 0}
+    for i in range(1, 49):
+        index = str(10100 + i)
+        values[snmp.IF_OPER_STATUS + "." + index] = 1 if i % 2 else 2
+        values[snmp.IF_ADMIN_STATUS + "." + index] = 1
+        values[snmp.VM_VLAN + "." + index] = 40 + i % 3
+    with FakeSwitch(values) as switch:
+        yield switch
+
+
+def test_snmp_walk(port_switch):
+    manager = async_manager(port_switch)
+    table = snmp.run(manager.walk([snmp.IF_OPER_STATUS, snmp.VM_VLAN]))
+
+    assert len(table[snmp.IF_OPER_STATUS]) == 48
+    assert int(table[snmp.IF_OPER_STATUS]["10101"]) == 1
+    assert int(table[snmp.IF_OPER_STATUS]["10102"]) == 2
+    assert int(table[snmp.VM_VLAN]["10103"]) == 40
+
+
+def test_snmp_port_states(port_switch):
+    manager = SNMPManager("127.0.0.1", "public", port=port_switch.port)
+    states = manager.port_states()
+
+    assert len(states) == 48
+    assert states["10101"] == snmp.PortState(oper_status=1, admin_status=1,
+                                             vlan=41)
+    # 3 columns x 48 ports, 16 rows per GETBULK and the end of the columns
+    assert port_switch.requests == 4
+
+
+def test_snmp_port_states_selected(port_switch):
+    manager = SNMPManager("127.0.0.1", "public", port=port_switch.port)
+    states = manager.port_states(["10102", "20000"])
+
+    assert states == {
+        "10102": snmp.PortState(oper_status=2, admin_status=1, vlan=42),
+        "20000": snmp.PortState(oper_status=None, admin_status=None,
+                                vlan=None),
+    }
+
+
+def test_snmp_port_states_latency(port_switch):
+    """ Whole switch snapshot: one GET per port and variable vs GETBULK """
+    manager = SNMPManager("127.0.0.1", "public", port=port_switch.port)
+    manager.make_request(snmp.IF_OPER_STATUS + ".", 10101)  # Warm up
+
+    requests = port_switch.requests
+    start = time.perf_counter()
+    for i in range(10101, 10149):
+        for column in snmp.PORT_COLUMNS:
+            manager.make_request(column + ".", i)
+    per_oid = time.perf_counter() - start
+    assert port_switch.requests - requests == 48 * 3
+
+    requests = port_switch.requests
+    start = time.perf_counter()
+    manager.port_states()
+    bulk = time.perf_counter() - start
+    assert port_switch.requests - requests == 4
+
+    print("48 ports snapshot: {:.0f}ms with GET, {:.0f}ms with GETBULK"
+          .format(per_oid * 1000, bulk * 1000))
+
+
+def test_batch_port_states(port_switch, fake_switch):
+    result = snmp.batch_port_states({
+        "ports": (async_manager(port_switch), ["10101"]),
+        "other": (async_manager(fake_switch), None),
+    })
+    assert result["ports"]["10101"].vlan == 41
+    # The other switch only has ifAdminStatus
+    assert len(result["other"]) == 48
+    assert result["other"]["13"] == snmp.PortState(
+        oper_status=None, admin_status=1, vlan=None)
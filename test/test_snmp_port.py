@@ -0,0 +1,352 @@
+import json
+import pytest
+from adh import snmp
+from adh.model.database import Database as db
+from adh.model.models import Chambre, Port, Switch
+from adh.util import port_state
+from adh.util.port_state import PortStateCache
+from CONFIGURATION import TEST_DATABASE as db_settings
+
+from .resource import base_url, TEST_HEADERS
+from .snmp_agent import FakeSwitch
+
+
+@pytest.fixture
+def fake_switch():
+    values = {}
+    for i in range(1, 41):
+        values[snmp.IF_OPER_STATUS + ".1.1.{}".format(i)] = 1
+        values[snmp.IF_ADMIN_STATUS + ".1.1.{}".format(i)] = 1
+        values[snmp.VM_VLAN + ".1.1.{}".format(i)] = 40 + i
+    with FakeSwitch(values, community="GrosMotDePasse") as switch:
+        yield switch
+
+
+@pytest.fixture
+def sample_switch():
+    yield Switch(
+        description="Switch sample 1",
+        ip="127.0.0.1",
+        communaute="GrosMotDePasse",
+    )
+
+
+@pytest.fixture
+def sample_switch2():
+    yield Switch(
+        description="Switch sample 2",
+        ip="127.0.0.1",
+        communaute="WrongPassword",
+    )
+
+
+@pytest.fixture
+def sample_port1(sample_switch):
+    yield Port(rcom=1, numero="0/0/1", oid="1.1.1", switch=sample_switch,
+               chambre_id=0)
+
+
+@pytest.fixture
+def sample_port2(sample_switch2):
+    yield Port(rcom=2, numero="0/0/2", oid="1.1.2", switch=sample_switch2,
+               chambre_id=0)
+
+
+def prep_db(session, sample_switch, sample_switch2, sample_port1,
+            sample_port2):
+    session.add_all([
+        sample_switch,
+        sample_switch2,
+        sample_port1,
+        sample_port2,
+        Chambre(numero=5110, description="Chambre"),
+    ])
+    session.commit()
+
+
+@pytest.fixture
+def api_client(fake_switch, sample_switch, sample_switch2, sample_port1,
+               sample_port2):
+    from .context import app
+    config = app.app.config
+    saved = {k: config.get(k) for k in ("SNMP_PORT", "SNMP_REQUEST_TIMEOUT",
+                                        "SNMP_RETRIES")}
+    config.update(SNMP_PORT=fake_switch.port, SNMP_REQUEST_TIMEOUT=0.5,
+                  SNMP_RETRIES=0)
+    with app.app.test_client() as c:
+        db.init_db(db_settings, testing=True)
+        prep_db(db.get_db().get_session(), sample_switch, sample_switch2,
+                sample_port1, sample_port2)
+        # Several requests are made, commit the sample data for good
+        db.get_db().get_session().commit()
+        yield c
+    config.update(saved)
+
+
+def port_url(switch, port, what):
+    return "{}/switch/{}/port/{}/{}/".format(base_url, switch.id, port.id,
+                                             what)
+
+
+def test_port_state_get_status(api_client, fake_switch, sample_switch,
+                               sample_port1):
+    r = api_client.get(port_url(sample_switch, sample_port1, "state"),
+                       headers=TEST_HEADERS)
+    assert r.status_code == 200
+    assert json.loads(r.data.decode()) is True
+
+
+def test_port_state_get_vlan(api_client, sample_switch, sample_port1):
+    r = api_client.get(port_url(sample_switch, sample_port1, "vlan"),
+                       headers=TEST_HEADERS)
+    assert r.status_code == 200
+    assert json.loads(r.data.decode()) == 41
+
+
+def test_port_state_served_from_cache(api_client, fake_switch, sample_switch,
+                                      sample_port1):
+    api_client.get(port_url(sample_switch, sample_port1, "state"),
+                   headers=TEST_HEADERS)
+    requests = fake_switch.requests
+
+    fake_switch.values[snmp.VM_VLAN + ".1.1.1"] = 50
+    r = api_client.get(port_url(sample_switch, sample_port1, "vlan"),
+                       headers=TEST_HEADERS)
+    assert json.loads(r.data.decode()) == 41
+    assert fake_switch.requests == requests
+
+
+def test_port_state_set_status(api_client, fake_switch, sample_switch,
+                               sample_port1):
+    api_client.get(port_url(sample_switch, sample_port1, "state"),
+                   headers=TEST_HEADERS)
+
+    r = api_client.put(port_url(sample_switch, sample_port1, "state"),
+                       data=json.dumps(False),
+                       content_type='application/json',
+                       headers=TEST_HEADERS)
+    assert r.status_code == 204
+    assert fake_switch.values[snmp.IF_ADMIN_STATUS + ".1.1.1"] == 2
+
+    # Written through the cache
+    requests = fake_switch.requests
+    r = api_client.get(port_url(sample_switch, sample_port1, "state"),
+                       headers=TEST_HEADERS)
+    assert json.loads(r.data.decode()) is False
+    assert fake_switch.requests == requests
+
+
+def test_port_state_set_vlan(api_client, fake_switch, sample_switch,
+                             sample_port1):
+    r = api_client.put(port_url(sample_switch, sample_port1, "vlan"),
+                       data=json.dumps(48),
+                       content_type='application/json',
+                       headers=TEST_HEADERS)
+    assert r.status_code == 204
+    assert fake_switch.values[snmp.VM_VLAN + ".1.1.1"] == 48
+
+    r = api_client.get(port_url(sample_switch, sample_port1, "vlan"),
+                       headers=TEST_HEADERS)
+    assert json.loads(r.data.decode()) == 48
+
+
+def test_port_state_unknown_port(api_client, sample_switch, sample_port2):
+    """ The port exists, but not on this switch """
+    r = api_client.get(port_url(sample_switch, sample_port2, "vlan"),
+                       headers=TEST_HEADERS)
+    assert r.status_code == 404
+
+
+def no_oid_port(switch):
+    s = db.get_db().get_session()
+    port = Port(numero="0/1/42", oid=None, switch=switch, chambre_id=0)
+    s.add(port)
+    s.commit()
+    s.commit()
+    return port
+
+
+@pytest.mark.parametrize("what, value", [("state", False), ("vlan", 48)])
+def test_port_state_set_no_oid(api_client, fake_switch, sample_switch,
+                               what, value):
+    port = no_oid_port(sample_switch)
+    r = api_client.put(port_url(sample_switch, port, what),
+                       data=json.dumps(value),
+                       content_type='application/json',
+                       headers=TEST_HEADERS)
+    assert r.status_code == 400
+    assert fake_switch.requests == 0
+
+
+def test_port_state_switch_unreachable(api_client, sample_switch2,
+                                       sample_port2):
+    r = api_client.get(port_url(sample_switch2, sample_port2, "state"),
+                       headers=TEST_HEADERS)
+    assert r.status_code == 503
+
+
+def test_port_state_poll_switches(api_client, sample_switch, sample_switch2):
+    from .context import app
+    with app.app.app_context():
+        results = port_state.poll_switches()
+        cache = port_state.get_state_cache()
+        assert cache.get(sample_switch.id)["1.1.2"].vlan == 42
+        assert cache.get(sample_switch2.id) is None
+    assert isinstance(results[sample_switch2.id], snmp.SNMPError)
+
+
+def test_port_state_cache_max_age():
+    now = [0]
+    cache = PortStateCache(max_age=30, clock=lambda: now[0])
+    cache.store(1, {"1.1.1": port_state.UNKNOWN._replace(vlan=41)}, 0)
+    now[0] = 29
+    assert cache.get(1)["1.1.1"].vlan == 41
+    now[0] = 30
+    assert cache.get(1) is None
+
+
+def test_port_state_cache_write_during_poll():
+    """ A snapshot started before a write must not undo it """
+    now = [0]
+    cache = PortStateCache(max_age=30, clock=lambda: now[0])
+    cache.store(1, {"1.1.1": port_state.UNKNOWN._replace(vlan=41)}, 0)
+
+    now[0] = 10
+    taken_at = cache.clock()  # The poller starts reading the switch
+    now[0] = 11
+    cache.update(1, "1.1.1", "vlan", 48)
+    now[0] = 12
+    cache.store(1, {"1.1.1": port_state.UNKNOWN._replace(vlan=41)}, taken_at)
+
+    assert cache.get(1)["1.1.1"].vlan == 48
+
+
+def test_port_state_read_from_snapshot(api_client, fake_switch,
+                                       sample_switch, sample_port1):
+    """ Once the switch is read, GET is served from the snapshot """
+    url = port_url(sample_switch, sample_port1, "vlan")
+    api_client.get(url, headers=TEST_HEADERS)
+
+    requests = fake_switch.requests
+    for _ in range(10):
+        assert api_client.get(url, headers=TEST_HEADERS).status_code == 200
+    assert fake_switch.requests == requests
+
+    db.get_db().get_cache("port_states", None).clear()
+    api_client.get(url, headers=TEST_HEADERS)
+    assert fake_switch.requests > requests
+
+
+def vlans_url(switch):
+    return "{}/switch/{}/port/vlan/".format(base_url, switch.id)
+
+
+def add_ports(switch, n):
+    """ Add the ports 1.1.3 ... 1.1.n of the fake switch """
+    s = db.get_db().get_session()
+    ports = [Port(numero="0/1/{}".format(i), oid="1.1.{}".format(i),
+                  switch=switch, chambre_id=0) for i in range(3, n + 1)]
+    s.add_all(ports)
+    s.commit()
+    s.commit()
+    return ports
+
+
+def test_port_state_set_vlans(api_client, fake_switch, sample_switch,
+                              sample_port1, sample_port2):
+    port3, = add_ports(sample_switch, 3)
+    body = [
+        {"portID": sample_port1.id, "vlan": 48},
+        {"portID": port3.id, "vlan": 49},
+        {"portID": sample_port2.id, "vlan": 48},  # Not on this switch
+        {"portID": 4242, "vlan": 48},
+    ]
+    r = api_client.put(vlans_url(sample_switch), data=json.dumps(body),
+                       content_type='application/json',
+                       headers=TEST_HEADERS)
+    assert r.status_code == 200
+    result = json.loads(r.data.decode())
+    assert [(i["portID"], i["status"]) for i in result] == [
+        (sample_port1.id, 204),
+        (port3.id, 204),
+        (sample_port2.id, 404),
+        (4242, 404),
+    ]
+    assert fake_switch.values[snmp.VM_VLAN + ".1.1.1"] == 48
+    assert fake_switch.values[snmp.VM_VLAN + ".1.1.3"] == 49
+    # A single SET for both ports
+    assert fake_switch.requests == 1
+
+    # Written through the cache
+    api_client.get(port_url(sample_switch, port3, "state"),
+                   headers=TEST_HEADERS)
+    requests = fake_switch.requests
+    r = api_client.get(port_url(sample_switch, port3, "vlan"),
+                       headers=TEST_HEADERS)
+    assert json.loads(r.data.decode()) == 49
+    assert fake_switch.requests == requests
+
+
+def test_port_state_set_vlans_no_oid(api_client, fake_switch, sample_switch,
+                                     sample_port1):
+    port = no_oid_port(sample_switch)
+    body = [{"portID": port.id, "vlan": 48},
+            {"portID": sample_port1.id, "vlan": 48}]
+    r = api_client.put(vlans_url(sample_switch), data=json.dumps(body),
+                       content_type='application/json',
+                       headers=TEST_HEADERS)
+    result = json.loads(r.data.decode())
+    assert [i["status"] for i in result] == [400, 204]
+    assert result[0]["message"] == "The port has no SNMP OID"
+
+
+def test_port_state_set_vlans_many_ports(api_client, fake_switch,
+                                         sample_switch, sample_port1):
+    ports = [sample_port1] + add_ports(sample_switch, 40)
+    body = [{"portID": p.id, "vlan": 60} for p in ports]
+    r = api_client.put(vlans_url(sample_switch), data=json.dumps(body),
+                       content_type='application/json',
+                       headers=TEST_HEADERS)
+    result = json.loads(r.data.decode())
+    assert [i["status"] for i in result] == [204] * 39
+    # 39 variables, at most 32 per SET
+    assert fake_switch.requests == 2
+
+
+def test_port_state_set_vlans_switch_unreachable(api_client, sample_switch2,
+                                                 sample_port2):
+    body = [{"portID": sample_port2.id, "vlan": 60}]
+    r = api_client.put(vlans_url(sample_switch2), data=json.dumps(body),
+                       content_type='application/json',
+                       headers=TEST_HEADERS)
+    assert r.status_code == 200
+    assert json.loads(r.data.decode())[0]["status"] == 503
+
+
+def test_port_state_set_vlans_unknown_switch(api_client):
+    r = api_client.put("{}/switch/4242/port/vlan/".format(base_url),
+                       data=json.dumps([{"portID": 1, "vlan": 60}]),
+                       content_type='application/json',
+                       headers=TEST_HEADERS)
+    assert r.status_code == 404
+
+
+def test_port_state_set_vlans_one_request(api_client, fake_switch,
+                                          sample_switch, sample_port1):
+    """ One SET per port with PUT vs a single SET for the batch """
+    ports = [sample_port1] + add_ports(sample_switch, 20)
+    urls = [port_url(sample_switch, p, "vlan") for p in ports]
+    body = [{"portID": p.id, "vlan": 61} for p in ports]
+    url = vlans_url(sample_switch)
+
+    for port_vlan_url in urls:
+        api_client.put(port_vlan_url,
+                       data=json.dumps(60),
+                       content_type='application/json',
+                       headers=TEST_HEADERS)
+    assert fake_switch.requests == len(ports)
+
+    api_client.put(url, data=json.dumps(body),
+                   content_type='application/json', headers=TEST_HEADERS)
+    assert fake_switch.requests == len(ports) + 1
+    assert fake_switch.values[snmp.VM_VLAN + ".1.1.20"] == 61
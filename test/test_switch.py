@@ -108,6 +108,31 @@ def test_switch_get_all_limit(api_client):
     assert len(t) == 0
 
 
+def test_switch_get_all_with_cursor(api_client):
+    # Several requests are made, commit the sample data for good
+    db.get_db().get_session().commit()
+    r = api_client.get(
+        "{}/switch/?limit={}".format(base_url, 1),
+        headers=TEST_HEADERS,
+    )
+    assert r.status_code == 200
+    r = api_client.get(
+        "{}/switch/?limit={}&cursor={}".format(
+            base_url, 1, r.headers['X-Next-Cursor']),
+        headers=TEST_HEADERS,
+    )
+    assert r.status_code == 200
+    assert json.loads(r.data.decode('utf-8')) == []
+
+
+def test_switch_get_all_invalid_cursor(api_client):
+    r = api_client.get(
+        "{}/switch/?cursor={}".format(base_url, "notacursor"),
+        headers=TEST_HEADERS,
+    )
+    assert r.status_code == 400
+
+
 def test_switch_get_all(api_client):
     r = api_client.get(
         "{}/switch/".format(base_url),
@@ -2,7 +2,7 @@ import json
 import pytest
 from adh.model.database import Database as db
 from CONFIGURATION import TEST_DATABASE as db_settings
-from test.resource import base_url, TEST_HEADERS
+from test.resource import base_url, TEST_HEADERS, count_queries
 from adh.model.models import Adherent, Chambre, Vlan, Modification
 from dateutil import parser
 from adh.controller.user import ntlm_hash
@@ -162,6 +162,108 @@ def test_user_filter_all_with_limit(api_client):
     assert len(response) == 1
 
 
+def test_user_filter_with_cursor(api_client):
+    # Several requests are made, commit the sample data for good
+    db.get_db().get_session().commit()
+    logins = []
+    cursor = None
+    for _ in range(3):
+        url = '{}/user/?limit={}'.format(base_url, 1)
+        if cursor:
+            url += '&cursor={}'.format(cursor)
+        r = api_client.get(url, headers=TEST_HEADERS)
+        assert r.status_code == 200
+        assert r.headers['X-Total-Count'] == '3'
+        logins += [u['username'] for u in json.loads(r.data.decode('utf-8'))]
+        cursor = r.headers.get('X-Next-Cursor')
+
+    assert logins == ['dubois_j', 'dupond_r', 'reignier']
+
+    # The last page is full, so we get a cursor, but the next page is empty
+    r = api_client.get(
+        '{}/user/?limit={}&cursor={}'.format(base_url, 1, cursor),
+        headers=TEST_HEADERS,
+    )
+    assert json.loads(r.data.decode('utf-8')) == []
+    assert 'X-Next-Cursor' not in r.headers
+
+
+def test_user_filter_with_invalid_cursor(api_client):
+    r = api_client.get(
+        '{}/user/?cursor={}'.format(base_url, 'notacursor'),
+        headers=TEST_HEADERS,
+    )
+    assert r.status_code == 400
+
+
+def test_user_filter_without_count(api_client):
+    with count_queries(db.get_db().engine) as statements:
+        r = api_client.get(
+            '{}/user/?totalCount={}'.format(base_url, 'none'),
+            headers=TEST_HEADERS,
+        )
+    assert r.status_code == 200
+    assert 'X-Total-Count' not in r.headers
+    assert len(json.loads(r.data.decode('utf-8'))) == 3
+    assert not any('count(' in s.lower() for s in statements)
+
+
+def test_user_filter_cached_count(api_client, sample_member3):
+    # Several requests are made, commit the sample data for good
+    db.get_db().get_session().commit()
+
+    url = '{}/user/?totalCount={}'.format(base_url, 'cached')
+    r = api_client.get(url, headers=TEST_HEADERS)
+    assert r.headers['X-Total-Count'] == '3'
+
+    s = db.get_db().get_session()
+    s.delete(s.query(Adherent).filter(Adherent.login == 'dupond_r').one())
+    s.commit()
+
+    # The count is reused...
+    r = api_client.get(url, headers=TEST_HEADERS)
+    assert r.headers['X-Total-Count'] == '3'
+    # ... but only for the same filters
+    r = api_client.get(url + '&terms=dubois', headers=TEST_HEADERS)
+    assert r.headers['X-Total-Count'] == '1'
+    r = api_client.get(
+        '{}/user/?totalCount={}'.format(base_url, 'exact'),
+        headers=TEST_HEADERS,
+    )
+    assert r.headers['X-Total-Count'] == '2'
+
+
+def test_user_filter_invalid_count_mode(api_client):
+    r = api_client.get(
+        '{}/user/?totalCount={}'.format(base_url, 'approximately'),
+        headers=TEST_HEADERS,
+    )
+    assert r.status_code == 400
+
+
+def test_user_filter_constant_number_of_queries(api_client, sample_vlan):
+    s = db.get_db().get_session()
+    for i in range(10):
+        room = Chambre(numero=2000 + i, description='room', vlan=sample_vlan)
+        s.add(Adherent(nom='N', prenom='P', mail='np{}@free.fr'.format(i),
+                       login='member_{}'.format(i), password='a',
+                       chambre=room))
+    s.commit()
+    # Several requests are made, commit the sample data for good
+    s.commit()
+
+    def number_of_queries(limit):
+        with count_queries(db.get_db().engine) as statements:
+            r = api_client.get(
+                '{}/user/?limit={}'.format(base_url, limit),
+                headers=TEST_HEADERS,
+            )
+        assert len(json.loads(r.data.decode('utf-8'))) == limit
+        return len(statements)
+
+    assert number_of_queries(1) == number_of_queries(12)
+
+
 def test_user_filter_by_room_number(api_client):
     r = api_client.get(
         '{}/user/?roomNumber={}'.format(base_url, 1234),
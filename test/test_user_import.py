@@ -0,0 +1,235 @@
+import datetime
+import json
+import pytest
+from adh.model.database import Database as db
+from adh.model.models import Adherent, Adhesion, Chambre, Modification, Vlan
+from CONFIGURATION import TEST_DATABASE as db_settings
+
+from .resource import base_url, TEST_HEADERS, count_commits, count_queries
+
+
+@pytest.fixture
+def sample_room():
+    yield Chambre(
+        numero=1234,
+        description='chambre 1',
+        vlan=Vlan(numero=42, adresses="192.168.42.1", adressesv6="fe80::1"),
+    )
+
+
+@pytest.fixture
+def sample_member(sample_room):
+    yield Adherent(
+        nom='Dubois',
+        prenom='Jean-Louis',
+        mail='j.dubois@free.fr',
+        login='dubois_j',
+        password='a',
+        chambre=sample_room,
+    )
+
+
+def prep_db(session, sample_room, sample_member):
+    session.add_all([sample_room, sample_member])
+    session.commit()
+
+
+@pytest.fixture
+def api_client(sample_room, sample_member):
+    from .context import app
+    with app.app.test_client() as c:
+        db.init_db(db_settings, testing=True)
+        prep_db(db.get_db().get_session(), sample_room, sample_member)
+        # Several requests are made, commit the sample data for good
+        db.get_db().get_session().commit()
+        yield c
+
+
+def make_user(i, **kwargs):
+    user = {
+        "firstName": "John",
+        "lastName": "Doe {}".format(i),
+        "email": "john.doe{}@gmail.com".format(i),
+        "username": "doe_{}".format(i),
+    }
+    user.update(kwargs)
+    return user
+
+
+def import_json(client, rows):
+    return client.post("{}/user/import/".format(base_url),
+                       data=json.dumps(rows),
+                       content_type="application/json",
+                       headers=TEST_HEADERS)
+
+
+def import_csv(client, text):
+    return client.post("{}/user/import/".format(base_url),
+                       data=text.encode("utf-8"),
+                       content_type="text/csv",
+                       headers=TEST_HEADERS)
+
+
+def statuses(r):
+    assert r.status_code == 200
+    return [row["status"] for row in json.loads(r.data.decode())]
+
+
+def test_user_import_json(api_client):
+    rows = [
+        make_user(1, roomNumber=1234, comment="comment",
+                  membershipStart="2018-09-01T00:00:00",
+                  membershipDuration=365),
+        make_user(2),
+    ]
+    r = import_json(api_client, rows)
+    assert statuses(r) == [201, 201]
+
+    s = db.get_db().get_session()
+    a = Adherent.find(s, "doe_1")
+    assert a.nom == "Doe 1"
+    assert a.chambre.numero == 1234
+    assert a.commentaires == "comment"
+    assert Adherent.find(s, "doe_2").chambre is None
+
+    adhesion = s.query(Adhesion).one()
+    assert adhesion.adherent_id == a.id
+    assert adhesion.depart == datetime.datetime(2018, 9, 1)
+    assert adhesion.fin == datetime.datetime(2019, 9, 1)
+
+    m = s.query(Modification).filter(Modification.adherent_id == a.id).one()
+    assert m.utilisateur_id == 1
+    assert m.action == (
+        '--- !ruby/hash:ActiveSupport::HashWithIndifferentAccess\n'
+        'chambre_id:\n'
+        '- \n'
+        '- 1\n'
+        'commentaires:\n'
+        '- \n'
+        '- comment\n'
+        'id:\n'
+        '- \n'
+        '- {}\n'
+        'login:\n'
+        '- \n'
+        '- doe_1\n'
+        'mail:\n'
+        '- \n'
+        '- john.doe1@gmail.com\n'
+        'nom:\n'
+        '- \n'
+        '- Doe 1\n'
+        'prenom:\n'
+        '- \n'
+        '- John\n'
+    ).format(a.id)
+    assert s.query(Modification).count() == 2
+
+
+def test_user_import_csv(api_client):
+    text = (
+        "username,firstName,lastName,email,roomNumber,membershipDuration\n"
+        "doe_1,John,Doe,john.doe@gmail.com,1234,365\n"
+        "doe_2,Jane,Doe,jane.doe@gmail.com,,\n"
+    )
+    r = import_csv(api_client, text)
+    assert statuses(r) == [201, 201]
+
+    s = db.get_db().get_session()
+    assert Adherent.find(s, "doe_1").chambre.numero == 1234
+    assert Adherent.find(s, "doe_2").chambre is None
+    adhesion = s.query(Adhesion).one()
+    assert adhesion.fin - adhesion.depart == datetime.timedelta(days=365)
+
+
+def test_user_import_row_errors(api_client):
+    rows = [
+        make_user(1),
+        make_user(2, email="not an email"),
+        make_user(3, roomNumber=4242),
+        make_user(4, username="dubois_j"),
+        make_user(1),
+        make_user(6, membershipDuration="a year"),
+        make_user(7, membershipStart="2018-09-01T00:00:00"),
+        {"firstName": "John"},
+        make_user(9),
+    ]
+    r = import_json(api_client, rows)
+    assert statuses(r) == [201, 400, 400, 409, 409, 400, 400, 400, 201]
+    result = json.loads(r.data.decode())
+    assert result[2]["message"] == "No room found"
+    assert result[7]["message"] == "email is required"
+
+    s = db.get_db().get_session()
+    assert s.query(Adherent).count() == 3
+    assert s.query(Modification).count() == 2
+
+
+@pytest.mark.parametrize("data", [
+    "{}",
+    "[1, 2]",
+    "[{",
+])
+def test_user_import_invalid_body(api_client, data):
+    r = api_client.post("{}/user/import/".format(base_url), data=data,
+                        content_type="application/json",
+                        headers=TEST_HEADERS)
+    assert r.status_code == 400
+
+
+def test_user_import_chunks(api_client, monkeypatch):
+    from .context import app
+    monkeypatch.setitem(app.app.config, "IMPORT_CHUNK_SIZE", 2)
+    with count_commits(db.get_db().engine) as commits:
+        r = import_json(api_client, [make_user(i) for i in range(5)])
+    assert statuses(r) == [201] * 5
+    assert len(commits) == 3
+
+
+def test_user_import_conflict_in_chunk(api_client, monkeypatch):
+    """ Only the row created by someone else in the meantime is a 409 """
+    from adh.controller import user_import
+    from .context import app
+    monkeypatch.setitem(app.app.config, "IMPORT_CHUNK_SIZE", 3)
+    resolve_rows = user_import.resolve_rows
+
+    def created_meanwhile(s, rows, results):
+        valid = resolve_rows(s, rows, results)
+        s.execute(Adherent.__table__.insert().values(login="doe_2"))
+        s.commit()
+        return valid
+
+    monkeypatch.setattr(user_import, "resolve_rows", created_meanwhile)
+    r = import_json(api_client, [make_user(i) for i in range(1, 5)])
+    assert statuses(r) == [201, 409, 201, 201]
+    assert json.loads(r.data.decode())[1]["message"] == "User already exists"
+
+    s = db.get_db().get_session()
+    assert s.query(Adherent).count() == 5
+    assert s.query(Modification).count() == 3
+
+
+def test_user_import_constant_number_of_queries(api_client):
+    engine = db.get_db().engine
+    # Create the admin, then cache it
+    import_json(api_client, [make_user(0)])
+    import_json(api_client, [])
+    with count_queries(engine) as few:
+        import_json(api_client, [make_user(i, membershipDuration=365)
+                                 for i in range(1, 4)])
+    with count_queries(engine) as many:
+        import_json(api_client, [make_user(i, membershipDuration=365)
+                                 for i in range(4, 60)])
+    assert len(few) == len(many)
+
+
+def test_user_import_searchable(api_client):
+    """ The bulk inserts must reach the search index """
+    def search(terms):
+        r = api_client.get("{}/user/?terms={}".format(base_url, terms),
+                           headers=TEST_HEADERS)
+        return [u["username"] for u in json.loads(r.data.decode())]
+
+    assert search("doe_1") == []
+    import_json(api_client, [make_user(1)])
+    assert search("doe_1") == ["doe_1"]
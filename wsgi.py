@@ -1,13 +1,22 @@
 #!/usr/bin/env python3
 import connexion
 import logging
+import CONFIGURATION
 from flask_cors import CORS
 from adh.model.database import Database
 from CONFIGURATION import PROD_DATABASE as DATABASE
 from connexion.resolver import RestyResolver
 from CONFIGURATION import API_CONF
 
-Database.init_db(DATABASE)
+Database.init_db(
+    DATABASE,
+    pool=getattr(CONFIGURATION, "DATABASE_POOL", None),
+    transactions=getattr(CONFIGURATION, "DATABASE_TRANSACTIONS", None),
+)
+
+# The workers must not share the connections opened before the fork (the
+# devices index is rebuilt by adh.model.reindex, not here)
+Database.get_db().engine.dispose()
 
 logging.basicConfig(level=logging.INFO)
 app = connexion.FlaskApp(__name__)